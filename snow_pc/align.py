@@ -1,41 +1,43 @@
 import os
 import json
-import subprocess
-import pandas as pd
-import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname, join, exists, basename, abspath
-import rioxarray as rxr 
-from rasterstats import point_query, zonal_stats
 
 import shutil
-from snow_pc.common import download_dem
+import laspy
+import numpy as np
+from snow_pc.common import download_dem, reader_stages, copy_header
+from snow_pc.pipeline import run_pipeline, run_command
+from snow_pc.report import instrumented, in_run
 
-def clip_align(laz_fp, buff_shp, align_path, asp_dir):
-    """Clip the point cloud to a shapefile.
+def clip_to_roads(laz_fp, buff_shp, clipped_pc = ''):
+    """Clip the point cloud to the buffered roads.
 
     Args:
-        laz_fp (_type_): _description_
-        buff_shp (_type_): _description_
-        dem_is_geoid (_type_): _description_
-        is_canopy (bool, optional): _description_. Defaults to False.
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        buff_shp (_type_): Filepath to the buffered road shapefile from prepare_reference().
+        clipped_pc (str, optional): Filepath to save the clipped point cloud. Defaults to '' which uses <name>-clipped_pc.laz next to the input.
 
     Raises:
-        Exception: _description_
+        Exception: If the clipped point cloud was not created.
+
+    Returns:
+        str: Filepath to the clipped point cloud.
     """
     #set the working directory
-    in_dir = dirname(laz_fp)
-
-    #find the directory that the laz_fp is in
-
+    in_dir = dirname(abspath(laz_fp))
 
-    clipped_pc = join(in_dir, 'clipped_pc.laz')
-    json_fp = join(in_dir, 'jsons', 'clip_align.json')
+    #name the clipped point cloud after the input so the products can be aligned at the same time
+    name = basename(laz_fp).replace('.laz', '').replace('.json', '')
+    if clipped_pc == '':
+        clipped_pc = join(in_dir, f'{name}-clipped_pc.laz')
+    json_fp = join(in_dir, 'jsons', f'clip_align_{name}.json')
 
 
     # Create .json file for PDAL clip
     json_pipeline = {
         "pipeline": [
-            laz_fp,
+            *reader_stages(laz_fp),
             {
                 "type":"filters.overlay",
                 "dimension":"Classification",
@@ -50,18 +52,32 @@ def clip_align(laz_fp, buff_shp, align_path, asp_dir):
             clipped_pc
         ]
     }
-    with open(json_fp,'w') as outfile:
-        json.dump(json_pipeline, outfile, indent = 2)
-
-    subprocess.run(['pdal', 'pipeline', json_fp])               
+    run_pipeline(json_pipeline, json_fp = json_fp)
 
     # Check to see if output clipped point cloud was created
     if not exists(clipped_pc):
         raise Exception('Output point cloud not created')
-    
+    return clipped_pc
+
+def solve_transform(laz_fp, buff_shp, align_path, asp_dir, ref_dem = ''):
+    """Solve the rigid transform of the point cloud to the reference DEM on the roads.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        buff_shp (_type_): Filepath to the buffered road shapefile from prepare_reference().
+        align_path (str): Prefix of the alignment outputs.
+        asp_dir (str): Path to the ASP bin directory.
+        ref_dem (str, optional): Filepath to the reference DEM. Defaults to '' which uses dem.tif next to the point cloud.
+
+    Returns:
+        str: Filepath to the transform file of pc_align.
+    """
+    in_dir = dirname(abspath(laz_fp))
+    clipped_pc = clip_to_roads(laz_fp, buff_shp)
+
     # set the dem file path
-    dem_fp = join(in_dir, 'dem.tif')
-    ref_dem = dem_fp
+    if ref_dem == '':
+        ref_dem = join(in_dir, 'dem.tif')
 
     #There is need to convert the dem to ellipsoid if it is in geoid
 
@@ -69,38 +85,208 @@ def clip_align(laz_fp, buff_shp, align_path, asp_dir):
     #call asp pc_align function on road and DEM and output translation/rotation matrix
     align_pc = join(in_dir,'pc-align', basename(align_path)) #set the align files name format
     pc_align_func = join(asp_dir, 'pc_align') #set the path to the pc_align function
-    subprocess.run([pc_align_func, '--max-displacement', '5', '--highest-accuracy', ref_dem, clipped_pc, '-o', align_pc]) #run the pc_align function
+    run_command([pc_align_func, '--max-displacement', '5', '--highest-accuracy', ref_dem, clipped_pc, '-o', align_pc]) #run the pc_align function
+
+    return align_pc +  '-transform.txt' #set the transform files name format
+
+def apply_transform(laz_fp, transform_fp, align_path, asp_dir, ref_dem = '', engine = 'native', gridder = 'native', resolution = 0.5):
+    """Apply a transform to the point cloud and grid it.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file.
+        transform_fp (str): Filepath to the transform file from solve_transform().
+        align_path (str): Prefix of the alignment outputs.
+        asp_dir (str): Path to the ASP bin directory.
+        ref_dem (str, optional): Filepath to the reference DEM. Defaults to '' which uses dem.tif next to the point cloud.
+        engine (str, optional): 'native' applies the transform with transform_laz(), 'asp' runs pc_align with zero iterations. Defaults to 'native'.
+        gridder (str, optional): 'native' grids with gridding.grid_laz(), 'asp' runs point2dem. Defaults to 'native'.
+        resolution (float, optional): Resolution of the aligned raster. Defaults to 0.5.
+
+    Returns:
+        str: Filepath to the aligned raster.
+    """
+    in_dir = dirname(abspath(laz_fp))
+    if ref_dem == '':
+        ref_dem = join(in_dir, 'dem.tif')
 
     # Apply transformation matrix to the entire laz and output points
-    initial_tansform = align_pc +  '-transform.txt' #set the transform files name format
     transform_pc = join(in_dir,'pc-transform', basename(align_path))
-    subprocess.run([pc_align_func, '--max-displacement', '-1', '--num-iterations', '0', '--initial-transform', 
-                    initial_tansform, '--save-transformed-source-points', ref_dem, laz_fp,'-o', transform_pc])
-    #print the command that was run
-    print([pc_align_func, '--max-displacement', '-1', '--num-iterations', '0', '--initial-transform', 
-                    initial_tansform, '--save-transformed-source-points', ref_dem, laz_fp,'-o', transform_pc])
+    transformed_laz = transform_pc + '-transform.laz'
+    if engine == 'native':
+        transform_laz(laz_fp, transform_fp, transformed_laz)
+    elif engine == 'asp':
+        pc_align_func = join(asp_dir, 'pc_align')
+        run_command([pc_align_func, '--max-displacement', '-1', '--num-iterations', '0', '--initial-transform', 
+                     transform_fp, '--save-transformed-source-points', ref_dem, laz_fp,'-o', transform_pc])
+        #print the command that was run
+        print([pc_align_func, '--max-displacement', '-1', '--num-iterations', '0', '--initial-transform', 
+                        transform_fp, '--save-transformed-source-points', ref_dem, laz_fp,'-o', transform_pc])
+    else:
+        raise ValueError(f'Unknown engine: {engine}')
 
     # Grid the output to a 0.5 meter tif (NOTE: this needs to be changed to 1m if using py3dep)
-    transform_laz = transform_pc + '-transform.laz'
-    point2dem_func = join(asp_dir, 'point2dem')
-    subprocess.run([point2dem_func, transform_laz,'--dem-spacing', '0.5', '--search-radius-factor', '2', '-o', align_path])
+    return grid_aligned(transformed_laz, align_path, asp_dir, gridder = gridder, resolution = resolution, ref_dem = ref_dem)
 
-    return align_path + '-DEM.tif'
+def grid_aligned(laz_fp, align_path, asp_dir, gridder = 'native', resolution = 0.5, ref_dem = ''):
+    """Grid an aligned point cloud to <align_path>-DEM.tif.
 
-def laz_align(laz_fp, align_file, asp_dir, user_dem = ''):
-    """Clip the point cloud to a shapefile.
+    Args:
+        laz_fp (_type_): Filepath to the aligned point cloud.
+        align_path (str): Prefix of the alignment outputs.
+        asp_dir (str): Path to the directory of point2dem.
+        gridder (str, optional): 'native' grids the idw of the points with gridding.grid_laz() and needs no ASP install, 'asp' runs point2dem. Defaults to 'native'.
+        resolution (float, optional): Resolution of the raster. Defaults to 0.5.
+        ref_dem (str, optional): Filepath to the reference DEM. The native gridder grids on its extent so the DTM and the DSM
+            land on the same grid and share one resampling plan in difference_dems(). Defaults to '' which grids over the point cloud.
+
+    Returns:
+        str: Filepath to the raster.
+    """
+    align_tif = align_path + '-DEM.tif'
+    if gridder == 'native':
+        from snow_pc.gridding import grid_laz
+        grid_laz(laz_fp, align_tif, resolution = resolution, output_type = 'idw', grid = reference_grid(laz_fp, ref_dem, resolution))
+    elif gridder == 'asp':
+        point2dem_func = join(asp_dir, 'point2dem')
+        run_command([point2dem_func, laz_fp,'--dem-spacing', str(resolution), '--search-radius-factor', '2', '-o', align_path])
+    else:
+        raise ValueError(f'Unknown gridder: {gridder}')
+    return align_tif
+
+def reference_grid(laz_fp, ref_dem, resolution):
+    """Grid of the reference DEM to grid an aligned point cloud on.
+
+    Args:
+        laz_fp (_type_): Filepath to the aligned point cloud.
+        ref_dem (str): Filepath to the reference DEM, or ''.
+        resolution (float): Resolution of the grid.
+
+    Returns:
+        dict: The grid from gridding.raster_grid(), or None if there is no reference DEM or it is in another crs than the point cloud.
+    """
+    if ref_dem == '' or not exists(ref_dem):
+        return None
+    import rasterio
+    from pyproj import CRS
+    from snow_pc.gridding import raster_grid
+
+    with laspy.open(laz_fp) as reader:
+        crs = reader.header.parse_crs()
+    with rasterio.open(ref_dem) as src:
+        ref_crs = src.crs
+    if crs is None or ref_crs is None or not CRS.from_user_input(ref_crs.to_wkt()).equals(crs, ignore_axis_order= True):
+        return None
+    return raster_grid(ref_dem, resolution)
+
+def read_transform(transform_fp):
+    """Read a transform file of pc_align.
+
+    Args:
+        transform_fp (str): Filepath to the <prefix>-transform.txt file.
+
+    Raises:
+        ValueError: If the file is not a 4x4 matrix.
+
+    Returns:
+        np.ndarray: The 4x4 rigid transform matrix.
+    """
+    matrix = np.loadtxt(transform_fp)
+    if matrix.shape != (4, 4):
+        raise ValueError(f'{transform_fp} is not a 4x4 transform matrix')
+    return matrix
+
+def transform_points(x, y, z, matrix, crs = None):
+    """Apply a transform of pc_align to points.
+
+    pc_align solves the transform of georeferenced point clouds in Earth-centered Earth-fixed coordinates, so
+    the points are converted to ECEF, transformed and converted back to their crs.
+
+    Args:
+        x (np.ndarray): X coordinates of the points.
+        y (np.ndarray): Y coordinates of the points.
+        z (np.ndarray): Z coordinates of the points, as ellipsoidal heights.
+        matrix (np.ndarray): The 4x4 transform matrix.
+        crs (_type_, optional): The crs of the points. Defaults to None which applies the matrix to the coordinates directly.
+
+    Returns:
+        tuple: The transformed x, y and z coordinates.
+    """
+    if crs is not None:
+        from pyproj import CRS, Transformer
+        to_ecef = Transformer.from_crs(CRS(crs).to_3d(), 'EPSG:4978', always_xy= True)
+        x, y, z = to_ecef.transform(x, y, z)
+    xyz = matrix[:3, :3] @ np.vstack([x, y, z]) + matrix[:3, 3:4]
+    x, y, z = xyz
+    if crs is not None:
+        x, y, z = to_ecef.transform(x, y, z, direction= 'INVERSE')
+    return x, y, z
+
+def transform_laz(laz_fp, transform_fp, out_fp, chunk_size = 1_000_000):
+    """Apply a transform of pc_align to a point cloud chunk by chunk.
+
+    The output keeps the point format, scales and offsets of the input, so the coordinates are only rounded
+    to the scale of the input.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file.
+        transform_fp (str): Filepath to the <prefix>-transform.txt file.
+        out_fp (str): Filepath to save the transformed point cloud.
+        chunk_size (int, optional): Number of points transformed at a time. Defaults to 1_000_000.
+
+    Raises:
+        ValueError: If transformed points do not fit the scales and offsets of the input.
+
+    Returns:
+        str: Filepath to the transformed point cloud.
+    """
+    matrix = read_transform(transform_fp)
+    os.makedirs(dirname(abspath(out_fp)), exist_ok= True)
+    with laspy.open(laz_fp) as reader:
+        header = copy_header(reader.header)
+        crs = reader.header.parse_crs()
+        with laspy.open(out_fp, mode= 'w', header= header) as writer:
+            for points in reader.chunk_iterator(chunk_size):
+                x, y, z = transform_points(np.asarray(points.x), np.asarray(points.y), np.asarray(points.z), matrix, crs)
+                for dim, values, scale, offset in zip(('X', 'Y', 'Z'), (x, y, z), header.scales, header.offsets):
+                    ints = np.round((values - offset) / scale)
+                    if len(ints) > 0 and (ints.min() < np.iinfo(np.int32).min or ints.max() > np.iinfo(np.int32).max):
+                        raise ValueError(f'Transformed {dim} coordinates do not fit the scale and offset of {laz_fp}')
+                    points[dim] = ints.astype(np.int32)
+                writer.write_points(points)
+    return out_fp
+
+def clip_align(laz_fp, buff_shp, align_path, asp_dir, ref_dem = '', gridder = 'native', resolution = 0.5):
+    """Clip the point cloud to a shapefile, solve its transform to the reference DEM and apply it.
 
     Args:
         laz_fp (_type_): _description_
         buff_shp (_type_): _description_
         dem_is_geoid (_type_): _description_
         is_canopy (bool, optional): _description_. Defaults to False.
+        ref_dem (str, optional): Filepath to the reference DEM. Defaults to '' which uses dem.tif next to the point cloud.
 
     Raises:
         Exception: _description_
     """
+    transform_fp = solve_transform(laz_fp, buff_shp, align_path, asp_dir, ref_dem = ref_dem)
+    return apply_transform(laz_fp, transform_fp, align_path, asp_dir, ref_dem = ref_dem, gridder = gridder, resolution = resolution)
+
+def prepare_reference(laz_fp, align_file, user_dem = ''):
+    """Prepare the reference DEM and the alignment target shared by the products of a point cloud.
+
+    Args:
+        laz_fp (_type_): Filepath to one of the point cloud products, e.g. the DTM.
+        align_file (str): Shapefile of the roads or csv of the calibration points.
+        user_dem (str, optional): Filepath to the DEM file. Defaults to '' which downloads the DEM.
+
+    Raises:
+        Exception: If the align file is not a shapefile or a csv.
+
+    Returns:
+        tuple: Filepath to the reference DEM and to the buffered road shapefile or the calibration points csv.
+    """
     #set the working directory
-    in_dir = dirname(laz_fp)
+    in_dir = dirname(abspath(laz_fp))
 
     # set the dem file path
     dem_fp = join(in_dir, 'dem.tif')
@@ -108,11 +294,13 @@ def laz_align(laz_fp, align_file, asp_dir, user_dem = ''):
     #download dem using download_dem() if user_dem is not provided
     if user_dem == '':
         dem_fp, crs, project = download_dem(laz_fp, dem_fp= dem_fp)
-    else:
+    elif abspath(user_dem) != abspath(dem_fp):
         shutil.copy(user_dem, dem_fp) #if user_dem is provided, copy the user_dem to dem_fp
 
     #if align file is a shapefile
     if align_file.endswith('.shp'):
+        import geopandas as gpd
+
         buffer_width = 3
         #create a buffer around the shapefile to clip the point cloud
         gdf = gpd.read_file(align_file)
@@ -120,18 +308,15 @@ def laz_align(laz_fp, align_file, asp_dir, user_dem = ''):
         gdf['CLS'] = 22 # Create a new attribute to be used for PDAL clip/overlay
         buff_shp = join(in_dir, 'buffered_area.shp')
         gdf.to_file(buff_shp)
-
-        #remove .tif of the laz_fp path and add -align to the end
-        align_path = laz_fp.replace('.laz', '-align')
-
-        #set asp_dir
-        if basename(asp_dir) != 'bin':
-            asp_dir = join(asp_dir, 'bin')
-
-        align_tif = clip_align(laz_fp, buff_shp=buff_shp, align_path= align_path,  asp_dir = asp_dir)
+        return dem_fp, buff_shp
 
     #elif the file ends with with csv or excel
     elif align_file.endswith('.csv'):
+        import pandas as pd
+        import geopandas as gpd
+        import rioxarray as rxr
+        from rasterstats import point_query
+
         dem = rxr.open_rasterio(dem_fp)
         #read the csv file
         cal_data = pd.read_csv(align_file)
@@ -156,23 +341,106 @@ def laz_align(laz_fp, align_file, asp_dir, user_dem = ''):
         #drop na
         gdf = gdf.dropna()
         #save to csv
-        gdf.to_csv(join(in_dir, 'cal_data.csv'), index = False)
-        #remove .tif of the laz_fp path and add -align to the end
-        align_path = laz_fp.replace('.laz', '-align')
+        cal_csv = join(in_dir, 'cal_data.csv')
+        gdf.to_csv(cal_csv, index = False)
+        return dem_fp, cal_csv
+    else:
+        raise Exception('File type not supported')
+
+@instrumented
+def laz_align(laz_fp, align_file, asp_dir, user_dem = '', reference = None, transform = '', gridder = 'native', resolution = 0.5):
+    """Clip the point cloud to a shapefile.
+
+    Args:
+        laz_fp (_type_): _description_
+        buff_shp (_type_): _description_
+        dem_is_geoid (_type_): _description_
+        is_canopy (bool, optional): _description_. Defaults to False.
+        reference (tuple, optional): Reference DEM and alignment target from prepare_reference(). Defaults to None which prepares them.
+        transform (str, optional): Filepath to a transform from solve_transform() to apply instead of solving one for this point cloud. Only for shapefiles. Defaults to ''.
+        gridder (str, optional): 'native' or 'asp', see grid_aligned(). Defaults to 'native'.
+        resolution (float, optional): Resolution of the aligned raster. Defaults to 0.5.
+
+    Raises:
+        Exception: _description_
+    """
+    #set the working directory
+    in_dir = dirname(abspath(laz_fp))
+
+    #prepare the reference DEM and the buffered roads or calibration points
+    if reference is None:
+        reference = prepare_reference(laz_fp, align_file, user_dem = user_dem)
+    dem_fp, align_target = reference
+
+    #remove .tif of the laz_fp path and add -align to the end
+    align_path = join(in_dir, basename(laz_fp).replace('.laz', '-align'))
+
+    #if align file is a shapefile
+    if align_file.endswith('.shp'):
+        #set asp_dir
+        if basename(asp_dir) != 'bin':
+            asp_dir = join(asp_dir, 'bin')
+
+        if transform != '':
+            align_tif = apply_transform(laz_fp, transform, align_path, asp_dir, ref_dem = dem_fp, gridder = gridder, resolution = resolution)
+        else:
+            align_tif = clip_align(laz_fp, buff_shp=align_target, align_path= align_path,  asp_dir = asp_dir, ref_dem = dem_fp, gridder = gridder, resolution = resolution)
+
+    #elif the file ends with with csv or excel
+    elif align_file.endswith('.csv'):
+        if transform != '':
+            raise ValueError('A shared transform is only supported for shapefiles')
         #set asp_dir
         if basename(asp_dir) != 'libexec':
             asp_dir = join(asp_dir, 'libexec')
-        subprocess.run([join(asp_dir, 'pc_align'), '--max-displacement', '300', '--highest-accuracy', '--datum', 'WGS_1984', '--save-inv-transformed-reference-points', '--save-transformed-source-points', '--csv-format', '1:easting 2: northing 3: height_above_datum', '--csv-proj4', 'EPSG:32611', '--compute-translation-only', laz_fp, join(in_dir, 'cal_data.csv'), '-o', join(in_dir, 'pc_align', basename(align_path))])
-        subprocess.run([join(asp_dir, 'point2dem'), join(in_dir, 'pc_align', basename(align_path)) + '-trans_reference.laz', '--dem-spacing', '0.5', '--search-radius-factor', '2', '-o', align_path])
-        align_tif = align_path + '-DEM.tif'
+        run_command([join(asp_dir, 'pc_align'), '--max-displacement', '300', '--highest-accuracy', '--datum', 'WGS_1984', '--save-inv-transformed-reference-points', '--save-transformed-source-points', '--csv-format', '1:easting 2: northing 3: height_above_datum', '--csv-proj4', 'EPSG:32611', '--compute-translation-only', laz_fp, align_target, '-o', join(in_dir, 'pc_align', basename(align_path))])
+        align_tif = grid_aligned(join(in_dir, 'pc_align', basename(align_path)) + '-trans_reference.laz', align_path, asp_dir, gridder = gridder, resolution = resolution, ref_dem = dem_fp)
     else:
         raise Exception('File type not supported')
 
     return align_tif
 
+def shared_transform(laz_fp, reference, asp_dir):
+    """Solve one transform on the roads to apply to every product of a point cloud.
 
+    Args:
+        laz_fp (_type_): Filepath to the point cloud to solve the transform from, e.g. the DTM or the unfiltered point cloud.
+        reference (tuple): Reference DEM and buffered road shapefile from prepare_reference().
+        asp_dir (str): Path to the ASP install.
 
+    Returns:
+        str: Filepath to the transform file.
+    """
+    dem_fp, buff_shp = reference
+    if not buff_shp.endswith('.shp'):
+        raise ValueError('A shared transform is only supported for shapefiles')
+    if basename(asp_dir) != 'bin':
+        asp_dir = join(asp_dir, 'bin')
+    align_path = join(dirname(abspath(laz_fp)), 'shared-align')
+    return solve_transform(laz_fp, buff_shp, align_path, asp_dir, ref_dem = dem_fp)
 
+def align_models(laz_fps, align_file, asp_dir, user_dem = '', n_workers = None, transform_from = ''):
+    """Align several products of the same point cloud at the same time.
 
+    The reference DEM and the buffered roads or calibration points are prepared once and shared.
 
-    
\ No newline at end of file
+    Args:
+        laz_fps (list): Filepaths to the point cloud products, e.g. the DTM and the DSM.
+        align_file (str): Shapefile of the roads or csv of the calibration points.
+        asp_dir (str): Path to the ASP install.
+        user_dem (str, optional): Filepath to the DEM file. Defaults to ''.
+        n_workers (int, optional): Number of products aligned at the same time. Defaults to None which aligns them all at once.
+        transform_from (str, optional): Filepath to a point cloud, e.g. the DTM or the unfiltered point cloud, to solve one transform
+            from and apply to every product. Defaults to '' which solves a transform for each product.
+
+    Returns:
+        list: Filepaths to the aligned rasters in the order of laz_fps.
+    """
+    reference = prepare_reference(laz_fps[0], align_file, user_dem = user_dem)
+    transform = ''
+    if transform_from != '':
+        transform = shared_transform(transform_from, reference, asp_dir)
+    # the ASP tools run as subprocesses so threads are enough to keep them running side by side
+    with ThreadPoolExecutor(max_workers= n_workers or len(laz_fps)) as executor:
+        futures = [executor.submit(in_run(laz_align), laz_fp, align_file, asp_dir, reference = reference, transform = transform) for laz_fp in laz_fps]
+        return [future.result() for future in futures]
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from snow_pc.snow_pc import pc2snow
+
+
+def read_sites(sites):
+    """Read the sites of a batch.
+
+    Args:
+        sites (_type_): A list of sites, or the filepath to a json list of sites or to a text file with one site directory per line.
+            A site is the directory of its point cloud files, or a dict with the directory as 'in_dir' and arguments of the
+            run for that site, e.g. its own 'align_file' or 'user_dem'.
+
+    Returns:
+        list: The sites as dicts.
+    """
+    if isinstance(sites, str):
+        with open(sites) as f:
+            if sites.endswith('.json'):
+                sites = json.load(f)
+            else:
+                sites = [line.strip() for line in f if line.strip() != '' and not line.startswith('#')]
+    return [{'in_dir': site} if isinstance(site, str) else dict(site) for site in sites]
+
+def run_site(func, site, kwargs):
+    """Run one site and catch its failure.
+
+    Args:
+        func (function): The run, e.g. pc2snow.
+        site (dict): The site from read_sites().
+        kwargs (dict): Arguments of the run shared by all sites.
+
+    Returns:
+        dict: The site directory, 'ok' or 'failed', the time taken in seconds, and the outputs or the error.
+    """
+    args = {**kwargs, **site}
+    in_dir = os.path.abspath(args.pop('in_dir'))
+    start = time.perf_counter()
+    try:
+        outputs = func(in_dir, **args)
+        status, error = 'ok', None
+    except Exception:
+        outputs, status, error = None, 'failed', traceback.format_exc()
+    return {'in_dir': in_dir, 'status': status, 'seconds': round(time.perf_counter() - start, 3), 'outputs': outputs, 'error': error}
+
+def run_batch(sites, func = pc2snow, n_workers = None, report_fp = '', **kwargs):
+    """Run many sites in parallel, one process per site at a time.
+
+    A failed site is reported and the other sites keep running.
+
+    Args:
+        sites (_type_): List of sites or filepath to a manifest of sites, see read_sites().
+        func (function, optional): The run of each site. Must be importable by the worker processes. Defaults to pc2snow.
+        n_workers (int, optional): Number of sites processed at the same time. Defaults to None which uses all cores.
+        report_fp (str, optional): Filepath to save the json report. Defaults to '' for no report.
+        **kwargs: Arguments of the run shared by all sites, e.g. align_file and asp_dir for pc2snow.
+
+    Returns:
+        list: The result of each site from run_site(), in the order of the sites.
+    """
+    sites = read_sites(sites)
+    results = [None] * len(sites)
+    with ProcessPoolExecutor(max_workers= n_workers) as executor:
+        futures = {executor.submit(run_site, func, site, kwargs): i for i, site in enumerate(sites)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception:
+                # the worker process itself died, e.g. it ran out of memory
+                results[i] = {'in_dir': os.path.abspath(sites[i]['in_dir']), 'status': 'failed', 'seconds': None,
+                              'outputs': None, 'error': traceback.format_exc()}
+            result = results[i]
+            print(f"{result['status']:>6} {result['in_dir']} ({result['seconds']} s)")
+
+    failed = sum(result['status'] == 'failed' for result in results)
+    print(f'Batch: {len(results) - failed} sites ok, {failed} failed')
+    if report_fp != '':
+        with open(report_fp, 'w') as f:
+            json.dump(results, f, indent= 2)
+    return results
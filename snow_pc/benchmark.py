@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import shutil
+import platform
+import numpy as np
+
+# origin of the synthetic sites in UTM zone 11N
+ORIGIN = (500000.0, 4800000.0)
+CRS = 'EPSG:32611'
+
+
+def terrain(x, y):
+    """Snow off elevation of the synthetic sites: a slope with rolling hills.
+
+    Args:
+        x (np.ndarray): Easting.
+        y (np.ndarray): Northing.
+
+    Returns:
+        np.ndarray: The elevation.
+    """
+    dx, dy = np.asarray(x) - ORIGIN[0], np.asarray(y) - ORIGIN[1]
+    return 1500 + 0.05 * dx + 0.02 * dy + 2 * np.sin(dx / 25) * np.cos(dy / 40)
+
+def synthetic_site(out_dir, size = 200.0, density = 10.0, seed = 0, canopy_fraction = 0.3, noise_fraction = 0.002,
+                   snow_depth = 1.0, road_width = 6.0, n_probes = 50, resolution = 1.0):
+    """Write a synthetic snow on lidar site with its snow off reference DEM, roads and probes.
+
+    The snow surface lies snow_depth above terrain() except on a plowed road strip across the middle of the site.
+    Trees return a first return from the crown and a last return from the snow, and a fraction of the points
+    are low and high noise outliers.
+
+    Args:
+        out_dir (str): Directory to write the site to.
+        size (float, optional): Width of the square site in m. Defaults to 200.0.
+        density (float, optional): Points per square m. Defaults to 10.0.
+        seed (int, optional): Seed of the random generator, the same seed writes the same site. Defaults to 0.
+        canopy_fraction (float, optional): Fraction of the site covered by tree crowns. Defaults to 0.3.
+        noise_fraction (float, optional): Fraction of the points that are outliers. Defaults to 0.002.
+        snow_depth (float, optional): Snow depth off the road in m. Defaults to 1.0.
+        road_width (float, optional): Width of the road in m. Defaults to 6.0.
+        n_probes (int, optional): Number of snow depth probes. Defaults to 50.
+        resolution (float, optional): Resolution of the reference DEM. Defaults to 1.0.
+
+    Returns:
+        dict: Filepaths to the point cloud 'laz', the reference DEM 'dem', the road shapefile 'roads' and the probe csv 'probes'.
+    """
+    import laspy
+    import pyproj
+
+    os.makedirs(out_dir, exist_ok= True)
+    rng = np.random.default_rng(seed)
+    x0, y0 = ORIGIN
+    road_y = y0 + size / 2
+
+    # snow surface, with tree crowns over a fraction of the site off the road
+    n = int(size * size * density)
+    x = x0 + rng.uniform(0, size, n)
+    y = y0 + rng.uniform(0, size, n)
+    on_road = np.abs(y - road_y) < road_width / 2
+    z = terrain(x, y) + np.where(on_road, 0, snow_depth)
+    n_trees = int(canopy_fraction * size * size / (np.pi * 4**2))
+    trees = np.column_stack([x0 + rng.uniform(0, size, n_trees), y0 + rng.uniform(0, size, n_trees), rng.uniform(5, 25, n_trees)])
+    crown = np.zeros(n, dtype= bool)
+    height = np.zeros(n)
+    for tx, ty, th in trees:
+        d = np.hypot(x - tx, y - ty)
+        inside = (d < 4) & ~on_road
+        # conical crowns
+        height[inside] = np.maximum(height[inside], th * (1 - d[inside] / 4))
+        crown |= inside
+    crown &= height > 2
+
+    # a crown point is a first return from the crown and a last return from the snow below it
+    return_number = np.ones(n, dtype= np.uint8)
+    number_of_returns = np.ones(n, dtype= np.uint8)
+    number_of_returns[crown] = 2
+    last = np.flatnonzero(crown)
+    x = np.concatenate([x, x[last]])
+    y = np.concatenate([y, y[last]])
+    z = np.concatenate([z + np.where(crown, height, 0), z[last]])
+    return_number = np.concatenate([return_number, np.full(len(last), 2, dtype= np.uint8)])
+    number_of_returns = np.concatenate([number_of_returns, np.full(len(last), 2, dtype= np.uint8)])
+    z += rng.normal(0, 0.03, len(z))
+
+    # low and high outliers, and a few invalid returns
+    noise = rng.choice(len(z), int(noise_fraction * len(z)), replace= False)
+    z[noise] += np.where(rng.random(len(noise)) < 0.5, -rng.uniform(5, 50, len(noise)), rng.uniform(60, 200, len(noise)))
+    invalid = rng.choice(len(z), max(1, len(z) // 1000), replace= False)
+    return_number[invalid] = number_of_returns[invalid] + 1
+
+    header = laspy.LasHeader(point_format= 1, version= '1.4')
+    header.scales = [0.01, 0.01, 0.01]
+    header.offsets = [x0, y0, 0]
+    header.add_crs(pyproj.CRS(CRS))
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = x, y, z
+    las.return_number = return_number
+    las.number_of_returns = number_of_returns
+    laz_fp = os.path.join(out_dir, 'site.laz')
+    las.write(laz_fp)
+
+    return {'laz': laz_fp, 'dem': synthetic_dem(os.path.join(out_dir, 'reference_dem.tif'), size, resolution),
+            'roads': synthetic_roads(os.path.join(out_dir, 'roads.shp'), size),
+            'probes': synthetic_probes(os.path.join(out_dir, 'probes.csv'), size, snow_depth, road_width, n_probes, seed)}
+
+def synthetic_dem(out_fp, size = 200.0, resolution = 1.0, margin = 20.0):
+    """Write the snow off reference DEM of a synthetic site, a stand-in for the py3dep download.
+
+    Args:
+        out_fp (str): Filepath to save the DEM.
+        size (float, optional): Width of the site. Defaults to 200.0.
+        resolution (float, optional): Resolution of the DEM. Defaults to 1.0.
+        margin (float, optional): Margin around the site. Defaults to 20.0.
+
+    Returns:
+        str: Filepath to the DEM.
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    width = int(np.ceil((size + 2 * margin) / resolution))
+    transform = from_origin(ORIGIN[0] - margin, ORIGIN[1] + size + margin, resolution, resolution)
+    cols, rows = np.meshgrid(np.arange(width) + 0.5, np.arange(width) + 0.5)
+    x, y = transform * (cols, rows)
+    with rasterio.open(out_fp, 'w', driver= 'GTiff', width= width, height= width, count= 1, dtype= 'float32', nodata= -9999,
+                       crs= CRS, transform= transform) as dst:
+        dst.write(terrain(x, y).astype(np.float32), 1)
+    return out_fp
+
+def synthetic_roads(out_fp, size = 200.0):
+    """Write the center line of the road of a synthetic site as a shapefile.
+
+    Args:
+        out_fp (str): Filepath to save the shapefile.
+        size (float, optional): Width of the site. Defaults to 200.0.
+
+    Returns:
+        str: Filepath to the shapefile.
+    """
+    import geopandas as gpd
+    from shapely.geometry import LineString
+
+    road_y = ORIGIN[1] + size / 2
+    gpd.GeoDataFrame(geometry= [LineString([(ORIGIN[0], road_y), (ORIGIN[0] + size, road_y)])], crs= CRS).to_file(out_fp)
+    return out_fp
+
+def synthetic_probes(out_fp, size = 200.0, snow_depth = 1.0, road_width = 6.0, n_probes = 50, seed = 0):
+    """Write snow depth probes of a synthetic site in cm with UTM coordinates in columns 'x' and 'y'.
+
+    Args:
+        out_fp (str): Filepath to save the csv.
+        size (float, optional): Width of the site. Defaults to 200.0.
+        snow_depth (float, optional): Snow depth in m. Defaults to 1.0.
+        road_width (float, optional): Width of the road, where there are no probes. Defaults to 6.0.
+        n_probes (int, optional): Number of probes. Defaults to 50.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        str: Filepath to the csv.
+    """
+    rng = np.random.default_rng(seed + 1)
+    x = ORIGIN[0] + rng.uniform(5, size - 5, n_probes)
+    # probes on either side of the road
+    offset = rng.uniform(road_width, size / 2 - 5, n_probes) * rng.choice([-1, 1], n_probes)
+    y = ORIGIN[1] + size / 2 + offset
+    depth = snow_depth * 100 + rng.normal(0, 5, n_probes)
+    with open(out_fp, 'w') as f:
+        f.write('depth_cm,x,y\n')
+        for row in zip(depth, x, y):
+            f.write('{:.1f},{:.2f},{:.2f}\n'.format(*row))
+    return out_fp
+
+
+def pdal_available():
+    """Check if PDAL pipelines can run, in-process or with the pdal executable."""
+    from snow_pc.pipeline import has_python_pdal
+
+    return has_python_pdal() or shutil.which('pdal') is not None
+
+def _terrain_models(site, engine):
+    """Filter the site for a terrain model and grid it.
+
+    The numpy engine is a stand-in that needs no PDAL: the numpy engines of the dem, return, elm and outlier filters
+    and the native gridder. It has no ground segmentation, there is no numpy filters.smrf.
+    """
+    from snow_pc.filtering import dem_filtering, return_filtering, elm_filtering, outlier_filtering
+    from snow_pc.gridding import grid_laz
+    from snow_pc.modeling import terrain_models
+
+    if engine == 'pdal':
+        return terrain_models(site['laz'], user_dem= site['dem'])
+    laz_fp = dem_filtering(site['laz'], user_dem= site['dem'], out_fp= 'dtm_dem_filtered.laz', engine= engine)
+    laz_fp = return_filtering(laz_fp, out_fp= 'dtm_returns_filtered.laz', engine= engine)
+    laz_fp = elm_filtering(laz_fp, out_fp= 'dtm_elm_filtered.laz', engine= engine)
+    laz_fp = outlier_filtering(laz_fp, out_fp= 'dtm_outlier_filtered.laz', engine= engine)
+    return grid_laz(laz_fp, os.path.join(os.path.dirname(site['laz']), 'dtm.tif'), resolution= 1.0, output_type= 'min')
+
+def _models(site):
+    """Grid the aligned DTM and DSM of the site on the reference DEM like align.grid_aligned(), stand-ins for the aligned models of pc2snow."""
+    from snow_pc.gridding import grid_laz, raster_grid
+
+    work_dir = os.path.dirname(site['laz'])
+    grid = raster_grid(site['dem'])
+    return (grid_laz(site['laz'], os.path.join(work_dir, 'site_dtm-align-DEM.tif'), output_type= 'min', grid= grid),
+            grid_laz(site['laz'], os.path.join(work_dir, 'site_dsm-align-DEM.tif'), output_type= 'max', grid= grid))
+
+def _difference(site, engine):
+    """Difference the DTM and DSM from _models() with the reference DEM like pc2snow."""
+    from snow_pc.snow_pc import difference_dems
+
+    work_dir = os.path.dirname(site['laz'])
+    dtm_fp, dsm_fp = [os.path.join(work_dir, f'site_{name}-align-DEM.tif') for name in ('dtm', 'dsm')]
+    return difference_dems(dtm_fp, dsm_fp, site['dem'], os.path.join(work_dir, 'site-snowdepth.tif'),
+                           os.path.join(work_dir, 'site-canopyheight.tif'))
+
+def _validation(site, engine):
+    """Validate the snow depth of the difference case against the probes."""
+    from snow_pc.validation import snowdepth_metrics
+
+    snow_depth_fp = os.path.join(os.path.dirname(site['laz']), 'site-snowdepth.tif')
+    return snowdepth_metrics(snow_depth_fp, site['probes'], 'depth_cm', 'y', 'x', road_shp= site['roads'], csv_EPSG= 32611)
+
+def _snow_depth(site):
+    """Write the snow depth the validation case reads."""
+    _models(site)
+    return _difference(site, 'numpy')
+
+def _cases():
+    """The benchmarked stages by name, with the engines each runs with, a function of the site and the engine, and
+    an untimed setup function of the site or None."""
+    from snow_pc.filtering import return_filtering, elm_filtering, outlier_filtering, ground_segmentation
+    from snow_pc.gridding import grid_laz
+
+    return {
+        'return_filtering': (('pdal', 'numpy'), lambda site, engine: return_filtering(site['laz'], engine= engine), None),
+        'elm_filtering': (('pdal', 'numpy'), lambda site, engine: elm_filtering(site['laz'], engine= engine), None),
+        'outlier_filtering': (('pdal', 'numpy'), lambda site, engine: outlier_filtering(site['laz'], engine= engine), None),
+        # there is no numpy filters.smrf to stand in for
+        'ground_segmentation': (('pdal',), lambda site, engine: ground_segmentation(site['laz']), None),
+        'terrain_models': (('pdal', 'numpy'), _terrain_models, None),
+        'gridding': (('numpy',), lambda site, engine: grid_laz(site['laz'], os.path.join(os.path.dirname(site['laz']), 'site-DEM.tif'),
+                                                                 resolution= 1.0, output_type= 'min'), None),
+        'difference': (('numpy',), _difference, _models),
+        'validation': (('numpy',), _validation, _snow_depth),
+    }
+
+CASES = ('return_filtering', 'elm_filtering', 'outlier_filtering', 'ground_segmentation', 'terrain_models', 'gridding', 'difference', 'validation')
+
+
+def environment():
+    """Versions of python, the libraries and the tools the benchmark ran with."""
+    from snow_pc import __version__
+    from snow_pc.stages import tool_version
+
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(), 'snow_pc': __version__,
+            **{tool: tool_version(tool) for tool in ('numpy', 'laspy', 'rasterio', 'pdal')}}
+
+def run_benchmarks(out_dir, sizes = (100.0, 200.0), density = 10.0, repeats = 3, cases = None, engines = None, results_fp = '', seed = 0):
+    """Time the stages on synthetic sites of increasing size.
+
+    Everything runs offline: the sites bring their own reference DEM, the native gridder stands in for point2dem,
+    the numpy engine of terrain_models stands in for its PDAL pipeline without the ground segmentation, and the
+    stages that need PDAL, e.g. ground_segmentation, are recorded as skipped when it is not installed. The setup of
+    a stage, e.g. the DTM and DSM the difference case differences, is not timed.
+
+    Args:
+        out_dir (str): Directory for the synthetic sites and the outputs of the stages.
+        sizes (tuple, optional): Widths of the sites in m. Defaults to (100.0, 200.0).
+        density (float, optional): Points per square m. Defaults to 10.0.
+        repeats (int, optional): Number of timed runs of each stage. Defaults to 3.
+        cases (list, optional): Names of the stages to run, see CASES. Defaults to None for all.
+        engines (list, optional): Engines to run, e.g. ['numpy']. Defaults to None for all.
+        results_fp (str, optional): Filepath to save the json results. Defaults to '' which saves benchmark.json in out_dir.
+        seed (int, optional): Seed of the synthetic sites. Defaults to 0.
+
+    Returns:
+        dict: The 'environment' and the 'results' of each stage, engine and size.
+    """
+    from snow_pc.report import point_count
+
+    all_cases = _cases()
+    cases = CASES if cases is None else cases
+    has_pdal = pdal_available()
+    results = []
+    for size in sizes:
+        site = synthetic_site(os.path.join(out_dir, f'site_{int(size)}'), size= size, density= density, seed= seed)
+        n_points = point_count(site['laz'])
+        for name in cases:
+            case_engines, func, setup = all_cases[name]
+            if setup is not None and any(engines is None or engine in engines for engine in case_engines):
+                setup(site)
+            for engine in case_engines:
+                if engines is not None and engine not in engines:
+                    continue
+                result = {'case': name, 'engine': engine, 'size': size, 'density': density, 'points': n_points}
+                if engine == 'pdal' and not has_pdal:
+                    results.append({**result, 'status': 'skipped', 'reason': 'pdal is not installed'})
+                    continue
+                seconds = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    func(site, engine)
+                    seconds.append(time.perf_counter() - start)
+                median = float(np.median(seconds))
+                results.append({**result, 'status': 'ok', 'seconds': [round(s, 4) for s in seconds], 'min': round(min(seconds), 4),
+                                'median': round(median, 4), 'points_per_second': round(n_points / median) if median > 0 else None})
+                print(f"{name:>20} {engine:>6} {size:>7.0f} m: {median:.3f} s")
+
+    benchmark = {'environment': environment(), 'results': results}
+    if results_fp == '':
+        results_fp = os.path.join(out_dir, 'benchmark.json')
+    with open(results_fp, 'w') as f:
+        json.dump(benchmark, f, indent= 2)
+    return benchmark
+
+def compare_benchmarks(baseline, current, tolerance = 0.25):
+    """Find the stages that got slower than a baseline run.
+
+    Args:
+        baseline (_type_): Results of run_benchmarks() or the filepath to their json.
+        current (_type_): Results of run_benchmarks() or the filepath to their json.
+        tolerance (float, optional): Allowed relative increase of the median time. Defaults to 0.25.
+
+    Returns:
+        list: The case, engine, size, baseline and current median and their ratio of each regression.
+    """
+    def load(benchmark):
+        if isinstance(benchmark, str):
+            with open(benchmark) as f:
+                benchmark = json.load(f)
+        return {(r['case'], r['engine'], r['size'], r['density']): r for r in benchmark['results'] if r['status'] == 'ok'}
+
+    baseline, current = load(baseline), load(current)
+    regressions = []
+    for key in sorted(set(baseline) & set(current), key= str):
+        before, after = baseline[key]['median'], current[key]['median']
+        if before > 0 and after > before * (1 + tolerance):
+            regressions.append({'case': key[0], 'engine': key[1], 'size': key[2], 'baseline': before, 'current': after,
+                                'ratio': round(after / before, 3)})
+            print(f'Slower: {key[0]} ({key[1]}, {key[2]:.0f} m) {before:.3f} s -> {after:.3f} s')
+    return regressions
@@ -0,0 +1,160 @@
+import os
+import laspy
+import numpy as np
+from snow_pc.common import pc_files, iter_chunks, copy_header, rescale_points
+
+
+def valid_returns(points):
+    """Mask of the points with valid returns, like the filters.mongo stage of return_filtering.
+
+    Args:
+        points (laspy.ScaleAwarePointRecord): The points.
+
+    Returns:
+        np.ndarray: True for the points with ReturnNumber > 0 and NumberOfReturns > 0.
+    """
+    return (np.asarray(points.return_number) > 0) & (np.asarray(points.number_of_returns) > 0)
+
+def sample_raster(src, x, y, interpolation = 'nearest'):
+    """Sample the first band of a raster at points, reading only the window that covers them.
+
+    Args:
+        src (rasterio.DatasetReader): The open raster.
+        x (np.ndarray): X coordinates of the points in the crs of the raster.
+        y (np.ndarray): Y coordinates of the points in the crs of the raster.
+        interpolation (str, optional): 'nearest' uses the value of the pixel the point falls in, like filters.dem.
+            'bilinear' interpolates between the four nearest pixel centers. Defaults to 'nearest'.
+
+    Returns:
+        np.ndarray: The values, NaN outside the raster and on nodata pixels.
+    """
+    from rasterio.windows import Window
+
+    values = np.full(len(x), np.nan)
+    if len(x) == 0:
+        return values
+
+    # fractional pixel coordinates of the points
+    inv = ~src.transform
+    cols = inv.a * x + inv.b * y + inv.c
+    rows = inv.d * x + inv.e * y + inv.f
+
+    # read the window around the points with one pixel of padding for the interpolation
+    col0 = max(int(np.floor(np.nanmin(cols))) - 1, 0)
+    row0 = max(int(np.floor(np.nanmin(rows))) - 1, 0)
+    col1 = min(int(np.floor(np.nanmax(cols))) + 2, src.width)
+    row1 = min(int(np.floor(np.nanmax(rows))) + 2, src.height)
+    if col1 <= col0 or row1 <= row0:
+        return values
+    data = src.read(1, window= Window(col0, row0, col1 - col0, row1 - row0)).astype(np.float64)
+    if src.nodata is not None:
+        data[data == src.nodata] = np.nan
+    height, width = data.shape
+    cols = cols - col0
+    rows = rows - row0
+
+    if interpolation == 'nearest':
+        c = np.floor(cols).astype(np.int64)
+        r = np.floor(rows).astype(np.int64)
+        inside = (c >= 0) & (c < width) & (r >= 0) & (r < height)
+        values[inside] = data[r[inside], c[inside]]
+    elif interpolation == 'bilinear':
+        # position relative to the pixel centers
+        cols = cols - 0.5
+        rows = rows - 0.5
+        c = np.floor(cols).astype(np.int64)
+        r = np.floor(rows).astype(np.int64)
+        # points in the outer half pixel use the edge pixel
+        inside = (cols >= -0.5) & (cols < width - 0.5) & (rows >= -0.5) & (rows < height - 0.5)
+        c0 = np.clip(c, 0, width - 1)[inside]
+        r0 = np.clip(r, 0, height - 1)[inside]
+        c1 = np.clip(c + 1, 0, width - 1)[inside]
+        r1 = np.clip(r + 1, 0, height - 1)[inside]
+        dc = np.clip(cols[inside] - c[inside], 0, 1)
+        dr = np.clip(rows[inside] - r[inside], 0, 1)
+        top = data[r0, c0] * (1 - dc) + data[r0, c1] * dc
+        bottom = data[r1, c0] * (1 - dc) + data[r1, c1] * dc
+        values[inside] = top * (1 - dr) + bottom * dr
+    else:
+        raise ValueError(f'Unknown interpolation: {interpolation}')
+    return values
+
+def within_dem(points, src, dem_low = 20, dem_high = 50, interpolation = 'nearest'):
+    """Mask of the points within the limits of a DEM, like the filters.dem stage of dem_filtering.
+
+    Args:
+        points (laspy.ScaleAwarePointRecord): The points.
+        src (rasterio.DatasetReader): The open DEM.
+        dem_low (int, optional): Lower limit of the DEM. Defaults to 20.
+        dem_high (int, optional): Upper limit of the DEM. Defaults to 50.
+        interpolation (str, optional): 'nearest' or 'bilinear', see sample_raster(). Defaults to 'nearest'.
+
+    Returns:
+        np.ndarray: True for the points with DEM - dem_low <= Z <= DEM + dem_high.
+    """
+    z = np.asarray(points.z)
+    dem = sample_raster(src, np.asarray(points.x), np.asarray(points.y), interpolation)
+    # comparisons with NaN are False so points off the DEM are dropped
+    return (dem - dem_low <= z) & (z <= dem + dem_high)
+
+def filter_chunked(laz_fp, out_fp, predicates, chunk_size = 1_000_000):
+    """Filter a point cloud chunk by chunk and append the kept points to the output file.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        out_fp (str): Filepath to save the output las file.
+        predicates (list): Functions that take a chunk of points and return a boolean mask of the points to keep.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        tuple: Filepath to the output las file and the number of points written.
+    """
+    laz_fps = pc_files(laz_fp)
+    with laspy.open(laz_fps[0]) as reader:
+        header = copy_header(reader.header)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_fp)), exist_ok= True)
+    count = 0
+    with laspy.open(out_fp, mode= 'w', header= header) as writer:
+        for points, _ in iter_chunks(laz_fps, chunk_size):
+            keep = np.ones(len(points), dtype= bool)
+            for predicate in predicates:
+                keep &= predicate(points)
+            if keep.any():
+                writer.write_points(rescale_points(points[keep], header))
+                count += int(keep.sum())
+    return out_fp, count
+
+def return_filter_chunked(laz_fp, out_fp, chunk_size = 1_000_000):
+    """Filter out points with invalid returns without PDAL.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        out_fp (str): Filepath to save the output las file.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        str: Filepath to the filtered point cloud file.
+    """
+    return filter_chunked(laz_fp, out_fp, [valid_returns], chunk_size)[0]
+
+def dem_filter_chunked(laz_fp, dem_fp, out_fp, dem_low = 20, dem_high = 50, interpolation = 'nearest', chunk_size = 1_000_000):
+    """Filter the point cloud to the DEM without PDAL.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        dem_fp (str): Filepath to the DEM in the crs of the point cloud.
+        out_fp (str): Filepath to save the output las file.
+        dem_low (int, optional): Lower limit of the DEM. Defaults to 20.
+        dem_high (int, optional): Upper limit of the DEM. Defaults to 50.
+        interpolation (str, optional): 'nearest' matches filters.dem, 'bilinear' interpolates the DEM. Defaults to 'nearest'.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        str: Filepath to the filtered point cloud file.
+    """
+    import rasterio
+
+    with rasterio.open(dem_fp) as src:
+        predicate = lambda points: within_dem(points, src, dem_low, dem_high, interpolation)
+        return filter_chunked(laz_fp, out_fp, [predicate], chunk_size)[0]
@@ -1,58 +1,188 @@
 import os
 from glob import glob
-import pyproj
 import laspy
-import py3dep
-from shapely.geometry import box
-from shapely.ops import transform
-from rasterio.enums import Resampling
-import rioxarray as rxr
-from rasterstats import point_query, zonal_stats
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.metrics import mean_squared_error
-from rasterio.crs import CRS
 import json
-import subprocess
+from snow_pc.dem_cache import TiledDEMCache, py3dep_provider
+from snow_pc.pipeline import run_pipeline
 
 
-def download_dem(laz_fp, dem_fp, cache_fp ='./cache/aiohttp_cache.sqlite'):
+def is_manifest(pc_fp):
+    """Check if a point cloud path is a manifest of point cloud files written by prepare_pc.
+
+    Args:
+        pc_fp (str): Path to a point cloud file or a manifest.
+
+    Returns:
+        bool: True if the path is a manifest.
+    """
+    return pc_fp.lower().endswith('.json')
+
+def read_manifest(pc_fp):
+    """Read the manifest of point cloud files written by prepare_pc.
+
+    A plain point cloud file is treated as a manifest with one file.
+
+    Args:
+        pc_fp (str): Path to a point cloud file or a manifest.
+
+    Returns:
+        dict: The manifest with the files, their bounds and point counts and the union of the bounds.
+    """
+    if is_manifest(pc_fp):
+        with open(pc_fp) as f:
+            return json.load(f)
+    with laspy.open(pc_fp) as las:
+        hdr = las.header
+        entry = {
+            "filename": pc_fp,
+            "bounds": [hdr.mins[0], hdr.mins[1], hdr.maxs[0], hdr.maxs[1], hdr.mins[2], hdr.maxs[2]],
+            "point_count": hdr.point_count
+        }
+    return {"files": [entry], "bounds": entry["bounds"], "point_count": entry["point_count"]}
+
+def pc_files(pc_fp):
+    """List the point cloud files behind a point cloud file or a manifest.
+
+    Args:
+        pc_fp (str): Path to a point cloud file or a manifest.
+
+    Returns:
+        list: Filepaths to the point cloud files.
+    """
+    if is_manifest(pc_fp):
+        return [entry['filename'] for entry in read_manifest(pc_fp)['files']]
+    return [pc_fp]
+
+def reader_stages(pc_fp):
+    """Create the PDAL reader stages for a point cloud file or a manifest.
+
+    The files of a manifest are read by one readers.las each and merged in memory, so there is no need to
+    write a merged copy of the point clouds to disk.
+
+    Args:
+        pc_fp (str): Path to a point cloud file or a manifest.
+
+    Returns:
+        list: The reader stages of the json pipeline.
+    """
+    stages = [{"type": "readers.las", "filename": fp} for fp in pc_files(pc_fp)]
+    if len(stages) > 1:
+        stages.append({"type": "filters.merge"})
+    return stages
+
+def iter_chunks(laz_fps, chunk_size = 1_000_000):
+    """Read point cloud files chunk by chunk.
+
+    Args:
+        laz_fps (list): Filepaths to the point cloud files.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Yields:
+        tuple: The chunk of points and the header of the file it comes from.
+    """
+    for fp in laz_fps:
+        with laspy.open(fp) as reader:
+            for points in reader.chunk_iterator(chunk_size):
+                yield points, reader.header
+
+def copy_header(header):
+    """Create an empty header with the point format, scales, offsets and crs of another header.
+
+    Args:
+        header (laspy.LasHeader): The header to copy.
+
+    Returns:
+        laspy.LasHeader: The new header.
+    """
+    new = laspy.LasHeader(point_format= header.point_format, version= header.version)
+    new.scales = header.scales
+    new.offsets = header.offsets
+    crs = header.parse_crs()
+    if crs is not None:
+        new.add_crs(crs)
+    return new
+
+def rescale_points(points, header):
+    """Copy points to the scales and offsets of a header if they differ.
+
+    Args:
+        points (laspy.ScaleAwarePointRecord): The points.
+        header (laspy.LasHeader): The header of the file the points are written to.
+
+    Returns:
+        laspy.ScaleAwarePointRecord: The points with the scales and offsets of the header.
+    """
+    if np.array_equal(points.scales, header.scales) and np.array_equal(points.offsets, header.offsets):
+        return points
+    out = laspy.ScaleAwarePointRecord.zeros(len(points), header= header)
+    for dim in points.point_format.dimension_names:
+        if dim not in ('X', 'Y', 'Z'):
+            out[dim] = points[dim]
+    out.x = points.x
+    out.y = points.y
+    out.z = points.z
+    return out
+
+def download_dem(laz_fp, dem_fp, cache_fp = '', dem_cache = None, provider = None, resolution = 1):
     """Download DEM within the bounds of the las file.
 
+    The reprojected DEM is kept in a local DEM cache. The default cache stores it as a fixed grid of tiles, so
+    later calls that overlap the same area only fetch and reproject the tiles that are not cached yet.
+
     Args:
-        laz_fp (_type_): Path to the las file.
-        dem_fp (str, optional): Filename for the downloaded dem. Defaults to 'dem.tif'.
-        cache_fp (str, optional): Cache filepath. Defaults to './cache/aiohttp_cache.sqlite'.
+        laz_fp (_type_): Path to the las file or to a manifest of las files.
+        dem_fp (str, optional): Filename for the downloaded dem. Relative filenames are in the directory of laz_fp. Defaults to 'dem.tif'.
+        cache_fp (str, optional): No longer used. py3dep caches its requests in HYRIVER_CACHE_NAME, set once per process to
+            dem_cache.HTTP_CACHE_FP unless it is set already. Defaults to ''.
+        dem_cache (DEMCache, optional): Cache of reprojected DEMs. Defaults to None which uses the default TiledDEMCache. Use False to disable the cache.
+        provider (function, optional): Called with the WGS84 bounds and the resolution to fetch the DEM. Defaults to None which uses py3dep.
+        resolution (int, optional): Resolution of the DEM in meters. Defaults to 1.
 
     Returns:
         _type_: The filepath to the downloaded DEM, the crs of the las file, and the transform from the las crs to wgs84. 
     """
-    #set the working directory
-    in_dir = os.path.dirname(laz_fp)
-    os.chdir(in_dir)
-    
+    import pyproj
+    import rioxarray  # noqa: F401, registers the .rio accessor
+    from rasterio.enums import Resampling
+    from shapely.geometry import box
+    from shapely.ops import transform
+
+    #resolve the filepaths against the directory of the las file instead of the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
+    dem_fp = os.path.join(in_dir, dem_fp)
+    if cache_fp != '':
+        print(f"Warning: cache_fp is ignored, py3dep caches its requests in {os.environ.get('HYRIVER_CACHE_NAME')}")
+
     # read crs of las file
-    with laspy.open(laz_fp) as las:
+    with laspy.open(pc_files(laz_fp)[0]) as las:
         hdr = las.header
         crs = hdr.parse_crs()
     # log.debug(f"CRS used is {crs}")
     # create transform from wgs84 to las crs
     wgs84 = pyproj.CRS('EPSG:4326')
     project = pyproj.Transformer.from_crs(crs, wgs84 , always_xy=True).transform
-    # calculate bounds of las file in wgs84
-    utm_bounds = box(hdr.mins[0], hdr.mins[1], hdr.maxs[0], hdr.maxs[1])
-    wgs84_bounds = transform(project, utm_bounds)
+    # bounds of las file (or all the files of a manifest)
+    bounds = tuple(read_manifest(laz_fp)['bounds'][:4])
     # download dem inside bounds
-    os.environ["HYRIVER_CACHE_NAME"] = cache_fp
-    
-    dem_wgs = py3dep.get_map('DEM', wgs84_bounds, resolution=1, crs='EPSG:4326')
-    # log.debug(f"DEM bounds: {dem_wgs.rio.bounds()}. Size: {dem_wgs.size}")
-    # reproject to las crs and save
-    dem_utm = dem_wgs.rio.reproject(crs, resampling = Resampling.cubic_spline)
-    dem_utm.rio.to_raster(dem_fp)
+    if provider is None:
+        provider = py3dep_provider
+
+    def fetch(bounds):
+        # calculate bounds in wgs84
+        wgs84_bounds = transform(project, box(*bounds))
+        # log.debug(f"DEM bounds: {dem_wgs.rio.bounds()}. Size: {dem_wgs.size}")
+        return provider(wgs84_bounds, resolution)
+
+    if dem_cache is False:
+        # reproject to las crs and save
+        dem_utm = fetch(bounds).rio.reproject(crs, resampling = Resampling.cubic_spline)
+        dem_utm.rio.to_raster(dem_fp)
+    else:
+        # the cache reprojects to las crs on a miss
+        if dem_cache is None:
+            dem_cache = TiledDEMCache()
+        dem_cache.get_dem(bounds, crs, resolution, dem_fp, fetch)
     # log.debug(f"Saved to {dem_fp}")
     return dem_fp, crs, project
 
@@ -73,129 +203,36 @@ def make_dirs(in_dir):
     return results_dir
 
 def snowdepth_val(lid_path, csv_path, snowdepth_col, lat_col, lon_col, road_shp = '', csv_EPSG=4326, zone_utmcrs=32611, lid_unit="m", probe_unit="cm", use_buffer = 'no'):
-    """_summary_
+    """Validate a lidar snow depth raster against probes and plot the agreement.
+
+    Use snow_pc.validation.snowdepth_metrics() to get the metrics without the figure.
 
     Args:
-        lid_path (_type_): _description_
-        csv_path (_type_): _description_
-        snowdepth_col (_type_): _description_
-        lat_col (_type_): _description_
-        lon_col (_type_): _description_
-        csv_EPSG (int, optional): _description_. Defaults to 4326.
-        zone_utmcrs (int, optional): _description_. Defaults to 32611.
-        lid_unit (str, optional): _description_. Defaults to "m".
-        probe_unit (str, optional): _description_. Defaults to "cm".
-        use_buffer (str, optional): _description_. Defaults to 'no'.
+        lid_path (str): Filepath to the lidar snow depth raster.
+        csv_path (str): Filepath to the csv of the probes.
+        snowdepth_col (str): Column of the probed snow depth.
+        lat_col (str): Column of the latitude or y coordinate of the probes.
+        lon_col (str): Column of the longitude or x coordinate of the probes.
+        road_shp (str, optional): Filepath to the road shapefile for the stable terrain residuals. Defaults to '' for no roads.
+        csv_EPSG (int, optional): EPSG code of the probe coordinates. Defaults to 4326.
+        zone_utmcrs (int, optional): EPSG code of the UTM zone. Defaults to 32611.
+        lid_unit (str, optional): Unit of the raster, "m" or "cm". Defaults to "m".
+        probe_unit (str, optional): Unit of the probes, "m" or "cm". Defaults to "cm".
+        use_buffer (str, optional): 'no' to interpolate the raster bilinearly at each probe, else the mean within 2 m of it. Defaults to 'no'.
 
     Returns:
-        _type_: _description_
+        tuple: The probes with their lidar snow depth and error, and the lidar snow depth of the road pixels.
     """
-    # read the lidar raster data
-    lidar = rxr.open_rasterio(lid_path, masked = True)
-    #reproject to crs of the zone
-    if lidar.rio.crs.to_string() != "EPSG:" + str(zone_utmcrs):
-        lidar = lidar.rio.reproject(CRS.from_string("EPSG:" + str(zone_utmcrs)))
-    # read the csv
-    df = pd.read_csv(csv_path, usecols=[snowdepth_col, lat_col, lon_col])
-    # convert to geodataframe
-    gdf = gpd.GeoDataFrame(
-        df,
-        geometry=gpd.points_from_xy(df[lon_col], df[lat_col]),
-        crs="EPSG:" + str(csv_EPSG),
-    )
-    # convert the gdf to crs of the zone
-    gdf_utm = gdf.to_crs("EPSG:" + str(zone_utmcrs))
-
-    #Extract the LiDAR pixels at pixel or buffered region 
-    if use_buffer == "no":
-        # sample the snow depth raster values at point locations
-        vals = point_query(gdf_utm.geometry, lidar.squeeze().values, affine = lidar.rio.transform(), nodata = -9999)
-        # add the values to a new column in the GeoDataFrame
-        gdf_utm['lidar'] = vals
-    else:
-        # buffer the points
-        gdf_utm_buffered = gdf_utm.buffer(2)
-        # calculate zonal statistics of the mean within the buffer
-        vals = zonal_stats(
-            gdf_utm_buffered,
-            lidar.squeeze().values,
-            affine=lidar.rio.transform(),
-            nodata=-9999,
-            stats="mean",
-        )
-        # add the values to new columns in the GeoDataFrame
-        gdf_utm['lidar'] = [stat["mean"] for stat in vals]
-
-    #convert the unit to m
-    if probe_unit == "cm":
-        gdf_utm[snowdepth_col] = gdf_utm[snowdepth_col] / 100
-    if lid_unit == "cm":
-        gdf_utm["lidar"] = gdf_utm["lidar"]/100
-    #rename the columns
-    gdf_utm.rename(columns={
-                       snowdepth_col: 'Probed Snow Depth (m)', 'lidar': 'LiDAR Snow Depth (m)'}, inplace=True)
-    #add error column
-    gdf_utm['error (cm)'] = (gdf_utm['Probed Snow Depth (m)'] - gdf_utm['LiDAR Snow Depth (m)']) * 100
-
-    if road_shp == '':
-        road = '/SNOWDATA/IDALS/misc_data_scripts/3mroadBufferClip/3m_road.shp'
-    else:
-        road = road_shp
-    #read the road shapefile
-    road = gpd.read_file(road)
-    # convert the gdf to crs of the zone
-    road = road.to_crs("EPSG:" + str(zone_utmcrs))
-    #create a 5m buffer
-    road_10 = road.buffer(2)
-    #sample lidar values overlapping with road_10
-    values = zonal_stats(
-            road_10,
-            lidar.squeeze().values,
-            affine=lidar.rio.transform(),
-            raster_out=True, stats="mean"
-        )
-    masked_data = values[0]['mini_raster_array']
-    lidar_road = masked_data[~masked_data.mask] 
-
-    fig, axs = plt.subplots(nrows=1, ncols=2, figsize=(10, 6))
-    # Drop missing values
-    gdf_utm = gdf_utm.dropna(subset=['Probed Snow Depth (m)', 'LiDAR Snow Depth (m)'])
-
-    # Scatter plot of probed depth vs lidar depth
-    sns.regplot(x='Probed Snow Depth (m)', y='LiDAR Snow Depth (m)', data=gdf_utm, ax=axs[0], fit_reg=False)
-    probe_min, probe_max = gdf_utm['Probed Snow Depth (m)'].min(), gdf_utm['Probed Snow Depth (m)'].max()
-    lidar_min, lidar_max = gdf_utm['LiDAR Snow Depth (m)'].min(), gdf_utm['LiDAR Snow Depth (m)'].max()
-    min_val = min(probe_min, lidar_min)
-    max_val = max(probe_max, lidar_max)
-    axs[0].plot([min_val, max_val], [min_val, max_val], linestyle='--', color='black')
-
-
-    # Calculate correlation (r) and RMSE
-    corr = np.corrcoef(gdf_utm['Probed Snow Depth (m)'], gdf_utm['LiDAR Snow Depth (m)'])[0, 1]
-    correlation_text = f'r: {corr:.2f}'
-    rmse = np.sqrt(mean_squared_error(gdf_utm['Probed Snow Depth (m)'], gdf_utm['LiDAR Snow Depth (m)']))
-    rmse_text = f'RMSE: {rmse:.2f}'
-    mbe = np.mean(gdf_utm['Probed Snow Depth (m)'] - gdf_utm['LiDAR Snow Depth (m)'])
-    mbe_text = f'MBE: {mbe:.2f}'
-    mae = np.mean(np.abs(gdf_utm['Probed Snow Depth (m)'] - gdf_utm['LiDAR Snow Depth (m)']))
-    mae_text = f'MAE: {mae:.2f}'
-    nmad = 1.4826 * np.median(np.abs(gdf_utm['Probed Snow Depth (m)'] - gdf_utm['LiDAR Snow Depth (m)']))
-    nmad_text = f'NMAD: {nmad:.2f}'
-
-    # Add the correlation coefficient and RMSE as text to the upper left corner
-    combined_text = '\n'.join([correlation_text, rmse_text, mbe_text, mae_text, nmad_text])
-    axs[0].text(0.02, 0.98, combined_text, transform=axs[0].transAxes, color='black', bbox=dict(facecolor='white', alpha=0.8), ha='left', va='top')
-
-    # Distribution plot of error
-    sns.histplot(gdf_utm['error (cm)'], kde=True, ax=axs[1])
-    axs[1].set_xlabel('Error (cm)')
-    axs[1].set_ylabel('Frequency')
-    plt.tight_layout()
-
+    from snow_pc.validation import sample_probes, probe_metrics, plot_validation
 
+    gdf_utm, lidar_road = sample_probes(lid_path, csv_path, snowdepth_col, lat_col, lon_col, road_shp, csv_EPSG, zone_utmcrs,
+                                        lid_unit, probe_unit, use_buffer)
+    plot_validation(gdf_utm, probe_metrics(gdf_utm['Probed Snow Depth (m)'], gdf_utm['LiDAR Snow Depth (m)']))
     return gdf_utm, lidar_road
 
 def clip_lidar_with_shapefile(shapefile_path, lidar_input_path, lidar_output_path):
+    import geopandas as gpd
+
     # Load the shapefile
     gdf = gpd.read_file(shapefile_path)
 
@@ -214,9 +251,5 @@ def clip_lidar_with_shapefile(shapefile_path, lidar_input_path, lidar_output_pat
         ]
     }
 
-    # Write the pipeline to a JSON file
-    with open('pipeline.json', 'w') as f:
-        json.dump(pipeline, f)
-
     # Run the PDAL pipeline
-    subprocess.run(['pdal', 'pipeline', 'pipeline.json'])
\ No newline at end of file
+    run_pipeline(pipeline, json_fp = os.path.join(os.path.dirname(os.path.abspath(lidar_output_path)), 'pipeline.json'))
\ No newline at end of file
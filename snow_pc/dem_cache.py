@@ -0,0 +1,283 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import math
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'snow_pc', 'dem')
+# py3dep reads the location of its HTTP cache from the environment on every request, so it is set once for the
+# process instead of per download where threads would overwrite each other; a HYRIVER_CACHE_NAME already set is kept
+HTTP_CACHE_FP = os.path.join(os.path.expanduser('~'), '.cache', 'snow_pc', 'aiohttp_cache.sqlite')
+os.environ.setdefault('HYRIVER_CACHE_NAME', HTTP_CACHE_FP)
+
+
+def py3dep_provider(wgs84_bounds, resolution):
+    """Fetch a DEM from 3DEP within bounds in WGS84.
+
+    Args:
+        wgs84_bounds (_type_): Polygon of the bounds in WGS84.
+        resolution (float): Resolution of the DEM in meters.
+
+    Returns:
+        _type_: The DEM as a DataArray in WGS84.
+    """
+    import py3dep
+    return py3dep.get_map('DEM', wgs84_bounds, resolution=resolution, crs='EPSG:4326')
+
+
+class DEMCache:
+    """On-disk cache of reference DEMs that are already reprojected to the las crs.
+
+    Entries are keyed by the projected bounds, the target crs and the resolution. The least recently used
+    entries are removed when the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, max_bytes = 5 * 1024**3):
+        """Create the cache.
+
+        Args:
+            cache_dir (str, optional): Directory of the cache. Defaults to ~/.cache/snow_pc/dem.
+            max_bytes (int, optional): Maximum size of the cache in bytes. Defaults to 5 GB.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok= True)
+
+    def key(self, bounds, crs, resolution):
+        """Create the key of a DEM.
+
+        Args:
+            bounds (tuple): (minx, miny, maxx, maxy) in the target crs.
+            crs (_type_): Target crs.
+            resolution (float): Resolution of the DEM.
+
+        Returns:
+            str: The key.
+        """
+        # round to a centimeter so float noise in the header bounds does not change the key
+        parts = {'bounds': [round(float(b), 2) for b in bounds], 'crs': crs.to_wkt(), 'resolution': float(resolution)}
+        return hashlib.sha256(json.dumps(parts, sort_keys= True).encode()).hexdigest()
+
+    def path(self, key):
+        """Filepath of a cache entry."""
+        return os.path.join(self.cache_dir, f'{key}.tif')
+
+    def get(self, key):
+        """Return the filepath of a cached DEM, or None if it is not cached.
+
+        Args:
+            key (str): Key from key().
+
+        Returns:
+            str: Filepath to the cached DEM.
+        """
+        fp = self.path(key)
+        if not os.path.exists(fp):
+            return None
+        # mark the entry as recently used
+        os.utime(fp)
+        return fp
+
+    def put(self, key, dem_fp):
+        """Add a DEM to the cache.
+
+        Args:
+            key (str): Key from key().
+            dem_fp (str): Filepath to the DEM.
+
+        Returns:
+            str: Filepath to the cached DEM.
+        """
+        fp = self.path(key)
+        # copy to a temporary file first so a concurrent reader never sees a partial entry
+        fd, tmp = tempfile.mkstemp(dir= self.cache_dir, suffix= '.tmp')
+        os.close(fd)
+        shutil.copyfile(dem_fp, tmp)
+        os.replace(tmp, fp)
+        self.evict(keep = [fp])
+        return fp
+
+    def evict(self, keep = ()):
+        """Remove the least recently used entries until the cache fits in max_bytes.
+
+        Args:
+            keep (list, optional): Filepaths of entries that must not be removed. Defaults to ().
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tif'):
+                fp = os.path.join(self.cache_dir, name)
+                stat = os.stat(fp)
+                entries.append((stat.st_mtime, stat.st_size, fp))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fp in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if fp in keep:
+                continue
+            os.remove(fp)
+            total -= size
+
+    def get_dem(self, bounds, crs, resolution, dem_fp, fetch):
+        """Save the DEM of the bounds to dem_fp, from the cache if possible.
+
+        Args:
+            bounds (tuple): (minx, miny, maxx, maxy) in the target crs.
+            crs (_type_): Target crs.
+            resolution (float): Resolution of the DEM.
+            dem_fp (str): Filepath to save the DEM.
+            fetch (function): Called with bounds in the target crs on a cache miss. Returns the DEM as a DataArray in WGS84.
+
+        Returns:
+            str: Filepath to the DEM.
+        """
+        from rasterio.enums import Resampling
+
+        key = self.key(bounds, crs, resolution)
+        cached = self.get(key)
+        if cached is not None:
+            shutil.copyfile(cached, dem_fp)
+            return dem_fp
+        fetch(bounds).rio.reproject(crs, resampling = Resampling.cubic_spline).rio.to_raster(dem_fp)
+        self.put(key, dem_fp)
+        return dem_fp
+
+
+class TiledDEMCache(DEMCache):
+    """On-disk cache of reference DEMs stored as a fixed grid of tiles in the las crs.
+
+    A request is assembled from the tiles it overlaps and only the missing tiles are fetched, so repeat
+    flights over the same area reuse the cached terrain even when their bounds differ. The tiles are laid out
+    in the units of the las crs, which must be projected; the requested resolution in meters is converted to them.
+    """
+
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, max_bytes = 5 * 1024**3, tile_size = 2000):
+        """Create the cache.
+
+        Args:
+            cache_dir (str, optional): Directory of the cache. Defaults to ~/.cache/snow_pc/dem.
+            max_bytes (int, optional): Maximum size of the cache in bytes. Defaults to 5 GB.
+            tile_size (int, optional): Width of the tiles in the units of the las crs. Defaults to 2000.
+        """
+        super().__init__(cache_dir, max_bytes)
+        self.tile_size = tile_size
+
+    def crs_resolution(self, crs, resolution):
+        """Convert a resolution in meters to the units of a projected crs.
+
+        Args:
+            crs (_type_): Target crs.
+            resolution (float): Resolution of the DEM in meters.
+
+        Raises:
+            ValueError: If the crs is not projected, e.g. in degrees.
+
+        Returns:
+            float: The resolution in the units of the crs.
+        """
+        if not crs.is_projected:
+            raise ValueError(f'The DEM tiles need a projected crs with linear units, not {crs.name}')
+        return float(resolution) / crs.axis_info[0].unit_conversion_factor
+
+    def tile_key(self, crs, resolution, col, row):
+        """Create the key of a tile.
+
+        Args:
+            crs (_type_): Target crs.
+            resolution (float): Resolution of the DEM in the units of the crs.
+            col (int): Column of the tile in the tile grid.
+            row (int): Row of the tile in the tile grid.
+
+        Returns:
+            str: The key.
+        """
+        parts = {'crs': crs.to_wkt(), 'resolution': float(resolution), 'tile_size': self._tile_size(resolution), 'tile': [col, row]}
+        return 'tile-' + hashlib.sha256(json.dumps(parts, sort_keys= True).encode()).hexdigest()
+
+    def _tile_size(self, resolution):
+        """Tile size rounded to a multiple of the resolution so the tiles share one pixel grid."""
+        return max(1, round(self.tile_size / resolution)) * float(resolution)
+
+    def tiles(self, bounds, resolution):
+        """List the tiles that overlap bounds.
+
+        Args:
+            bounds (tuple): (minx, miny, maxx, maxy) in the target crs.
+            resolution (float): Resolution of the DEM in the units of the crs.
+
+        Returns:
+            list: (col, row, tile bounds) of each tile.
+        """
+        size = self._tile_size(resolution)
+        minx, miny, maxx, maxy = bounds
+        tiles = []
+        for row in range(math.floor(miny / size), math.floor(maxy / size) + 1):
+            for col in range(math.floor(minx / size), math.floor(maxx / size) + 1):
+                tiles.append((col, row, (col * size, row * size, (col + 1) * size, (row + 1) * size)))
+        return tiles
+
+    def get_dem(self, bounds, crs, resolution, dem_fp, fetch):
+        """Save the DEM of the bounds to dem_fp, fetching only the tiles that are not cached.
+
+        Args:
+            bounds (tuple): (minx, miny, maxx, maxy) in the target crs.
+            crs (_type_): Target crs.
+            resolution (float): Resolution of the DEM in meters.
+            dem_fp (str): Filepath to save the DEM.
+            fetch (function): Called with bounds in the target crs for the missing tiles. Returns the DEM as a DataArray in WGS84.
+
+        Returns:
+            str: Filepath to the DEM.
+        """
+        import rasterio
+        from rasterio.enums import Resampling
+        from rasterio.merge import merge
+        from rasterio.transform import from_origin
+
+        # the tile grid, the pixels and the fetch margin are in the units of the crs
+        resolution = self.crs_resolution(crs, resolution)
+        tiles = self.tiles(bounds, resolution)
+        paths = {}
+        missing = []
+        for col, row, tile_bounds in tiles:
+            key = self.tile_key(crs, resolution, col, row)
+            if self.get(key) is None:
+                missing.append((col, row, tile_bounds))
+            paths[(col, row)] = self.path(key)
+
+        if len(missing) > 0:
+            # fetch the missing tiles at once, with a margin so the resampling has data at the tile edges
+            margin = 10 * float(resolution)
+            fetch_bounds = (min(b[0] for _, _, b in missing) - margin, min(b[1] for _, _, b in missing) - margin,
+                            max(b[2] for _, _, b in missing) + margin, max(b[3] for _, _, b in missing) + margin)
+            dem_wgs = fetch(fetch_bounds)
+            size = int(round(self._tile_size(resolution) / resolution))
+            for col, row, tile_bounds in missing:
+                tile = dem_wgs.rio.reproject(crs, transform = from_origin(tile_bounds[0], tile_bounds[3], resolution, resolution),
+                                             shape = (size, size), resampling = Resampling.cubic_spline)
+                fd, tmp = tempfile.mkstemp(dir= self.cache_dir, suffix= '.tmp')
+                os.close(fd)
+                tile.rio.to_raster(tmp, driver= 'GTiff', tiled= True, compress= 'deflate')
+                os.replace(tmp, paths[(col, row)])
+
+        # assemble the window of the request on the tile pixel grid
+        minx, miny, maxx, maxy = bounds
+        window = (math.floor(minx / resolution) * resolution, math.floor(miny / resolution) * resolution,
+                  math.ceil(maxx / resolution) * resolution, math.ceil(maxy / resolution) * resolution)
+        sources = [rasterio.open(paths[(col, row)]) for col, row, _ in tiles]
+        try:
+            data, out_transform = merge(sources, bounds= window, res= resolution)
+            profile = sources[0].profile
+        finally:
+            for src in sources:
+                src.close()
+        profile.update(driver= 'GTiff', width= data.shape[2], height= data.shape[1], transform= out_transform,
+                       tiled= False, compress= None)
+        profile.pop('blockxsize', None)
+        profile.pop('blockysize', None)
+        with rasterio.open(dem_fp, 'w', **profile) as dst:
+            dst.write(data)
+
+        self.evict(keep = list(paths.values()))
+        return dem_fp
@@ -0,0 +1,287 @@
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+# plans kept by resampling_plan(), the least recently used are closed beyond it
+MAX_PLANS = 4
+
+
+def block_windows(width, height, block_size = 1024):
+    """Split a raster into square blocks.
+
+    Args:
+        width (int): Width of the raster.
+        height (int): Height of the raster.
+        block_size (int, optional): Size of the blocks in pixels. Defaults to 1024.
+
+    Yields:
+        rasterio.windows.Window: The window of each block.
+    """
+    from rasterio.windows import Window
+
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(col, row, min(block_size, width - col), min(block_size, height - row))
+
+def read_masked(src, window):
+    """Read a window of the first band with the nodata pixels as NaN.
+
+    Args:
+        src (_type_): The open raster.
+        window (rasterio.windows.Window): The window to read.
+
+    Returns:
+        np.ndarray: The values as float64.
+    """
+    data = src.read(1, window= window).astype(np.float64)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        data[data == src.nodata] = np.nan
+    return data
+
+def write_cog(tmp_fp, out_fp):
+    """Convert a tiled GeoTIFF to a compressed cloud optimized GeoTIFF and remove it.
+
+    Args:
+        tmp_fp (str): Filepath to the tiled GeoTIFF.
+        out_fp (str): Filepath to save the COG.
+
+    Returns:
+        str: Filepath to the COG.
+    """
+    import rasterio.shutil
+
+    # the COG driver copies the tiles block by block, so the raster is never held in memory
+    rasterio.shutil.copy(tmp_fp, out_fp, driver= 'COG', compress= 'deflate', predictor= 'YES', blocksize= 512)
+    os.remove(tmp_fp)
+    return out_fp
+
+class ResamplingPlan:
+    """Source pixel indices and weights of every pixel of a target grid.
+
+    The plan is computed once for a pair of source and target grids and applied to every raster on the
+    source grid, e.g. the DTM, the DSM and further epochs gridded the same way. When both grids share a crs
+    and are not rotated, the plan separates into one index array per row and one per column of the target
+    grid. Otherwise the indices of each block are computed with pyproj and cached on disk, so the plan never
+    holds more than one block in memory. A temporary cache directory lives as long as the plan and is removed
+    by close(), at the end of a with block or when the plan is garbage collected.
+    """
+
+    def __init__(self, src_crs, src_transform, src_shape, dst_crs, dst_transform, dst_shape, resampling = 'nearest', cache_dir = None):
+        """Create the plan.
+
+        Args:
+            src_crs (_type_): Crs of the source grid.
+            src_transform (affine.Affine): Transform of the source grid.
+            src_shape (tuple): (height, width) of the source grid.
+            dst_crs (_type_): Crs of the target grid.
+            dst_transform (affine.Affine): Transform of the target grid.
+            dst_shape (tuple): (height, width) of the target grid.
+            resampling (str, optional): 'nearest' or 'bilinear'. Defaults to 'nearest'.
+            cache_dir (str, optional): Directory for the block indices of non separable plans. Defaults to None which uses a temporary directory.
+        """
+        if resampling not in ('nearest', 'bilinear'):
+            raise ValueError(f'Unknown resampling: {resampling}')
+        self.src_crs = src_crs
+        self.src_transform = src_transform
+        self.src_shape = tuple(src_shape)
+        self.dst_crs = dst_crs
+        self.dst_transform = dst_transform
+        self.dst_shape = tuple(dst_shape)
+        self.resampling = resampling
+        self.cache_dir = cache_dir
+        self._tmp_dir = None
+        self.separable = (src_crs == dst_crs and src_transform.b == 0 and src_transform.d == 0
+                          and dst_transform.b == 0 and dst_transform.d == 0)
+        if self.separable:
+            # source column of each target column and source row of each target row
+            height, width = self.dst_shape
+            x = dst_transform.c + (np.arange(width) + 0.5) * dst_transform.a
+            y = dst_transform.f + (np.arange(height) + 0.5) * dst_transform.e
+            self.cols = self._index((x - src_transform.c) / src_transform.a, self.src_shape[1])
+            self.rows = self._index((y - src_transform.f) / src_transform.e, self.src_shape[0])
+
+    @classmethod
+    def from_rasters(cls, src, dst, resampling = 'nearest', cache_dir = None):
+        """Create the plan from a source raster to the grid of a target raster.
+
+        Args:
+            src (_type_): The open source raster.
+            dst (_type_): The open target raster.
+            resampling (str, optional): 'nearest' or 'bilinear'. Defaults to 'nearest'.
+            cache_dir (str, optional): Directory for the block indices of non separable plans. Defaults to None.
+
+        Returns:
+            ResamplingPlan: The plan.
+        """
+        return cls(src.crs, src.transform, src.shape, dst.crs, dst.transform, dst.shape, resampling, cache_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Remove the temporary directory of the cached block indices. A directory given as cache_dir is kept."""
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+
+    def key(self):
+        """Key of the source and target grids and the resampling."""
+        return (str(self.src_crs), tuple(self.src_transform), self.src_shape, str(self.dst_crs), tuple(self.dst_transform),
+                self.dst_shape, self.resampling)
+
+    def _index(self, frac, size):
+        """Indices and weights of fractional pixel coordinates along one axis. -1 marks the outside of the source."""
+        if self.resampling == 'nearest':
+            index = np.floor(frac).astype(np.int64)
+            index[(index < 0) | (index >= size)] = -1
+            return (index,)
+        # bilinear interpolates between the two nearest pixel centers
+        center = frac - 0.5
+        below = np.floor(center).astype(np.int64)
+        weight = center - below
+        # the outer half pixels take the edge pixel
+        lower = np.clip(below, 0, size - 1)
+        upper = np.clip(below + 1, 0, size - 1)
+        lower[(frac < 0) | (frac >= size)] = -1
+        return lower, upper, weight
+
+    def indices(self, window):
+        """Source indices and weights of the pixels of a window of the target grid.
+
+        Args:
+            window (rasterio.windows.Window): The window.
+
+        Returns:
+            tuple: (row indices, column indices) with the shape of the window; for bilinear the lower and upper indices and the weights of each axis.
+        """
+        r0, c0, h, w = int(window.row_off), int(window.col_off), int(window.height), int(window.width)
+        if self.separable:
+            rows = tuple(a[r0:r0 + h, np.newaxis] for a in self.rows)
+            cols = tuple(a[np.newaxis, c0:c0 + w] for a in self.cols)
+            return rows, cols
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            if self._tmp_dir is None:
+                self._tmp_dir = tempfile.TemporaryDirectory(prefix= 'snow_pc_plan_')
+            cache_dir = self._tmp_dir.name
+        os.makedirs(cache_dir, exist_ok= True)
+        fp = os.path.join(cache_dir, f'{r0}_{c0}_{h}_{w}.npz')
+        if os.path.exists(fp):
+            with np.load(fp) as cached:
+                return tuple(cached[f'r{i}'] for i in range(len(cached.files) // 2)), tuple(cached[f'c{i}'] for i in range(len(cached.files) // 2))
+
+        from pyproj import Transformer
+        cols, rows = np.meshgrid(np.arange(c0, c0 + w) + 0.5, np.arange(r0, r0 + h) + 0.5)
+        x, y = self.dst_transform * (cols, rows)
+        x, y = Transformer.from_crs(self.dst_crs, self.src_crs, always_xy= True).transform(x, y)
+        fcol, frow = ~self.src_transform * (x, y)
+        rows = self._index(np.asarray(frow), self.src_shape[0])
+        cols = self._index(np.asarray(fcol), self.src_shape[1])
+        np.savez(fp, **{f'r{i}': a for i, a in enumerate(rows)}, **{f'c{i}': a for i, a in enumerate(cols)})
+        return rows, cols
+
+    def apply(self, src, window):
+        """Resample a window of the target grid from a raster on the source grid.
+
+        Only the part of the source that the window needs is read.
+
+        Args:
+            src (_type_): The open source raster.
+            window (rasterio.windows.Window): The window of the target grid.
+
+        Returns:
+            np.ndarray: The values with NaN outside the source and on nodata pixels.
+        """
+        from rasterio.windows import Window
+
+        rows, cols = self.indices(window)
+        shape = (int(window.height), int(window.width))
+        valid = np.broadcast_to((rows[0] >= 0) & (cols[0] >= 0), shape)
+        values = np.full(shape, np.nan)
+        if not valid.any():
+            return values
+        # read the bounding window of the source pixels
+        used_rows = np.concatenate([np.ravel(a[a >= 0]) for a in rows[:2]])
+        used_cols = np.concatenate([np.ravel(a[a >= 0]) for a in cols[:2]])
+        row0, col0 = used_rows.min(), used_cols.min()
+        data = read_masked(src, Window(col0, row0, used_cols.max() - col0 + 1, used_rows.max() - row0 + 1))
+        if self.resampling == 'nearest':
+            r = np.broadcast_to(rows[0], shape)[valid] - row0
+            c = np.broadcast_to(cols[0], shape)[valid] - col0
+            values[valid] = data[r, c]
+            return values
+
+        r0, r1, wr = (np.broadcast_to(a, shape)[valid] for a in rows)
+        c0, c1, wc = (np.broadcast_to(a, shape)[valid] for a in cols)
+        r0, r1, c0, c1 = r0 - row0, r1 - row0, c0 - col0, c1 - col0
+        corners = np.stack([data[r0, c0], data[r0, c1], data[r1, c0], data[r1, c1]])
+        weights = np.stack([(1 - wr) * (1 - wc), (1 - wr) * wc, wr * (1 - wc), wr * wc])
+        # nodata corners are left out and the weights of the others renormalized
+        weights = np.where(np.isnan(corners), 0, weights)
+        total = weights.sum(axis= 0)
+        with np.errstate(invalid= 'ignore', divide= 'ignore'):
+            values[valid] = np.where(total > 0, np.nansum(corners * weights, axis= 0) / total, np.nan)
+        return values
+
+
+_plans = OrderedDict()
+
+def resampling_plan(src, dst, resampling = 'nearest'):
+    """Get the plan from a source raster to the grid of a target raster, reusing the plan of the same grids.
+
+    The last MAX_PLANS plans are kept; older ones are closed, which removes their cached block indices.
+
+    Args:
+        src (_type_): The open source raster.
+        dst (_type_): The open target raster.
+        resampling (str, optional): 'nearest' or 'bilinear'. Defaults to 'nearest'.
+
+    Returns:
+        ResamplingPlan: The plan.
+    """
+    plan = ResamplingPlan.from_rasters(src, dst, resampling)
+    key = plan.key()
+    if key in _plans:
+        _plans.move_to_end(key)
+        return _plans[key]
+    _plans[key] = plan
+    while len(_plans) > MAX_PLANS:
+        _plans.popitem(last= False)[1].close()
+    return plan
+
+def difference_rasters(src_fp, ref_fp, out_fp, block_size = 1024, resampling = 'nearest', plan = None):
+    """Subtract the reference raster from a raster, block by block on the grid of the reference.
+
+    The raster is resampled to the grid of the reference with a ResamplingPlan that is shared by every raster
+    on the same grid, so only the blocks being differenced are read and the peak memory is set by block_size
+    and not by the size of the rasters.
+
+    Args:
+        src_fp (str): Filepath to the raster, e.g. the aligned DTM.
+        ref_fp (str): Filepath to the reference raster, e.g. the snow off DEM.
+        out_fp (str): Filepath to save the difference as a cloud optimized GeoTIFF.
+        block_size (int, optional): Size of the blocks in pixels. Defaults to 1024.
+        resampling (str, optional): 'nearest' like reproject_match, or 'bilinear'. Defaults to 'nearest'.
+        plan (ResamplingPlan, optional): Plan from the grid of the raster to the grid of the reference. Defaults to None which uses resampling_plan().
+
+    Returns:
+        str: Filepath to the difference.
+    """
+    import rasterio
+
+    with rasterio.open(ref_fp) as ref, rasterio.open(src_fp) as src:
+        if plan is None:
+            plan = resampling_plan(src, ref, resampling)
+        profile = dict(driver= 'GTiff', width= ref.width, height= ref.height, count= 1, dtype= 'float32', nodata= np.nan,
+                       crs= ref.crs, transform= ref.transform, tiled= True, blockxsize= 512, blockysize= 512, compress= 'deflate')
+        fd, tmp_fp = tempfile.mkstemp(dir= os.path.dirname(os.path.abspath(out_fp)), suffix= '.tif')
+        os.close(fd)
+        with rasterio.open(tmp_fp, 'w', **profile) as dst:
+            for window in block_windows(ref.width, ref.height, block_size):
+                diff = plan.apply(src, window) - read_masked(ref, window)
+                dst.write(diff.astype(np.float32), 1, window= window)
+    return write_cog(tmp_fp, out_fp)
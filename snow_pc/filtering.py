@@ -1,60 +1,220 @@
 import os
 from os.path import dirname, join
-import json
-import subprocess
 import shutil
-from snow_pc.common import download_dem, make_dirs
+from snow_pc.common import download_dem, make_dirs, reader_stages
+from snow_pc.pipeline import run_pipeline
+from snow_pc.report import instrumented
 
-def return_filtering(laz_fp, out_fp = ''):
+
+def get_dem(laz_fp, user_dem = ''):
+    """Set up the DEM of the filters next to the point cloud.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        user_dem (str, optional): Filepath to the DEM file. Defaults to '' which downloads the DEM.
+
+    Returns:
+        str: Filepath to the DEM.
+    """
+    #set dem_fp
+    dem_fp = join(dirname(os.path.abspath(laz_fp)), 'dem.tif')
+
+    #download dem using download_dem() if user_dem is not provided
+    if user_dem == '':
+        dem_fp, crs, project = download_dem(laz_fp, dem_fp= dem_fp)
+    elif os.path.abspath(user_dem) != os.path.abspath(dem_fp):
+        shutil.copy(user_dem, dem_fp) #if user_dem is provided, copy the user_dem to dem_fp
+    return dem_fp
+
+
+class FilterChain:
+    """Chain filtering stages into a single PDAL pipeline.
+
+    The point cloud is read once, the intermediate points stay in memory between the stages and only the
+    final output is written, e.g.
+
+        FilterChain(laz_fp).returns().dem(user_dem = dem_fp).outlier().write('filtered.laz')
+    """
+
+    def __init__(self, laz_fp):
+        """Start a chain.
+
+        Args:
+            laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        """
+        self.laz_fp = laz_fp
+        self.stages = reader_stages(laz_fp)
+
+    def returns(self):
+        """Use filters.mongo to filter out points with invalid returns."""
+        self.stages.append({
+            "type": "filters.mongo",
+            "expression": {"$and": [
+            {"ReturnNumber": {"$gt": 0}},
+            {"NumberOfReturns": {"$gt": 0}} ] }
+        })
+        return self
+
+    def dem(self, user_dem = '', dem_low = 20, dem_high = 50):
+        """Use filters.dem to filter the point cloud to the DEM.
+
+        Args:
+            user_dem (str, optional): Filepath to the DEM file. Defaults to '' which downloads the DEM.
+            dem_low (int, optional): Lower limit of the DEM. Defaults to 20.
+            dem_high (int, optional): Upper limit of the DEM. Defaults to 50.
+        """
+        self.stages.append({
+            "type": "filters.dem",
+            "raster": get_dem(self.laz_fp, user_dem),
+            "limits": f"Z[{dem_low}:{dem_high}]"
+        })
+        return self
+
+    def elm(self):
+        """Use filters.elm to classify low noise points."""
+        self.stages.append({
+            "type": "filters.elm"
+        })
+        return self
+
+    def outlier(self, mean_k = 20, multiplier = 3):
+        """Use filters.outlier to classify outlier points.
+
+        Args:
+            mean_k (int, optional): Number of neighbors. Defaults to 20.
+            multiplier (int, optional): Standard deviation multiplier. Defaults to 3.
+        """
+        self.stages.append({
+            "type": "filters.outlier",
+            "method": "statistical",
+            "mean_k": mean_k,
+            "multiplier": multiplier
+        })
+        return self
+
+    def ground(self, lidar_pc = 'yes', slope = 0.15, window = 18, threshold = 0.5, scalar = 1.25):
+        """Use filters.smrf and filters.range to segment ground points.
+
+        Args:
+            lidar_pc (str, optional): 'yes' for lidar point clouds. SfM point clouds skip filters.smrf. Defaults to 'yes'.
+            slope (float, optional): filters.smrf slope. Defaults to 0.15.
+            window (int, optional): filters.smrf window. Defaults to 18.
+            threshold (float, optional): filters.smrf threshold. Defaults to 0.5.
+            scalar (float, optional): filters.smrf scalar. Defaults to 1.25.
+        """
+        if lidar_pc.lower() == 'yes':
+            self.stages.append({
+                "type": "filters.smrf",
+                "ignore": "Classification[7:7], NumberOfReturns[0:0], ReturnNumber[0:0]",
+                "scalar": scalar,
+                "slope": slope,
+                "window": window,
+                "threshold": threshold
+            })
+        self.stages.append({
+            "type": "filters.range",
+            "limits": "Classification[2:2]"
+        })
+        return self
+
+    def surface(self, lidar_pc = 'yes'):
+        """Use filters.range to segment the surface points.
+
+        Args:
+            lidar_pc (str, optional): 'yes' keeps the first returns, otherwise classes 2 to 6 are kept. Defaults to 'yes'.
+        """
+        if lidar_pc.lower() == 'yes':
+            limits = "returnnumber[1:1]"
+        else:
+            limits = "Classification[2:6]"
+        self.stages.append({
+            "type": "filters.range",
+            "limits": limits
+        })
+        return self
+
+    def pipeline(self, out_fp, out_tif = '', las_options = None):
+        """Create the json pipeline of the chain.
+
+        Args:
+            out_fp (str): Filepath to save the output las file.
+            out_tif (str, optional): Filepath to save an idw raster of the output. Defaults to '' for no raster.
+            las_options (dict, optional): Extra options of writers.las. Defaults to None.
+
+        Returns:
+            dict: The json pipeline.
+        """
+        writer = {"type": "writers.las", "filename": out_fp}
+        if las_options is not None:
+            writer.update(las_options)
+        stages = self.stages + [writer]
+        if out_tif != '':
+            stages.append({
+                "type": "writers.gdal",
+                "filename": out_tif,
+                "resolution": 1.0,
+                "output_type": "idw"
+            })
+        return {"pipeline": stages}
+
+    def write(self, out_fp, out_tif = '', las_options = None, json_fp = ''):
+        """Run the chain and write the output.
+
+        Args:
+            out_fp (str): Filepath to save the output las file.
+            out_tif (str, optional): Filepath to save an idw raster of the output. Defaults to '' for no raster.
+            las_options (dict, optional): Extra options of writers.las. Defaults to None.
+            json_fp (str, optional): Filepath to save the json pipeline. Defaults to '' which uses jsons/filter_chain.json next to the input.
+
+        Returns:
+            _type_: Filepath to the output las file, and to the raster if out_tif is given.
+        """
+        if json_fp == '':
+            json_fp = join(dirname(os.path.abspath(self.laz_fp)), 'jsons', 'filter_chain.json')
+        run_pipeline(self.pipeline(out_fp, out_tif, las_options), json_fp = json_fp)
+        if out_tif != '':
+            return out_fp, out_tif
+        return out_fp
+
+    def execute(self):
+        """Run the chain in memory without writing any file.
+
+        Returns:
+            tuple: The point arrays and the metadata from run_pipeline().
+        """
+        return run_pipeline({"pipeline": self.stages}, backend = 'python', return_arrays = True)
+
+
+@instrumented
+def return_filtering(laz_fp, out_fp = '', engine = 'pdal', chunk_size = 1_000_000):
     """Use filters.mongo to filter out points with invalid returns.
 
     Args:
         laz_fp (_type_): Filepath to the point cloud file.
+        engine (str, optional): 'pdal' runs filters.mongo, 'numpy' filters the points chunk by chunk with laspy. Defaults to 'pdal'.
+        chunk_size (int, optional): Number of points read at a time by the numpy engine. Defaults to 1_000_000.
 
     Returns:
         _type_: Filepath to the filtered point cloud file.
     """
-    #set the working directory
-    in_dir = os.path.dirname(laz_fp)
-    os.chdir(in_dir)
+    #resolve the outputs against the directory of the point cloud instead of the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
 
     #create a filepath for the output las file
     if out_fp == '':
         out_fp = "returns_filtered.laz"
+    out_fp = join(in_dir, out_fp)
 
-    #create a json pipeline for pdal
-    json_pipeline = {
-        "pipeline": [
-            {
-                "type": "readers.las",
-                "filename": laz_fp
-            },
-            {
-                "type": "filters.mongo",\
-                "expression": {"$and": [\
-                {"ReturnNumber": {"$gt": 0}},\
-                {"NumberOfReturns": {"$gt": 0}} ] }
-            },
-            {
-                "type": "writers.las",
-                "filename": out_fp
-            }
-        ]
-    }
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'return_filtering'
-    json_to_use = join(json_dir, f'{json_name}.json')
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    #run the filter
+    if engine == 'numpy':
+        from snow_pc.chunked import return_filter_chunked
+        return return_filter_chunked(laz_fp, out_fp, chunk_size = chunk_size)
+    FilterChain(laz_fp).returns().write(out_fp, json_fp = join(in_dir, 'jsons', 'return_filtering.json'))
 
     return out_fp
 
-def dem_filtering(laz_fp, user_dem = '', dem_low = 20, dem_high = 50, out_fp = ''):
+@instrumented
+def dem_filtering(laz_fp, user_dem = '', dem_low = 20, dem_high = 50, out_fp = '', engine = 'pdal', interpolation = 'nearest', chunk_size = 1_000_000):
     """Use filters.dem to filter the point cloud to the DEM. 
 
     Args:
@@ -62,157 +222,94 @@ def dem_filtering(laz_fp, user_dem = '', dem_low = 20, dem_high = 50, out_fp = '
         user_dem (str, optional): Filepath to the DEM file. Defaults to ''.
         dem_low (int, optional): Lower limit of the DEM. Defaults to 20.
         dem_high (int, optional): Upper limit of the DEM. Defaults to 50.
+        engine (str, optional): 'pdal' runs filters.dem, 'numpy' filters the points chunk by chunk with laspy. Defaults to 'pdal'.
+        interpolation (str, optional): DEM sampling of the numpy engine, 'nearest' like filters.dem or 'bilinear'. Defaults to 'nearest'.
+        chunk_size (int, optional): Number of points read at a time by the numpy engine. Defaults to 1_000_000.
 
     Returns:
         _type_: Filepath to the filtered point cloud file.
     """
 
-    #set the working directory
-    in_dir = os.path.dirname(laz_fp)
-    os.chdir(in_dir)
-
-    #set dem_fp
-    dem_fp = join(in_dir, 'dem.tif')
-    
-    #download dem using download_dem() if user_dem is not provided
-    if user_dem == '':
-        dem_fp, crs, project = download_dem(laz_fp, dem_fp= dem_fp)
-    else:
-        shutil.copy(user_dem, dem_fp) #if user_dem is provided, copy the user_dem to dem_fp
+    #resolve the outputs against the directory of the point cloud instead of the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
 
     #create a filepath for the output las file
     if out_fp == '':
         out_fp = "dem_filtered.laz"
+    out_fp = join(in_dir, out_fp)
 
-
-    #create a json pipeline for pdal
-    json_pipeline = {
-        "pipeline": [
-            {
-                "type": "readers.las",
-                "filename": laz_fp
-            },
-            {
-                "type": "filters.dem",
-                "raster": dem_fp,
-                "limits": f"Z[{dem_low}:{dem_high}]"
-            },
-            {
-                "type": "writers.las",
-                "filename": out_fp
-            }
-        ]
-    }
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'dem_filtering'
-    json_to_use = join(json_dir, f'{json_name}.json')
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    #run the filter
+    if engine == 'numpy':
+        from snow_pc.chunked import dem_filter_chunked
+        dem_fp = get_dem(laz_fp, user_dem)
+        return dem_filter_chunked(laz_fp, dem_fp, out_fp, dem_low = dem_low, dem_high = dem_high,
+                                  interpolation = interpolation, chunk_size = chunk_size)
+    FilterChain(laz_fp).dem(user_dem = user_dem, dem_low = dem_low, dem_high = dem_high).write(out_fp, json_fp = join(in_dir, 'jsons', 'dem_filtering.json'))
 
     return out_fp
 
-def elm_filtering(laz_fp, out_fp = ''):
+@instrumented
+def elm_filtering(laz_fp, out_fp = '', engine = 'pdal', chunk_size = 1_000_000):
     """Use filters.elm to filter the point cloud.
 
     Args:
         laz_fp (_type_): Filepath to the point cloud file.
+        engine (str, optional): 'pdal' runs filters.elm, 'numpy' classifies the same low noise from the lowest points of each
+            cell in a streaming pass with laspy. Defaults to 'pdal'.
+        chunk_size (int, optional): Number of points read at a time by the numpy engine. Defaults to 1_000_000.
 
     Returns:
         _type_: Filepath to the filtered point cloud file.
     """
-    #set the working directory
-    in_dir = os.path.dirname(laz_fp)
-    os.chdir(in_dir)
+    #resolve the outputs against the directory of the point cloud instead of the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
 
     #create a filepath for the output las file
     if out_fp == '':
         out_fp = "elm_filtered.laz"
+    out_fp = join(in_dir, out_fp)
     
-    #create a json pipeline for pdal
-    json_pipeline = {
-        "pipeline": [
-            {
-                "type": "readers.las",
-                "filename": laz_fp
-            },
-            {
-                "type": "filters.elm"
-            },
-            {
-                "type": "writers.las",
-                "filename": out_fp
-            }
-        ]
-    }
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'elm_filtering'
-    json_to_use = join(json_dir, f'{json_name}.json')
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    #run the filter
+    if engine == 'numpy':
+        from snow_pc.noise import elm_filter_native
+        return elm_filter_native(laz_fp, out_fp, chunk_size = chunk_size)
+    FilterChain(laz_fp).elm().write(out_fp, json_fp = join(in_dir, 'jsons', 'elm_filtering.json'))
 
     return out_fp
 
-def outlier_filtering(laz_fp, mean_k = 20, multiplier = 3, out_fp = ''):
+@instrumented
+def outlier_filtering(laz_fp, mean_k = 20, multiplier = 3, out_fp = '', engine = 'pdal', n_workers = None, chunk_size = 1_000_000):
     """Use filters.outlier to filter the point cloud.
 
     Args:
         laz_fp (_type_): Filepath to the point cloud file.
-        mean_k (int, optional): _description_. Defaults to 20.
-        multiplier (int, optional): _description_. Defaults to 3.
+        mean_k (int, optional): Number of neighbors. Defaults to 20.
+        multiplier (int, optional): Standard deviation multiplier. Defaults to 3.
+        engine (str, optional): 'pdal' runs filters.outlier, 'numpy' classifies the same outliers with tiled KD-trees queried
+            in parallel. Defaults to 'pdal'.
+        n_workers (int, optional): Number of threads of the numpy engine. Defaults to None which uses all cores.
+        chunk_size (int, optional): Number of points read at a time by the numpy engine. Defaults to 1_000_000.
 
     Returns:
         _type_: Filepath to the filtered point cloud file.
     """
-    #set the working directory
-    in_dir = os.path.dirname(laz_fp)
-    os.chdir(in_dir)
+    #resolve the outputs against the directory of the point cloud instead of the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
 
     #create a filepath for the output las file
     if out_fp == '':
         out_fp = "outlier_filtered.laz"
+    out_fp = join(in_dir, out_fp)
 
-    #create a json pipeline for pdal
-    json_pipeline = {
-        "pipeline": [
-            {
-                "type": "readers.las",
-                "filename": laz_fp
-            },
-            {
-                "type": "filters.outlier",\
-                "method": "statistical",\
-                "mean_k": mean_k,\
-                "multiplier": multiplier
-            },
-            {
-                "type": "writers.las",
-                "filename": out_fp
-            }
-        ]
-    }
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'outlier_filtering'
-    json_to_use = join(json_dir, f'{json_name}.json')
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    #run the filter
+    if engine == 'numpy':
+        from snow_pc.noise import outlier_filter_native
+        return outlier_filter_native(laz_fp, out_fp, mean_k = mean_k, multiplier = multiplier, n_workers = n_workers, chunk_size = chunk_size)
+    FilterChain(laz_fp).outlier(mean_k = mean_k, multiplier = multiplier).write(out_fp, json_fp = join(in_dir, 'jsons', 'outlier_filtering.json'))
 
     return out_fp
 
+@instrumented
 def ground_segmentation(laz_fp, out_fp = '', out_fp2 = '', lidar_pc = 'yes', slope = 0.15, window = 18, threshold = 0.5, scalar = 1.25):
     """Use filters.smrf and filters.range to segment ground points.
 
@@ -222,87 +319,26 @@ def ground_segmentation(laz_fp, out_fp = '', out_fp2 = '', lidar_pc = 'yes', slo
     Returns:
         _type_: Filepath to the segmented point cloud file.
     """
-    #set the working directory
-    in_dir = os.path.dirname(laz_fp)
-    os.chdir(in_dir)
+    #resolve the outputs against the directory of the point cloud instead of the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
 
     #create a filepath for the output laz and tif file
     if out_fp == '':
         out_fp = "ground_segmented.laz"
     if out_fp2 == '':
         out_fp2 = "ground_segmented.tif"
+    out_fp, out_fp2 = join(in_dir, out_fp), join(in_dir, out_fp2)
+
+    #sfm point clouds are written as las 1.4
+    las_options = None if lidar_pc.lower() == 'yes' else {"major_version": 1, "minor_version": 4}
 
-    if lidar_pc.lower() == 'yes':
-        #create a json pipeline for pdal
-        json_pipeline = {
-            "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
-                {
-                    "type": "filters.smrf",\
-                    "ignore": "Classification[7:7], NumberOfReturns[0:0], ReturnNumber[0:0]",\
-                    "scalar": scalar,\
-                    "slope": slope,\
-                    "window": window,\
-                    "threshold": threshold
-                },
-                {
-                    "type": "filters.range",
-                    "limits": "Classification[2:2]"
-                },
-                {
-                    "type": "writers.las",
-                    "filename": out_fp
-                },
-                {
-                    "type": "writers.gdal",
-                    "filename": out_fp2,
-                    "resolution": 1.0,
-                    "output_type": "idw"
-                }
-            ]
-        }
-    else:
-        #create a json pipeline for pdal
-        json_pipeline = {
-            "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
-                {
-                    "type": "filters.range",
-                    "limits": "Classification[2:2]"
-                },
-                {
-                    "type": "writers.las",
-                    "filename": out_fp,
-                    "major_version": 1,
-                    "minor_version": 4
-                },
-                {
-                    "type": "writers.gdal",
-                    "filename": out_fp2,
-                    "resolution": 1.0,
-                    "output_type": "idw"
-                }
-            ]
-        }
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'ground_segmentation'
-    json_to_use = join(json_dir, f'{json_name}.json')
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    #run the segmentation
+    chain = FilterChain(laz_fp).ground(lidar_pc = lidar_pc, slope = slope, window = window, threshold = threshold, scalar = scalar)
+    chain.write(out_fp, out_tif = out_fp2, las_options = las_options, json_fp = join(in_dir, 'jsons', 'ground_segmentation.json'))
 
     return out_fp, out_fp2
 
+@instrumented
 def surface_segmentation(laz_fp, out_fp = '', out_fp2 = '', lidar_pc = 'yes'):
     """Use filters.range to segment the surface points.
 
@@ -312,75 +348,21 @@ def surface_segmentation(laz_fp, out_fp = '', out_fp2 = '', lidar_pc = 'yes'):
     Returns:
         _type_: Filepath to the segmented point cloud file.
     """
-    #set the working directory
-    in_dir = os.path.dirname(laz_fp)
-    os.chdir(in_dir)
+    #resolve the outputs against the directory of the point cloud instead of the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
 
     #create a filepath for the output laz and tif file
     if out_fp == '':
         out_fp = "surface_segmented.laz"
     if out_fp2 == '':
         out_fp2 = "surface_segmented.tif"
+    out_fp, out_fp2 = join(in_dir, out_fp), join(in_dir, out_fp2)
+
+    #sfm point clouds are written as las 1.4
+    las_options = None if lidar_pc.lower() == 'yes' else {"major_version": 1, "minor_version": 4}
 
-    if lidar_pc.lower() == 'yes':    
-        #create a json pipeline for pdal
-        json_pipeline = {
-            "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
-                {
-                    "type": "filters.range",
-                    "limits": "returnnumber[1:1]"
-                },
-                {
-                    "type": "writers.las",
-                    "filename": out_fp
-                },
-                {
-                    "type": "writers.gdal",
-                    "filename": out_fp2,
-                    "resolution": 1.0,
-                    "output_type": "idw"
-                }
-            ]
-        }
-    else:
-        #create a json pipeline for pdal
-        json_pipeline = {
-            "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
-                {"type": "filters.range",\
-                "limits":"Classification[2:6]"
-                },
-                {
-                    "type": "writers.las",
-                    "filename": out_fp,
-                    "major_version": 1,
-                    "minor_version": 4
-                },
-                {
-                    "type": "writers.gdal",
-                    "filename": out_fp2,
-                    "resolution": 1.0,
-                    "output_type": "idw"
-                }
-            ]
-        }
-
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'surface_segmentation'
-    json_to_use = join(json_dir, f'{json_name}.json')
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    #run the segmentation
+    chain = FilterChain(laz_fp).surface(lidar_pc = lidar_pc)
+    chain.write(out_fp, out_tif = out_fp2, las_options = las_options, json_fp = join(in_dir, 'jsons', 'surface_segmentation.json'))
 
     return out_fp, out_fp2
\ No newline at end of file
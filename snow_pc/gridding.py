@@ -0,0 +1,298 @@
+import os
+import math
+import laspy
+import numpy as np
+from snow_pc.common import pc_files, iter_chunks
+
+NODATA = -9999
+OUTPUT_TYPES = ('min', 'max', 'mean', 'idw', 'count')
+# bytes per cell of the accumulators each output type needs, on top of the int32 count of every output
+CELL_BYTES = {'min': 4, 'max': 4, 'mean': 8, 'idw': 28, 'count': 0}
+
+
+def make_grid(laz_fp, resolution = 1.0):
+    """Create the grid of a raster over the bounds of a point cloud, the same way writers.gdal does.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        resolution (float, optional): Size of the cells. Defaults to 1.0.
+
+    Returns:
+        dict: origin_x, origin_y (lower left corner), resolution, width and height of the grid.
+    """
+    mins, maxs = [], []
+    for fp in pc_files(laz_fp):
+        with laspy.open(fp) as reader:
+            mins.append(reader.header.mins)
+            maxs.append(reader.header.maxs)
+    minx, miny = np.min(mins, axis= 0)[:2]
+    maxx, maxy = np.max(maxs, axis= 0)[:2]
+    return {'origin_x': float(minx), 'origin_y': float(miny), 'resolution': float(resolution),
+            'width': int(math.floor((maxx - minx) / resolution)) + 1, 'height': int(math.floor((maxy - miny) / resolution)) + 1}
+
+
+def raster_grid(raster_fp, resolution = None):
+    """Create the grid of a raster, e.g. to grid several point clouds on the cells of the same reference DEM.
+
+    The grid has the upper left corner of the raster and covers it at the resolution.
+
+    Args:
+        raster_fp (str): Filepath to the raster.
+        resolution (float, optional): Size of the cells. Defaults to None which uses the resolution of the raster.
+
+    Raises:
+        ValueError: If the raster is rotated or its pixels are not square.
+
+    Returns:
+        dict: origin_x, origin_y (lower left corner), resolution, width and height of the grid.
+    """
+    import rasterio
+
+    with rasterio.open(raster_fp) as src:
+        transform, width, height = src.transform, src.width, src.height
+    if transform.b != 0 or transform.d != 0 or not math.isclose(transform.a, -transform.e):
+        raise ValueError(f'{raster_fp} is not a north up raster with square pixels')
+    if resolution is None:
+        resolution = transform.a
+    # round so a resolution that divides the raster does not add a row and a column of float error
+    width = int(math.ceil(round(width * transform.a / resolution, 6)))
+    height = int(math.ceil(round(height * transform.a / resolution, 6)))
+    return {'origin_x': float(transform.c), 'origin_y': float(transform.f - height * resolution), 'resolution': float(resolution),
+            'width': width, 'height': height}
+
+
+class GridAccumulator:
+    """Per-cell statistics of points accumulated chunk by chunk.
+
+    Like writers.gdal, every point within radius of a cell center counts for that cell, and idw weights the
+    points by the inverse of their distance to the cell center to the power. Only the accumulators of the
+    requested output types are allocated, over the whole grid or over a strip of its rows.
+    """
+
+    def __init__(self, grid, radius = None, power = 2.0, output_types = OUTPUT_TYPES, rows = None):
+        """Create empty statistics.
+
+        Args:
+            grid (dict): The grid from make_grid() or raster_grid().
+            radius (float, optional): Search radius around the cell centers. Defaults to None which uses resolution * sqrt(2) like writers.gdal.
+            power (float, optional): Power of the idw weights. Defaults to 2.0.
+            output_types (list, optional): Output types that result() is called for. Defaults to OUTPUT_TYPES.
+            rows (tuple, optional): First and last (exclusive) grid rows to accumulate. Defaults to None for all the rows.
+        """
+        for output_type in output_types:
+            if output_type not in OUTPUT_TYPES:
+                raise ValueError(f'Unknown output type: {output_type}')
+        self.grid = grid
+        self.radius = grid['resolution'] * math.sqrt(2) if radius is None else radius
+        self.power = power
+        self.output_types = set(output_types)
+        self.rows = (0, grid['height']) if rows is None else rows
+        shape = (self.rows[1] - self.rows[0], grid['width'])
+        self.count = np.zeros(shape, dtype= np.int32)
+        if 'min' in self.output_types:
+            self.min = np.full(shape, np.inf, dtype= np.float32)
+        if 'max' in self.output_types:
+            self.max = np.full(shape, -np.inf, dtype= np.float32)
+        # the sums stay float64, float32 loses centimetres summing hundreds of elevations
+        if 'mean' in self.output_types:
+            self.sum = np.zeros(shape)
+        if 'idw' in self.output_types:
+            self.weights = np.zeros(shape)
+            self.weighted_sum = np.zeros(shape)
+            # points that fall on a cell center take the idw value alone
+            self.exact_count = np.zeros(shape, dtype= np.int32)
+            self.exact_sum = np.zeros(shape)
+
+    def add(self, x, y, z):
+        """Add points to the statistics.
+
+        Args:
+            x (np.ndarray): X coordinates of the points.
+            y (np.ndarray): Y coordinates of the points.
+            z (np.ndarray): Values of the points.
+        """
+        res = self.grid['resolution']
+        width = self.grid['width']
+        first, last = self.rows
+        top = self.grid['origin_y'] + self.grid['height'] * res
+        col = np.floor((x - self.grid['origin_x']) / res).astype(np.int64)
+        row = np.floor((top - y) / res).astype(np.int64)
+
+        # visit every cell whose center can be within radius of the point
+        k = int(math.ceil(self.radius / res))
+        for drow in range(-k, k + 1):
+            for dcol in range(-k, k + 1):
+                c = col + dcol
+                r = row + drow
+                dist = np.hypot(self.grid['origin_x'] + (c + 0.5) * res - x, top - (r + 0.5) * res - y)
+                near = (dist <= self.radius) & (c >= 0) & (c < width) & (r >= first) & (r < last)
+                if not near.any():
+                    continue
+                idx = (r[near] - first) * width + c[near]
+                values = z[near]
+                # accumulate into flat views of the grids
+                np.add.at(self.count.reshape(-1), idx, 1)
+                if 'min' in self.output_types:
+                    np.minimum.at(self.min.reshape(-1), idx, values)
+                if 'max' in self.output_types:
+                    np.maximum.at(self.max.reshape(-1), idx, values)
+                if 'mean' in self.output_types:
+                    np.add.at(self.sum.reshape(-1), idx, values)
+                if 'idw' in self.output_types:
+                    d = dist[near]
+                    exact = d == 0
+                    w = 1 / d[~exact] ** self.power
+                    np.add.at(self.exact_count.reshape(-1), idx[exact], 1)
+                    np.add.at(self.exact_sum.reshape(-1), idx[exact], values[exact])
+                    np.add.at(self.weights.reshape(-1), idx[~exact], w)
+                    np.add.at(self.weighted_sum.reshape(-1), idx[~exact], w * values[~exact])
+
+    def result(self, output_type):
+        """Raster of one statistic.
+
+        Args:
+            output_type (str): 'min', 'max', 'mean', 'idw' or 'count'.
+
+        Returns:
+            np.ndarray: The float32 raster with NODATA in the empty cells.
+        """
+        if output_type not in self.output_types:
+            raise ValueError(f'Output type {output_type} was not accumulated')
+        empty = self.count == 0
+        with np.errstate(invalid= 'ignore', divide= 'ignore'):
+            if output_type == 'min':
+                out = self.min.copy()
+            elif output_type == 'max':
+                out = self.max.copy()
+            elif output_type == 'mean':
+                out = (self.sum / self.count).astype(np.float32)
+            elif output_type == 'idw':
+                out = np.where(self.exact_count > 0, self.exact_sum / self.exact_count, self.weighted_sum / self.weights).astype(np.float32)
+            else:
+                return self.count.astype(np.float32)
+        out[empty] = NODATA
+        return out
+
+
+def strip_rows(grid, output_types, max_memory):
+    """Number of grid rows whose accumulators fit in a memory budget.
+
+    Args:
+        grid (dict): The grid from make_grid() or raster_grid().
+        output_types (list): The output types of the raster.
+        max_memory (int): Bytes for the accumulators.
+
+    Returns:
+        int: Rows per strip, a multiple of the 256 rows of the raster blocks when the budget allows it.
+    """
+    cell_bytes = 4 + sum(CELL_BYTES[output_type] for output_type in set(output_types))
+    rows = max(1, int(max_memory // (cell_bytes * grid['width'])))
+    return rows // 256 * 256 if rows >= 256 else rows
+
+
+def grid_laz(laz_fp, out_fp, resolution = 1.0, output_type = 'idw', radius = None, power = 2.0, grid = None, chunk_size = 1_000_000,
+             max_memory = 512 * 2**20):
+    """Rasterize a point cloud chunk by chunk without PDAL or ASP.
+
+    The raster is accumulated in strips of rows that fit in max_memory, so large rasters do not hold every cell in
+    memory. The point cloud is still read once: each chunk is binned into the strips within the search radius of its
+    points, which are spilled to a temporary file per strip next to the raster and accumulated strip by strip.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        out_fp (str): Filepath to save the raster.
+        resolution (float, optional): Size of the cells. Defaults to 1.0.
+        output_type (_type_, optional): 'min', 'max', 'mean', 'idw', 'count', a list of them for one band each, or 'all'. Defaults to 'idw'.
+        radius (float, optional): Search radius around the cell centers. Defaults to None which uses resolution * sqrt(2) like writers.gdal.
+        power (float, optional): Power of the idw weights. Defaults to 2.0.
+        grid (dict, optional): Grid to write to, e.g. to match another raster. Defaults to None which covers the point cloud like writers.gdal.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+        max_memory (int, optional): Bytes for the accumulators of a strip. Defaults to 512 MiB.
+
+    Returns:
+        str: Filepath to the raster.
+    """
+    import tempfile
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    if output_type == 'all':
+        output_type = list(OUTPUT_TYPES)
+    output_types = [output_type] if isinstance(output_type, str) else list(output_type)
+    if grid is None:
+        grid = make_grid(laz_fp, resolution)
+
+    laz_fps = pc_files(laz_fp)
+    with laspy.open(laz_fps[0]) as reader:
+        crs = reader.header.parse_crs()
+
+    res = grid['resolution']
+    if radius is None:
+        radius = res * math.sqrt(2)
+    top = grid['origin_y'] + grid['height'] * res
+    transform = from_origin(grid['origin_x'], top, res, res)
+    rows = strip_rows(grid, output_types, max_memory)
+    strips = [(first, min(first + rows, grid['height'])) for first in range(0, grid['height'], rows)]
+    os.makedirs(os.path.dirname(os.path.abspath(out_fp)), exist_ok= True)
+    with rasterio.open(out_fp, 'w', driver= 'GTiff', width= grid['width'], height= grid['height'], count= len(output_types),
+                       dtype= 'float32', nodata= NODATA, crs= crs, transform= transform,
+                       tiled= True, blockxsize= 256, blockysize= 256, compress= 'deflate') as dst:
+        if len(strips) == 1:
+            stats = GridAccumulator(grid, radius= radius, power= power, output_types= output_types)
+            for points, _ in iter_chunks(laz_fps, chunk_size):
+                stats.add(np.asarray(points.x), np.asarray(points.y), np.asarray(points.z))
+            for band, name in enumerate(output_types, start= 1):
+                dst.write(stats.result(name), band)
+        else:
+            with tempfile.TemporaryDirectory(dir= os.path.dirname(os.path.abspath(out_fp))) as spill_dir:
+                spill_fps = [os.path.join(spill_dir, f'strip-{i}.xyz') for i in range(len(strips))]
+                for points, _ in iter_chunks(laz_fps, chunk_size):
+                    xyz = np.column_stack([points.x, points.y, points.z]).astype(np.float64)
+                    for i, idx in bin_strips(xyz[:, 1], top, res, rows, radius, len(strips)):
+                        with open(spill_fps[i], 'ab') as f:
+                            xyz[idx].tofile(f)
+                for (first, last), spill_fp in zip(strips, spill_fps):
+                    stats = GridAccumulator(grid, radius= radius, power= power, output_types= output_types, rows= (first, last))
+                    if os.path.exists(spill_fp):
+                        xyz = np.memmap(spill_fp, dtype= np.float64, mode= 'r').reshape(-1, 3)
+                        for i in range(0, len(xyz), chunk_size):
+                            chunk = np.array(xyz[i:i + chunk_size])
+                            stats.add(chunk[:, 0], chunk[:, 1], chunk[:, 2])
+                        del xyz
+                    window = Window(0, first, grid['width'], last - first)
+                    for band, name in enumerate(output_types, start= 1):
+                        dst.write(stats.result(name), band, window= window)
+        for band, name in enumerate(output_types, start= 1):
+            dst.set_band_description(band, name)
+    return out_fp
+
+
+def bin_strips(y, top, res, rows, radius, n_strips):
+    """Indices of the points within the search radius of the cell centers of each strip of rows.
+
+    A point near the edge of a strip is binned into both strips, and the points of a strip keep their order.
+
+    Args:
+        y (np.ndarray): Y coordinates of the points.
+        top (float): Y coordinate of the top of the grid.
+        res (float): Size of the cells.
+        rows (int): Rows per strip, the last strip can be shorter.
+        radius (float): Search radius around the cell centers.
+        n_strips (int): Number of strips.
+
+    Yields:
+        tuple: Index of the strip and the indices of its points.
+    """
+    # the strips of the first and last rows whose cell centers can be within radius, with a margin for rounding
+    first = np.maximum(np.floor(((top - y - radius) / res - 0.5) / rows - 1e-9), 0).astype(np.int64)
+    last = np.minimum(np.floor(((top - y + radius) / res - 0.5) / rows + 1e-9), n_strips - 1).astype(np.int64)
+    span = np.maximum(last - first + 1, 0)
+    points = np.repeat(np.arange(len(y)), span)
+    strip = first[points] + np.arange(len(points)) - np.repeat(np.cumsum(span) - span, span)
+    # a stable sort by strip keeps the order of the points in each strip
+    order = np.argsort(strip, kind= 'stable')
+    strip, points = strip[order], points[order]
+    starts = np.flatnonzero(np.diff(strip, prepend= -1))
+    for i, idx in zip(strip[starts], np.split(points, starts[1:])):
+        yield int(i), idx
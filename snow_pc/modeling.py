@@ -1,13 +1,15 @@
 import os
 from os.path import dirname, join
-import json
-import subprocess
 import shutil
-from snow_pc.common import download_dem, make_dirs
+from snow_pc.common import download_dem, make_dirs, reader_stages
+from snow_pc.tiling import run_tiled
+from snow_pc.pipeline import run_pipeline
+from snow_pc.report import instrumented
 
 
 #combine the filters into a single function
-def terrain_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes'):
+@instrumented
+def terrain_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes', tile_size = None, buffer = 30, n_workers = None):
     """Use filters.dem, filters.mongo, filters.elm, filters.outlier, filters.smrf, and filters.range to filter the point cloud for terrain models.
 
     Args:
@@ -19,12 +21,16 @@ def terrain_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
         dem_high (int, optional): _description_. Defaults to 50.
         mean_k (int, optional): _description_. Defaults to 20.
         multiplier (int, optional): _description_. Defaults to 3.
+        tile_size (int, optional): Width of the tiles for tiled processing. Defaults to None which processes the whole point cloud at once.
+            filters.elm and filters.outlier still run once over the whole point cloud (see tiling.run_tiled).
+        buffer (int, optional): Overlap added around each tile for tiled processing. Defaults to 30.
+        n_workers (int, optional): Number of tiles run at the same time for tiled processing. Defaults to None which uses all cores.
 
     Returns:
         _type_: Filepath to the terrain model.
     """
     #set the working directory
-    in_dir = os.path.dirname(laz_fp)
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
     # os.chdir(in_dir)
 
     #create a filepath for the output las and tif file
@@ -46,10 +52,7 @@ def terrain_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
         #create a json pipeline for pdal
         json_pipeline = {
             "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
+                *reader_stages(laz_fp),
                 {
                     "type": "filters.dem",
                     "raster": dem_fp,
@@ -96,10 +99,7 @@ def terrain_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
         #create a json pipeline for pdal
         json_pipeline = {
             "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
+                *reader_stages(laz_fp),
                 {
                     "type": "filters.dem",
                     "raster": dem_fp,
@@ -137,22 +137,16 @@ def terrain_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
             ]
         }
 
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'dtm_pipeline'
-    json_to_use = join(json_dir, f'{json_name}.json')
-
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    #run the json pipeline, tile by tile if a tile size is given
+    if tile_size is not None:
+        run_tiled(json_pipeline, tile_size= tile_size, buffer= buffer, n_workers= n_workers)
+    else:
+        run_pipeline(json_pipeline, json_fp = join(in_dir, 'jsons', 'dtm_pipeline.json'))
 
     return outlas, outtif
 
-def surface_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes'):
+@instrumented
+def surface_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes', tile_size = None, buffer = 30, n_workers = None):
     """Use filters.dem, filters.mongo, filters.elm, filters.outlier, filters.smrf, and filters.range to filter the point cloud for surface models.
 
     Args:
@@ -164,12 +158,16 @@ def surface_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
         dem_high (int, optional): _description_. Defaults to 50.
         mean_k (int, optional): _description_. Defaults to 20.
         multiplier (int, optional): _description_. Defaults to 3.
-    
+        tile_size (int, optional): Width of the tiles for tiled processing. Defaults to None which processes the whole point cloud at once.
+            filters.elm and filters.outlier still run once over the whole point cloud (see tiling.run_tiled).
+        buffer (int, optional): Overlap added around each tile for tiled processing. Defaults to 30.
+        n_workers (int, optional): Number of tiles run at the same time for tiled processing. Defaults to None which uses all cores.
+
     Returns:
         _type_: Filepath to the terrain model.
     """
     #set the working directory
-    in_dir = os.path.dirname(laz_fp)
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
     # os.chdir(in_dir)
 
     #create a filepath for the output las and tif file
@@ -191,10 +189,7 @@ def surface_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
         #create a json pipeline for pdal
         json_pipeline = {
             "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
+                *reader_stages(laz_fp),
                 {
                     "type": "filters.dem",
                     "raster": dem_fp,
@@ -236,10 +231,7 @@ def surface_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
         #create a json pipeline for pdal
         json_pipeline = {
             "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_fp
-                },
+                *reader_stages(laz_fp),
                 {
                     "type": "filters.dem",
                     "raster": dem_fp,
@@ -272,17 +264,188 @@ def surface_models(laz_fp, outlas = '', outtif = '', user_dem = '', dem_low = 20
             ]
         }
 
-    #create a directory to save the json pipeline
-    json_dir =  join(in_dir, 'jsons')
-    os.makedirs(json_dir, exist_ok= True)
-    json_name = 'dsm_pipeline'
-    json_to_use = join(json_dir, f'{json_name}.json')
+    #run the json pipeline, tile by tile if a tile size is given
+    if tile_size is not None:
+        run_tiled(json_pipeline, tile_size= tile_size, buffer= buffer, n_workers= n_workers)
+    else:
+        run_pipeline(json_pipeline, json_fp = join(in_dir, 'jsons', 'dsm_pipeline.json'))
+
+    return outlas, outtif
+
+def elevation_pipeline(laz_fp, dem_fp, dtm_las, dtm_tif, dsm_las, dsm_tif, dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes'):
+    """Build a PDAL pipeline that filters the point cloud once and writes both the terrain and surface models.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file.
+        dem_fp (_type_): Filepath to the reference DEM used by filters.dem.
+        dtm_las (_type_): Filepath to save the output terrain las file.
+        dtm_tif (_type_): Filepath to save the output terrain tif file.
+        dsm_las (_type_): Filepath to save the output surface las file.
+        dsm_tif (_type_): Filepath to save the output surface tif file.
+        dem_low (int, optional): Lower limit of the DEM filter. Defaults to 20.
+        dem_high (int, optional): Upper limit of the DEM filter. Defaults to 50.
+        mean_k (int, optional): Number of neighbors for the outlier filter. Defaults to 20.
+        multiplier (int, optional): Standard deviation multiplier for the outlier filter. Defaults to 3.
+        lidar_pc (str, optional): 'yes' for lidar point clouds, anything else for SfM point clouds. Defaults to 'yes'.
+
+    Returns:
+        dict: The json pipeline.
+    """
+    #shared filters, run once for both models
+    stages = [
+        *reader_stages(laz_fp),
+        {
+            "type": "filters.dem",
+            "raster": dem_fp,
+            "limits": f"Z[{dem_low}:{dem_high}]"
+        }
+    ]
+    if lidar_pc.lower() == 'yes':
+        stages.append({
+            "type": "filters.mongo",
+            "expression": {"$and": [
+            {"ReturnNumber": {"$gt": 0}},
+            {"NumberOfReturns": {"$gt": 0}} ] }
+        })
+    stages += [
+        {
+            "type": "filters.elm"
+        },
+        {
+            "type": "filters.outlier",
+            "method": "statistical",
+            "mean_k": mean_k,
+            "multiplier": multiplier,
+            "tag": "filtered"
+        }
+    ]
+
+    #surface branch. This goes first so its points are written before filters.smrf reclassifies the shared points
+    if lidar_pc.lower() == 'yes':
+        dsm_limits = "returnnumber[1:1]"
+    else:
+        dsm_limits = "Classification[2:6]"
+    stages += [
+        {
+            "type": "filters.range",
+            "limits": dsm_limits,
+            "inputs": ["filtered"]
+        },
+        {
+            "type": "writers.las",
+            "filename": dsm_las,
+            "major_version": 1,
+            "minor_version": 2
+        },
+        {
+            "type": "writers.gdal",
+            "filename": dsm_tif,
+            "resolution": 1.0,
+            "output_type": "idw",
+            "tag": "dsm"
+        }
+    ]
+
+    #terrain branch
+    if lidar_pc.lower() == 'yes':
+        stages.append({
+            "type": "filters.smrf",
+            "ignore": "Classification[7:7], NumberOfReturns[0:0], ReturnNumber[0:0]",
+            "inputs": ["filtered"]
+        })
+        stages.append({
+            "type": "filters.range",
+            "limits": "Classification[2:2]"
+        })
+    else:
+        stages.append({
+            "type": "filters.range",
+            "limits": "Classification[2:2]",
+            "inputs": ["filtered"]
+        })
+    stages += [
+        {
+            "type": "writers.las",
+            "filename": dtm_las,
+            "major_version": 1,
+            "minor_version": 2
+        },
+        {
+            "type": "writers.gdal",
+            "filename": dtm_tif,
+            "resolution": 1.0,
+            "output_type": "idw",
+            "tag": "dtm"
+        },
+        #join the two branches so the pipeline has a single end stage
+        {
+            "type": "filters.merge",
+            "inputs": ["dsm", "dtm"]
+        }
+    ]
+    json_pipeline = {"pipeline": stages}
+
+    return json_pipeline
+
+
+@instrumented
+def elevation_models(laz_fp, dtm_las = '', dtm_tif = '', dsm_las = '', dsm_tif = '', user_dem = '', dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes', tile_size = None, buffer = 30, n_workers = None):
+    """Create the terrain and surface models in a single PDAL pipeline.
 
-    #write json pipeline to file
-    with open(json_to_use, 'w') as f:
-        json.dump(json_pipeline, f)
-        
-    #run the json pipeline
-    subprocess.run(["pdal", "pipeline", json_to_use])
+    The point cloud is read and passed through filters.dem, filters.mongo, filters.elm and filters.outlier
+    only once. The filtered points are then branched into the ground (filters.smrf + filters.range) and the
+    surface (first return) outputs, so the shared filtering is not repeated as it is when terrain_models and
+    surface_models are called one after the other.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file.
+        dtm_las (str, optional): Filepath to save the output terrain las file. Defaults to ''.
+        dtm_tif (str, optional): Filepath to save the output terrain tif file. Defaults to ''.
+        dsm_las (str, optional): Filepath to save the output surface las file. Defaults to ''.
+        dsm_tif (str, optional): Filepath to save the output surface tif file. Defaults to ''.
+        user_dem (str, optional): Filepath to the dem file. Defaults to ''.
+        dem_low (int, optional): Lower limit of the DEM filter. Defaults to 20.
+        dem_high (int, optional): Upper limit of the DEM filter. Defaults to 50.
+        mean_k (int, optional): Number of neighbors for the outlier filter. Defaults to 20.
+        multiplier (int, optional): Standard deviation multiplier for the outlier filter. Defaults to 3.
+        lidar_pc (str, optional): 'yes' for lidar point clouds, anything else for SfM point clouds. Defaults to 'yes'.
+        tile_size (int, optional): Width of the tiles for tiled processing. Defaults to None which processes the whole point cloud at once.
+            filters.elm and filters.outlier still run once over the whole point cloud (see tiling.run_tiled).
+        buffer (int, optional): Overlap added around each tile for tiled processing. Defaults to 30.
+        n_workers (int, optional): Number of tiles run at the same time for tiled processing. Defaults to None which uses all cores.
+
+    Returns:
+        _type_: Filepaths to the terrain laz and tif and the surface laz and tif.
+    """
+    #set the working directory
+    in_dir = os.path.dirname(os.path.abspath(laz_fp))
+
+    #create filepaths for the output las and tif files
+    if dtm_las == '':
+        dtm_las = join(in_dir, 'dtm.laz')
+    if dtm_tif == '':
+        dtm_tif = join(in_dir, 'dtm.tif')
+    if dsm_las == '':
+        dsm_las = join(in_dir, 'dsm.laz')
+    if dsm_tif == '':
+        dsm_tif = join(in_dir, 'dsm.tif')
+
+    #set dem_fp
+    dem_fp = join(in_dir, 'dem.tif')
+
+    #download dem using download_dem() if user_dem is not provided
+    if user_dem == '':
+        dem_fp, crs, project = download_dem(laz_fp, dem_fp= dem_fp)
+    else:
+        shutil.copy(user_dem, dem_fp) #if user_dem is provided, copy the user_dem to dem_fp
+
+    #build the branched pipeline
+    json_pipeline = elevation_pipeline(laz_fp, dem_fp, dtm_las, dtm_tif, dsm_las, dsm_tif, dem_low = dem_low, dem_high = dem_high, mean_k = mean_k, multiplier = multiplier, lidar_pc = lidar_pc)
+
+    #run the json pipeline, tile by tile if a tile size is given
+    if tile_size is not None:
+        run_tiled(json_pipeline, tile_size= tile_size, buffer= buffer, n_workers= n_workers)
+    else:
+        run_pipeline(json_pipeline, json_fp = join(in_dir, 'jsons', 'dtm_dsm_pipeline.json'))
 
-    return outlas, outtif
\ No newline at end of file
+    return dtm_las, dtm_tif, dsm_las, dsm_tif
@@ -0,0 +1,281 @@
+import os
+import laspy
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from snow_pc.common import pc_files, iter_chunks, copy_header, rescale_points
+
+# class of the noise points, as set by filters.outlier and filters.elm
+NOISE = 7
+
+
+def read_xyz(laz_fp, chunk_size = 1_000_000):
+    """Read the coordinates of a point cloud.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        np.ndarray: The (n, 3) coordinates in the order the points are read.
+    """
+    chunks = [np.column_stack([points.x, points.y, points.z]) for points, _ in iter_chunks(pc_files(laz_fp), chunk_size)]
+    return np.concatenate(chunks) if len(chunks) > 0 else np.empty((0, 3))
+
+def classify_chunked(laz_fp, out_fp, noise, chunk_size = 1_000_000):
+    """Write a point cloud chunk by chunk with the noise points set to class 7.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        out_fp (str): Filepath to save the output las file.
+        noise (_type_): Mask of the noise points in the order the points are read, or a function that takes a chunk of
+            points and returns the mask of its noise points.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        str: Filepath to the output las file.
+    """
+    laz_fps = pc_files(laz_fp)
+    with laspy.open(laz_fps[0]) as reader:
+        header = copy_header(reader.header)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_fp)), exist_ok= True)
+    start = 0
+    with laspy.open(out_fp, mode= 'w', header= header) as writer:
+        for points, _ in iter_chunks(laz_fps, chunk_size):
+            points = rescale_points(points, header)
+            chunk_noise = noise(points) if callable(noise) else noise[start:start + len(points)]
+            if chunk_noise.any():
+                classification = np.asarray(points.classification).copy()
+                classification[chunk_noise] = NOISE
+                points.classification = classification
+            writer.write_points(points)
+            start += len(points)
+    return out_fp
+
+
+def mean_knn_distances(xyz, mean_k = 20, tile_size = 500.0, buffer = 30.0, n_workers = None):
+    """Mean 3D distance of every point to its mean_k nearest neighbors, like filters.outlier.
+
+    The points are split into tiles in x and y and each tile builds its own KD-tree over the tile and a buffer
+    around it, so the trees stay small and the tiles are queried by parallel threads. A point whose nearest
+    neighbors could lie beyond the buffer is queried again with a wider buffer, so the distances are the same
+    as with one tree over the whole cloud.
+
+    Args:
+        xyz (np.ndarray): The (n, 3) coordinates.
+        mean_k (int, optional): Number of neighbors. Defaults to 20.
+        tile_size (float, optional): Width of the tiles. Defaults to 500.0.
+        buffer (float, optional): Width of the buffer around the tiles. Defaults to 30.0.
+        n_workers (int, optional): Number of threads. Defaults to None which uses all cores.
+
+    Returns:
+        np.ndarray: The mean distances.
+    """
+    from scipy.spatial import cKDTree
+
+    n = len(xyz)
+    k = min(mean_k, n - 1)
+    distances = np.zeros(n)
+    if k < 1:
+        return distances
+
+    mins, maxs = xyz[:, :2].min(axis= 0), xyz[:, :2].max(axis= 0)
+    shape = np.floor((maxs - mins) / tile_size).astype(np.int64) + 1
+    tile_xy = np.minimum(np.floor((xyz[:, :2] - mins) / tile_size).astype(np.int64), shape - 1)
+    tile_id = tile_xy[:, 1] * shape[0] + tile_xy[:, 0]
+    # the points of each tile are a slice of the points sorted by tile
+    order = np.argsort(tile_id, kind= 'stable')
+    ids, starts, counts = np.unique(tile_id[order], return_index= True, return_counts= True)
+    slices = {int(i): order[s:s + c] for i, s, c in zip(ids, starts, counts)}
+
+    def run(tile):
+        tx, ty = tile % shape[0], tile // shape[0]
+        lo = mins + np.array([tx, ty]) * tile_size
+        hi = lo + tile_size
+        pending = slices[tile]
+        width = buffer
+        while len(pending) > 0:
+            # the points of the tiles within width of this tile and then of the buffered bounds
+            ring = int(np.ceil(width / tile_size))
+            near = [slices[int(j * shape[0] + i)] for j in range(max(ty - ring, 0), min(ty + ring + 1, shape[1]))
+                    for i in range(max(tx - ring, 0), min(tx + ring + 1, shape[0])) if int(j * shape[0] + i) in slices]
+            candidates = np.concatenate(near)
+            inside = np.all((xyz[candidates, :2] >= lo - width) & (xyz[candidates, :2] <= hi + width), axis= 1)
+            candidates = candidates[inside]
+            d, _ = cKDTree(xyz[candidates]).query(xyz[pending], k= k + 1)
+            # the first neighbor is the point itself
+            d = d[:, 1:]
+            # a point outside the buffer is further than the nearest buffer edge that has points beyond it
+            edge = np.full(len(pending), np.inf)
+            for axis in range(2):
+                if lo[axis] - width > mins[axis]:
+                    edge = np.minimum(edge, xyz[pending, axis] - (lo[axis] - width))
+                if hi[axis] + width < maxs[axis]:
+                    edge = np.minimum(edge, hi[axis] + width - xyz[pending, axis])
+            exact = d[:, -1] <= edge
+            distances[pending[exact]] = d[exact].mean(axis= 1)
+            if not exact.all():
+                # a tile with too few points to find all neighbors returns infinite distances
+                farthest = d[~exact, -1]
+                farthest = farthest[np.isfinite(farthest)]
+                width = max(width * 2, tile_size, float(farthest.max()) if len(farthest) > 0 else 0)
+            pending = pending[~exact]
+
+    with ThreadPoolExecutor(max_workers= n_workers) as executor:
+        list(executor.map(run, slices))
+    return distances
+
+def statistical_outliers(xyz, mean_k = 20, multiplier = 3, tile_size = 500.0, buffer = 30.0, n_workers = None):
+    """Find the outliers of filters.outlier with the statistical method.
+
+    A point is an outlier when the mean distance to its mean_k nearest neighbors is at least the mean of these
+    distances over the whole cloud plus multiplier standard deviations.
+
+    Args:
+        xyz (np.ndarray): The (n, 3) coordinates.
+        mean_k (int, optional): Number of neighbors. Defaults to 20.
+        multiplier (int, optional): Standard deviation multiplier. Defaults to 3.
+        tile_size (float, optional): Width of the tiles of the KD-trees. Defaults to 500.0.
+        buffer (float, optional): Width of the buffer around the tiles. Defaults to 30.0.
+        n_workers (int, optional): Number of threads. Defaults to None which uses all cores.
+
+    Returns:
+        np.ndarray: Mask of the outliers.
+    """
+    distances = mean_knn_distances(xyz, mean_k, tile_size, buffer, n_workers)
+    if len(distances) < 2:
+        return np.zeros(len(distances), dtype= bool)
+    threshold = distances.mean() + multiplier * distances.std(ddof= 1)
+    return distances >= threshold
+
+def outlier_filter_native(laz_fp, out_fp, mean_k = 20, multiplier = 3, tile_size = 500.0, buffer = 30.0, n_workers = None, chunk_size = 1_000_000):
+    """Classify the statistical outliers as class 7 without PDAL, a drop-in for filters.outlier.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        out_fp (str): Filepath to save the output las file.
+        mean_k (int, optional): Number of neighbors. Defaults to 20.
+        multiplier (int, optional): Standard deviation multiplier. Defaults to 3.
+        tile_size (float, optional): Width of the tiles of the KD-trees. Defaults to 500.0.
+        buffer (float, optional): Width of the buffer around the tiles. Defaults to 30.0.
+        n_workers (int, optional): Number of threads. Defaults to None which uses all cores.
+        chunk_size (int, optional): Number of points read and written at a time. Defaults to 1_000_000.
+
+    Returns:
+        str: Filepath to the output las file.
+    """
+    outliers = statistical_outliers(read_xyz(laz_fp, chunk_size), mean_k, multiplier, tile_size, buffer, n_workers)
+    return classify_chunked(laz_fp, out_fp, outliers, chunk_size)
+
+
+def elm_grid(laz_fp, cell = 10.0):
+    """Grid of the cells of filters.elm over the bounds of a point cloud.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        cell (float, optional): Size of the cells. Defaults to 10.0.
+
+    Returns:
+        dict: origin_x, origin_y (lower left corner), cell, width and height of the grid.
+    """
+    mins, maxs = [], []
+    for fp in pc_files(laz_fp):
+        with laspy.open(fp) as reader:
+            mins.append(reader.header.mins)
+            maxs.append(reader.header.maxs)
+    minx, miny = np.min(mins, axis= 0)[:2]
+    maxx, maxy = np.max(maxs, axis= 0)[:2]
+    return {'origin_x': float(minx), 'origin_y': float(miny), 'cell': float(cell),
+            'width': int((maxx - minx) / cell) + 1, 'height': int((maxy - miny) / cell) + 1}
+
+def elm_cells(grid, x, y):
+    """Flat index of the cell of each point, computed the way filters.elm does, which floors the offset before dividing by the cell size."""
+    col = np.clip(np.floor(np.floor(x - grid['origin_x']) / grid['cell']).astype(np.int64), 0, grid['width'] - 1)
+    row = np.clip(np.floor(np.floor(y - grid['origin_y']) / grid['cell']).astype(np.int64), 0, grid['height'] - 1)
+    return row * grid['width'] + col
+
+def lowest_per_cell(laz_fp, grid, depth = 16, chunk_size = 1_000_000):
+    """The lowest elevations of every cell, in one pass over the point cloud.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        grid (dict): The grid from elm_grid().
+        depth (int, optional): Number of elevations kept per cell. Defaults to 16.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        tuple: The (cells, depth) lowest elevations in ascending order padded with inf, and the number of points of each cell.
+    """
+    n_cells = grid['width'] * grid['height']
+    lowest = np.full((n_cells, depth), np.inf)
+    counts = np.zeros(n_cells, dtype= np.int64)
+    for points, _ in iter_chunks(pc_files(laz_fp), chunk_size):
+        cells = elm_cells(grid, np.asarray(points.x), np.asarray(points.y))
+        counts += np.bincount(cells, minlength= n_cells)
+        # merge the kept elevations of the cells of the chunk with the elevations of the chunk
+        touched = np.unique(cells)
+        kept = lowest[touched]
+        finite = np.isfinite(kept)
+        z = np.concatenate([kept[finite], np.asarray(points.z)])
+        c = np.concatenate([np.broadcast_to(touched[:, np.newaxis], kept.shape)[finite], cells])
+        order = np.lexsort((z, c))
+        z, c = z[order], c[order]
+        first = np.searchsorted(c, c, side= 'left')
+        rank = np.arange(len(c)) - first
+        keep = rank < depth
+        lowest[touched] = np.inf
+        lowest[c[keep], rank[keep]] = z[keep]
+    return lowest, counts
+
+def elm_cutoffs(laz_fp, cell = 10.0, threshold = 1.0, depth = 16, chunk_size = 1_000_000):
+    """Elevation of each cell below which filters.elm marks the points as noise.
+
+    filters.elm sorts the points of a cell by elevation and walks up from the lowest point; while the gap to the
+    next point is larger than threshold the points below the gap are noise. Only the lowest points of each cell
+    are needed for that, so the point cloud is streamed and the memory is set by the number of cells and depth.
+    Cells whose noise goes deeper than depth points are resolved by repeating the pass with a larger depth.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        cell (float, optional): Size of the cells. Defaults to 10.0 like filters.elm.
+        threshold (float, optional): Elevation gap that separates noise. Defaults to 1.0 like filters.elm.
+        depth (int, optional): Number of elevations kept per cell in the first pass. Defaults to 16.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        tuple: The grid from elm_grid() and the cutoff elevation of each cell, -inf for the cells without noise.
+    """
+    grid = elm_grid(laz_fp, cell)
+    while True:
+        lowest, counts = lowest_per_cell(laz_fp, grid, depth, chunk_size)
+        n_kept = np.minimum(counts, depth)
+        gaps = np.diff(lowest, axis= 1)
+        # gaps between the kept elevations, the gaps to the padding are not real
+        real = np.arange(depth - 1)[np.newaxis, :] < (n_kept - 1)[:, np.newaxis]
+        supported = real & ~(gaps > threshold)
+        has_support = supported.any(axis= 1)
+        unresolved = ~has_support & (counts > depth)
+        if unresolved.any():
+            depth *= 2
+            continue
+        # the first point with a small gap above it is not noise, nor is the highest point of a cell
+        first = np.where(has_support, np.argmax(supported, axis= 1), np.maximum(n_kept - 1, 0))
+        cutoffs = np.where(counts > 0, lowest[np.arange(len(counts)), first], -np.inf)
+        return grid, cutoffs
+
+def elm_filter_native(laz_fp, out_fp, cell = 10.0, threshold = 1.0, chunk_size = 1_000_000):
+    """Classify the low noise of filters.elm as class 7 without PDAL.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        out_fp (str): Filepath to save the output las file.
+        cell (float, optional): Size of the cells. Defaults to 10.0.
+        threshold (float, optional): Elevation gap that separates noise. Defaults to 1.0.
+        chunk_size (int, optional): Number of points read and written at a time. Defaults to 1_000_000.
+
+    Returns:
+        str: Filepath to the output las file.
+    """
+    grid, cutoffs = elm_cutoffs(laz_fp, cell, threshold, chunk_size= chunk_size)
+    is_noise = lambda points: np.asarray(points.z) < cutoffs[elm_cells(grid, np.asarray(points.x), np.asarray(points.y))]
+    return classify_chunked(laz_fp, out_fp, is_noise, chunk_size)
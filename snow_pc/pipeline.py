@@ -0,0 +1,125 @@
+import os
+import json
+import subprocess
+import tempfile
+
+# 'python' runs pipelines in-process with the python-pdal bindings, 'subprocess' runs `pdal pipeline`,
+# and 'auto' uses the bindings when they are installed
+DEFAULT_BACKEND = os.environ.get('SNOW_PC_PDAL_BACKEND', 'auto')
+
+
+class PipelineError(Exception):
+    """Raised when a PDAL pipeline or an external tool fails."""
+
+
+def has_python_pdal():
+    """Check if the python-pdal bindings are installed.
+
+    Returns:
+        bool: True if `import pdal` works.
+    """
+    try:
+        import pdal  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def run_command(command):
+    """Run an external tool, e.g. pdal merge or pc_align, and check its exit code.
+
+    Args:
+        command (list): The executable and its arguments.
+
+    Raises:
+        PipelineError: If the tool is not found or exits with an error.
+
+    Returns:
+        str: What the tool printed.
+    """
+    try:
+        result = subprocess.run([str(arg) for arg in command], capture_output= True, text= True)
+    except FileNotFoundError as e:
+        raise PipelineError(f'{command[0]} is not installed') from e
+    if result.returncode != 0:
+        raise PipelineError(f'{os.path.basename(str(command[0]))} failed with exit code {result.returncode}: {result.stderr.strip()}')
+    return result.stdout
+
+def run_pipeline(json_pipeline, json_fp = '', backend = None, arrays = None, return_arrays = False):
+    """Run a PDAL pipeline and return the points and the metadata.
+
+    Args:
+        json_pipeline (dict): The json pipeline.
+        json_fp (str, optional): Filepath to save the json pipeline for the subprocess backend. Defaults to '' which uses a temporary file.
+        backend (str, optional): 'python', 'subprocess' or 'auto'. Defaults to None which uses DEFAULT_BACKEND.
+        arrays (list, optional): Numpy arrays of points to use as the input of the pipeline instead of a reader. Only for the python backend. Defaults to None.
+        return_arrays (bool, optional): Return the points of the last stage. Only for the python backend. Defaults to False which
+            does not copy the points out of PDAL, e.g. for pipelines that end with a writer.
+
+    Raises:
+        PipelineError: If the pipeline fails.
+
+    Returns:
+        tuple: The point arrays of the last stage (empty unless return_arrays) and the metadata.
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend == 'auto':
+        backend = 'python' if has_python_pdal() else 'subprocess'
+
+    if backend == 'python':
+        return _run_python(json_pipeline, arrays, return_arrays)
+    elif backend == 'subprocess':
+        if arrays is not None or return_arrays:
+            raise PipelineError('Input and output arrays need the python backend')
+        return _run_subprocess(json_pipeline, json_fp)
+    else:
+        raise ValueError(f'Unknown pipeline backend: {backend}')
+
+def _run_python(json_pipeline, arrays = None, return_arrays = False):
+    """Run a pipeline in-process with the python-pdal bindings."""
+    import pdal
+
+    if arrays is not None:
+        pipeline = pdal.Pipeline(json.dumps(json_pipeline), arrays= arrays)
+    else:
+        pipeline = pdal.Pipeline(json.dumps(json_pipeline))
+    try:
+        pipeline.execute()
+    except RuntimeError as e:
+        raise PipelineError(str(e)) from e
+    metadata = pipeline.metadata
+    # older bindings return the metadata as a json string
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    return (list(pipeline.arrays) if return_arrays else []), metadata
+
+def _run_subprocess(json_pipeline, json_fp = ''):
+    """Run a pipeline with `pdal pipeline` and check its exit code."""
+    temporary = json_fp == ''
+    if temporary:
+        fd, json_fp = tempfile.mkstemp(suffix= '.json')
+        os.close(fd)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(json_fp)), exist_ok= True)
+    metadata_fp = os.path.splitext(json_fp)[0] + '_metadata.json'
+    try:
+        with open(json_fp, 'w') as f:
+            json.dump(json_pipeline, f)
+        try:
+            result = subprocess.run(["pdal", "pipeline", json_fp, "--metadata", metadata_fp], capture_output= True, text= True)
+        except FileNotFoundError as e:
+            raise PipelineError('pdal is not installed') from e
+        if result.returncode != 0:
+            raise PipelineError(f'pdal pipeline {json_fp} failed with exit code {result.returncode}: {result.stderr.strip()}')
+
+        metadata = {}
+        if os.path.exists(metadata_fp):
+            with open(metadata_fp) as f:
+                metadata = json.load(f)
+        return [], metadata
+    finally:
+        # the temporary pipeline and its metadata are removed, a pipeline saved where asked is kept
+        if temporary:
+            for fp in (json_fp, metadata_fp):
+                if os.path.exists(fp):
+                    os.remove(fp)
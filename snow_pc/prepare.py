@@ -1,11 +1,16 @@
 import logging
 import os
+import json
 import subprocess
 from glob import glob
 from os.path import isdir, join
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import laspy
 
 from snow_pc.common import make_dirs
+from snow_pc.pipeline import run_command
+from snow_pc.report import instrumented
 
 def replace_white_spaces(in_dir, replace = ''):
     """Remove any white space in the point cloud files. 
@@ -28,24 +33,69 @@ def replace_white_spaces(in_dir, replace = ''):
         print(f'Passing...')
 
 
-def las2laz(in_dir: str):
+def _laz_is_current(las_fp, laz_fp):
+    """Check if a LAZ file is newer than its LAS file and holds the same number of points."""
+    if not os.path.exists(laz_fp) or os.path.getmtime(laz_fp) < os.path.getmtime(las_fp):
+        return False
+    try:
+        with laspy.open(las_fp) as las, laspy.open(laz_fp) as laz:
+            return las.header.point_count == laz.header.point_count
+    except Exception:
+        # an unreadable LAZ file, e.g. from an interrupted conversion, is converted again
+        return False
+
+def _translate(las_fp, laz_fp):
+    """Convert one LAS file to LAZ with pdal translate and return the exit code and error message."""
+    try:
+        result = subprocess.run(['pdal', 'translate', las_fp, laz_fp], capture_output= True, text= True)
+    except FileNotFoundError as e:
+        return 127, str(e)
+    return result.returncode, result.stderr.strip()
+
+def las2laz(in_dir: str, n_workers: int = 4, overwrite: bool = False):
     """Convert all LAS files in a directory to LAZ files.
 
+    The conversions run concurrently. A LAS file is skipped when its LAZ file exists, is newer and holds the
+    same number of points.
+
     Args:
         in_dir (str): The directory containing the LAS files to convert.
+        n_workers (int, optional): Maximum number of conversions running at once. Defaults to 4.
+        overwrite (bool, optional): Convert every LAS file even if its LAZ file is up to date. Defaults to False.
+
+    Returns:
+        dict: The converted, skipped and failed LAS files. Failed files are listed with their exit code and error message.
     """
 
     assert isdir(in_dir), f'{in_dir} is not a directory'
 
     # Get a list of all LAS files in the directory
-    las_files = [file for file in os.listdir(in_dir) if file.endswith('.las')]
-
-    # Iterate over each LAS file and convert it to LAZ
-    for las_file in las_files:
-        input_path = os.path.join(in_dir, las_file)
-        output_path = os.path.join(in_dir, os.path.splitext(las_file)[0] + '.laz')
-        subprocess.run(['pdal', 'translate', input_path, output_path])
-        print(f"Converted {input_path} to {output_path}")
+    las_files = sorted(os.path.join(in_dir, file) for file in os.listdir(in_dir) if file.endswith('.las'))
+
+    summary = {'converted': [], 'skipped': [], 'failed': []}
+    jobs = {}
+    for input_path in las_files:
+        output_path = os.path.splitext(input_path)[0] + '.laz'
+        if not overwrite and _laz_is_current(input_path, output_path):
+            summary['skipped'].append(input_path)
+        else:
+            jobs[input_path] = output_path
+
+    # Convert the remaining LAS files, a few at a time
+    with ThreadPoolExecutor(max_workers= n_workers) as pool:
+        futures = {pool.submit(_translate, input_path, output_path): input_path for input_path, output_path in jobs.items()}
+        for future in as_completed(futures):
+            input_path = futures[future]
+            returncode, stderr = future.result()
+            if returncode == 0:
+                summary['converted'].append(input_path)
+                print(f"Converted {input_path} to {jobs[input_path]}")
+            else:
+                summary['failed'].append((input_path, returncode, stderr))
+                print(f"Error: converting {input_path} failed with exit code {returncode}: {stderr}")
+
+    print(f"LAS to LAZ: {len(summary['converted'])} converted, {len(summary['skipped'])} up to date, {len(summary['failed'])} failed")
+    return summary
 
         
 def merge_laz_files(in_dir, out_fp = 'unaligned_merged.laz'):
@@ -68,18 +118,53 @@ def merge_laz_files(in_dir, out_fp = 'unaligned_merged.laz'):
     
     # Execute the merge command
     print(f'Running command: {command}')
-    subprocess.run(command)
+    run_command(command)
     print(f"Merged {len(laz_files)} LAZ files into {mosaic_fp}")
 
-def prepare_pc(in_dir: str, replace: str = ''):
+def write_manifest(laz_files, out_fp):
+    """Write a manifest of LAZ files with their header bounds and point counts.
+
+    The manifest is read by the filtering and modeling functions as one reader per file, so the point clouds
+    do not need to be merged or copied before processing.
+
+    Args:
+        laz_files (list): Filepaths to the LAZ files.
+        out_fp (str): Filepath to save the manifest.
+
+    Returns:
+        str: Filepath to the manifest.
+    """
+    files = []
+    for laz_file in sorted(laz_files):
+        with laspy.open(laz_file) as las:
+            hdr = las.header
+            files.append({
+                "filename": os.path.abspath(laz_file),
+                "bounds": [float(hdr.mins[0]), float(hdr.mins[1]), float(hdr.maxs[0]), float(hdr.maxs[1]), float(hdr.mins[2]), float(hdr.maxs[2])],
+                "point_count": int(hdr.point_count)
+            })
+    assert len(files) > 0, f'No LAZ files to write to {out_fp}'
+
+    bounds = [min(f["bounds"][0] for f in files), min(f["bounds"][1] for f in files),
+              max(f["bounds"][2] for f in files), max(f["bounds"][3] for f in files),
+              min(f["bounds"][4] for f in files), max(f["bounds"][5] for f in files)]
+    manifest = {"files": files, "bounds": bounds, "point_count": sum(f["point_count"] for f in files)}
+    with open(out_fp, 'w') as f:
+        json.dump(manifest, f, indent = 2)
+    print(f"Wrote manifest of {len(files)} LAZ files to {out_fp}")
+    return out_fp
+
+@instrumented
+def prepare_pc(in_dir: str, replace: str = '', merge: bool = False):
     """Prepare point cloud data for processing.
 
     Args:
         in_dir (str): Path to the directory containing the point cloud files.
         replace (str, optional): Character to replace the white space. Defaults to ''.
+        merge (bool, optional): Write a merged LAZ file instead of a manifest of the LAZ files. Defaults to False.
 
     Returns:
-        str: Path to the merged LAZ file.
+        str: Path to the manifest of the LAZ files, or to the merged LAZ file if merge is True.
     """
 
     # checks on directory and user update
@@ -88,9 +173,9 @@ def prepare_pc(in_dir: str, replace: str = ''):
     #checks if there is at least one file in the directory
     assert len(glob(join(in_dir, '*'))) > 0, f'No files found in {in_dir}'
 
-    #change to the directory
+    #resolve the directory so the outputs do not depend on the working directory
+    in_dir = os.path.abspath(in_dir)
     print(f"Working in directory: {in_dir}")
-    os.chdir(in_dir)
 
     # set up sub directories
     results_dir = make_dirs(in_dir)
@@ -109,6 +194,10 @@ def prepare_pc(in_dir: str, replace: str = ''):
             las2laz(in_dir)
             break
     
+    # list the laz files in a manifest that is read directly by the pipelines
+    if not merge:
+        return write_manifest(glob(join(in_dir, '*.laz')), join(results_dir, 'unfiltered.json'))
+
     # mosaic
     # if there is more than 1 laz file, merge them
     if len(glob(join(in_dir, '*.laz'))) > 1:
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, where the memory of the stages is not reported
+    resource = None
+
+# how often the resident memory of the process is sampled during a stage, in seconds
+SAMPLE_INTERVAL = 0.05
+
+_lock = threading.Lock()
+# the report of the run of the current thread or task, so runs in threads of one process keep their own report
+_active = contextvars.ContextVar('snow_pc_run_report', default= None)
+
+
+def point_count(fp):
+    """Number of points of a point cloud file, a manifest or a directory of point cloud files from the LAS headers.
+
+    Args:
+        fp (str): Filepath to a point cloud file, a manifest of point cloud files or a directory of LAS/LAZ files.
+
+    Returns:
+        int: The number of points, or None if fp is not a readable point cloud.
+    """
+    import laspy
+    from glob import glob
+    from snow_pc.common import pc_files
+
+    if isinstance(fp, str) and os.path.isdir(fp):
+        counts = [point_count(pc_fp) for pc_fp in sorted(glob(os.path.join(fp, '*.la[sz]')))]
+        return sum(counts) if len(counts) > 0 and None not in counts else None
+    if not isinstance(fp, str) or not fp.lower().endswith(('.las', '.laz', '.json')) or not os.path.isfile(fp):
+        return None
+    try:
+        total = 0
+        for pc_fp in pc_files(fp):
+            with laspy.open(pc_fp) as reader:
+                total += reader.header.point_count
+        return total
+    except Exception:
+        return None
+
+def io_counters():
+    """Bytes read and written so far by this process, and by its finished child processes.
+
+    The process counts every read and write, the children only the blocks they read from and wrote to disk,
+    so the two are kept apart.
+
+    Returns:
+        tuple: (bytes read, bytes written, children bytes read, children bytes written), None where the platform does not report them.
+    """
+    read, written, children_read, children_written = None, None, None, None
+    # linux reports the bytes of every read and write of the process
+    if os.path.exists('/proc/self/io'):
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines() if ':' in line)
+        read, written = int(counters['rchar']), int(counters['wchar'])
+    if resource is not None:
+        # the child processes, e.g. pdal and pc_align, report blocks of 512 bytes
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        children_read, children_written = children.ru_inblock * 512, children.ru_oublock * 512
+    return read, written, children_read, children_written
+
+def current_rss(pid = 'self'):
+    """Resident memory of a process in bytes, or None if it cannot be read.
+
+    Args:
+        pid (_type_, optional): Process id. Defaults to 'self' for this process.
+    """
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+def child_pids(pid = None):
+    """Process ids of the live child processes of a process and of their children.
+
+    Args:
+        pid (int, optional): Process id. Defaults to None for this process.
+
+    Returns:
+        list: The process ids, empty where /proc is not available.
+    """
+    pid = os.getpid() if pid is None else pid
+    parents = {}
+    try:
+        entries = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return []
+    for entry in entries:
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # the parent id follows the command name, which may hold spaces
+                parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    children, queue = [], [pid]
+    while queue:
+        parent = queue.pop()
+        for child, ppid in parents.items():
+            if ppid == parent:
+                children.append(child)
+                queue.append(child)
+    return children
+
+def children_rss():
+    """Resident memory in bytes of the live child processes together, or None if there are none."""
+    sizes = [rss for rss in (current_rss(pid) for pid in child_pids()) if rss is not None]
+    return sum(sizes) if len(sizes) > 0 else None
+
+def _max_rss(who):
+    """Peak resident memory in bytes of this process or of its largest finished child process."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class RunReport:
+    """Timing, memory, point counts and I/O of the stages of a run, saved as a json report.
+
+    Stages run at the same time in threads of one process share its memory and I/O counters, so their
+    memory and bytes overlap in the report; their times and point counts are their own. The memory of the
+    child processes, e.g. pdal, is sampled while they run and their bytes are the blocks they read and wrote.
+    """
+
+    def __init__(self, report_fp):
+        """Start an empty report.
+
+        Args:
+            report_fp (str): Filepath to save the json report.
+        """
+        self.report_fp = report_fp
+        self.started = time.time()
+        self.stages = []
+
+    def measure(self, name, func, inputs = ()):
+        """Run a stage and record it.
+
+        Args:
+            name (str): Name of the stage.
+            func (function): Runs the stage without arguments.
+            inputs (list, optional): Filepaths of the inputs of the stage. Defaults to ().
+
+        Returns:
+            _type_: What func returned.
+        """
+        from snow_pc.stages import _strings
+
+        record = {'name': name, 'status': 'ok', 'seconds': None, 'peak_rss': None, 'peak_rss_children': None,
+                  'bytes_read': None, 'bytes_written': None, 'children_bytes_read': None, 'children_bytes_written': None,
+                  'input_points': {}, 'output_points': {}}
+        for fp in inputs:
+            count = point_count(fp)
+            if count is not None:
+                record['input_points'][fp] = count
+        counters0 = io_counters()
+        children0 = _max_rss(resource.RUSAGE_CHILDREN) if resource is not None else None
+
+        # sample the resident memory of the process and of its live children while the stage runs,
+        # ru_maxrss only knows the peaks of the whole process and of its largest child so far
+        peak = [current_rss(), None]
+        done = threading.Event()
+        def sample():
+            while not done.wait(SAMPLE_INTERVAL):
+                for i, rss in enumerate((current_rss(), children_rss())):
+                    if rss is not None and (peak[i] is None or rss > peak[i]):
+                        peak[i] = rss
+        sampler = threading.Thread(target= sample, daemon= True)
+        sampler.start()
+
+        start = time.perf_counter()
+        try:
+            result = func()
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 3)
+            done.set()
+            sampler.join()
+            record['peak_rss'] = peak[0] if peak[0] is not None else _max_rss(resource.RUSAGE_SELF) if resource is not None else None
+            record['peak_rss_children'] = peak[1]
+            # children that finished between two samples only show in a new lifetime peak
+            if peak[1] is None and children0 is not None and _max_rss(resource.RUSAGE_CHILDREN) > children0:
+                record['peak_rss_children'] = _max_rss(resource.RUSAGE_CHILDREN)
+            counters1 = io_counters()
+            fields = ('bytes_read', 'bytes_written', 'children_bytes_read', 'children_bytes_written')
+            for field, before, after in zip(fields, counters0, counters1):
+                if before is not None:
+                    record[field] = after - before
+            with _lock:
+                self.stages.append(record)
+
+        for fp in _strings(result):
+            count = point_count(fp)
+            if count is not None:
+                record['output_points'][fp] = count
+        if any(count == 0 for count in record['output_points'].values()):
+            record['status'] = 'empty'
+            print(f'Warning: {name} wrote a point cloud without points')
+        return result
+
+    def skipped(self, name):
+        """Record a stage that was skipped because its inputs did not change.
+
+        Args:
+            name (str): Name of the stage.
+        """
+        with _lock:
+            self.stages.append({'name': name, 'status': 'skipped'})
+
+    def save(self):
+        """Write the report.
+
+        Returns:
+            str: Filepath to the report.
+        """
+        report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                  'seconds': round(time.time() - self.started, 3), 'stages': self.stages}
+        out_dir = os.path.dirname(os.path.abspath(self.report_fp))
+        os.makedirs(out_dir, exist_ok= True)
+        fd, tmp = tempfile.mkstemp(dir= out_dir, suffix= '.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(report, f, indent= 2)
+        os.replace(tmp, self.report_fp)
+        return self.report_fp
+
+
+def active_report():
+    """The report of the running run, or None outside of run_report()."""
+    return _active.get()
+
+def in_run(func):
+    """Wrap a function so it records into the report of the calling run when it runs in a worker thread.
+
+    Threads do not inherit the run of the thread that starts them. Wrap the function handed to a thread pool,
+    e.g. executor.submit(in_run(stages.run), ...), so its stages land in the report of the caller.
+
+    Args:
+        func (function): The function run in the worker thread.
+
+    Returns:
+        function: The wrapped function.
+    """
+    context = contextvars.copy_context()
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # a copy per call, one context cannot be entered by two threads at once
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+@contextmanager
+def run_report(results_dir):
+    """Record the instrumented stages run inside it and save run_report.json in the results directory.
+
+    A run inside another run, e.g. pc2correctedDEM() called by pc2snow(), records into the report of the outer run.
+    Runs in different threads, e.g. several sites at once, each keep and save their own report.
+
+    Args:
+        results_dir (str): The results directory of the run.
+
+    Yields:
+        RunReport: The report.
+    """
+    outer = _active.get()
+    if outer is not None:
+        yield outer
+        return
+    report = RunReport(os.path.join(results_dir, 'run_report.json'))
+    token = _active.set(report)
+    try:
+        yield report
+    finally:
+        _active.reset(token)
+        report.save()
+
+def instrumented(func):
+    """Record each call of a stage function in the active report.
+
+    The first argument of the stage is taken as its input point cloud. Outside of run_report() the function runs unchanged.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        report = _active.get()
+        if report is None:
+            return func(*args, **kwargs)
+        inputs = [args[0]] if len(args) > 0 and isinstance(args[0], str) else []
+        return report.measure(func.__name__, lambda: func(*args, **kwargs), inputs)
+    return wrapper
+
+def reported(func):
+    """Save a run report in the results directory of a run function whose first argument is the directory of the point clouds."""
+    @functools.wraps(func)
+    def wrapper(in_dir, *args, **kwargs):
+        from snow_pc.common import make_dirs
+
+        with run_report(make_dirs(in_dir)):
+            return func(in_dir, *args, **kwargs)
+    return wrapper
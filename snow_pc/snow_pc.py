@@ -1,99 +1,176 @@
 """Main module."""
 
 import os
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join, basename
-import rioxarray as rio
 
 #local imports
+from snow_pc.common import make_dirs, pc_files
+from snow_pc.stages import StageCache
 from snow_pc.prepare import prepare_pc
-from snow_pc.modeling import terrain_models, surface_models
-from snow_pc.align import laz_align
+from snow_pc.modeling import terrain_models, surface_models, elevation_models
+from snow_pc.align import laz_align, prepare_reference, shared_transform
+from snow_pc.differencing import difference_rasters, ResamplingPlan
+from snow_pc.report import instrumented, reported, in_run
 
 
 
-def pc2uncorrectedDEM(in_dir, outlas = '', outtif = '', user_dem = '', dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes'):
+@reported
+def pc2uncorrectedDEM(in_dir, outlas = '', outtif = '', user_dem = '', dem_low = 20, dem_high = 50, mean_k = 20, multiplier = 3, lidar_pc = 'yes', tile_size = None, n_workers = None, resume = True):
     """Converts laz files to uncorrected DEM.
 
     Args:
         in_dir (str): Path to the directory containing the point cloud files.
         user_dem (str, optional): Path to the DEM file. Defaults to ''.
+        tile_size (int, optional): Width of the tiles to process in parallel. Defaults to None which processes the whole point cloud at once.
+        n_workers (int, optional): Number of tiles run at the same time for tiled processing. Defaults to None which uses all cores.
+        resume (bool, optional): Skip the stages whose inputs, parameters and tools are unchanged since the last run. Defaults to True.
 
     Returns:
     outtif (str): filepath to output DTM tiff
     outlas (str): filepath to output DTM laz file
     """
+    stages = StageCache(make_dirs(in_dir), resume = resume)
 
     # prepare point cloud
-    unfiltered_laz = prepare_pc(in_dir)
+    raw_files = sorted(glob(join(in_dir, '*.la[sz]')))
+    unfiltered_laz = stages.run('prepare', lambda: prepare_pc(in_dir), inputs = raw_files, tools = ['pdal'])
 
-    #create uncorrected DTM
-    dtm_laz, dtm_tif = terrain_models(unfiltered_laz, outtif= outtif, outlas= outlas, user_dem = user_dem, dem_low = dem_low, dem_high = dem_high, mean_k = mean_k, multiplier = multiplier, lidar_pc = lidar_pc)
-
-    #create uncorrected DSM
-    dsm_laz, dsm_tif = surface_models(unfiltered_laz, outtif= outtif, outlas= outlas, user_dem = user_dem, dem_low = dem_low, dem_high = dem_high, mean_k = mean_k, multiplier = multiplier, lidar_pc = lidar_pc)
+    #create uncorrected DTM and DSM. The shared filters run once for both models
+    params = dict(outlas = outlas, outtif = outtif, dem_low = dem_low, dem_high = dem_high, mean_k = mean_k, multiplier = multiplier,
+                  lidar_pc = lidar_pc, tile_size = tile_size)
+    dtm_laz, dtm_tif, dsm_laz, dsm_tif = stages.run('elevation_models',
+        lambda: elevation_models(unfiltered_laz, dtm_las= outlas, dtm_tif= outtif, user_dem = user_dem, dem_low = dem_low, dem_high = dem_high, mean_k = mean_k, multiplier = multiplier, lidar_pc = lidar_pc, tile_size = tile_size, n_workers = n_workers),
+        inputs = [unfiltered_laz, *pc_files(unfiltered_laz), user_dem], params = params, tools = ['pdal'])
 
     return dtm_laz, dtm_tif, dsm_laz, dsm_tif
 
 
-def pc2correctedDEM(in_dir, align_file, asp_dir, user_dem = ''):
+@reported
+def pc2correctedDEM(in_dir, align_file, asp_dir, user_dem = '', resume = True, transform_from = 'each'):
     """Converts laz files to corrected DEM.
 
     Args:
         in_dir (str): Path to the directory containing the point cloud files.
         align_shp (str): Path to the shapefile to align the point cloud to.
         user_dem (str, optional): Path to the DEM file. Defaults to ''.
+        resume (bool, optional): Skip the stages whose inputs, parameters and tools are unchanged since the last run. Defaults to True.
+        transform_from (str, optional): 'each' solves a transform for the DTM and for the DSM. 'dtm' or 'unfiltered' solves one
+            transform from the DTM or from the unfiltered point cloud clipped to the roads and applies it to both. Defaults to 'each'.
 
     Returns:
     outtif (str): filepath to output DTM tiff
     outlas (str): filepath to output DTM laz file
     """
-
+    if transform_from not in ('each', 'dtm', 'unfiltered'):
+        raise ValueError(f'Unknown transform_from: {transform_from}')
 
     # create uncorrected DEM
-    dtm_laz, dtm_tif, dsm_laz, dsm_tif = pc2uncorrectedDEM(in_dir, user_dem = user_dem)
-
-
-    # align the point cloud
-    dtm_align_tif = laz_align(dtm_laz, align_file = align_file, asp_dir= asp_dir, user_dem = user_dem)
-    dsm_align_tif = laz_align(dsm_laz, align_file = align_file, asp_dir= asp_dir, user_dem = user_dem)
+    dtm_laz, dtm_tif, dsm_laz, dsm_tif = pc2uncorrectedDEM(in_dir, user_dem = user_dem, resume = resume)
+
+
+    # prepare the reference DEM and the buffered roads once for both models
+    stages = StageCache(make_dirs(in_dir), resume = resume)
+    reference = stages.run('align_reference', lambda: prepare_reference(dtm_laz, align_file, user_dem = user_dem),
+                           inputs = [dtm_laz, align_file, user_dem])
+
+    # solve one transform for both models
+    tools = asp_tools(asp_dir)
+    transform = ''
+    if transform_from != 'each':
+        source = dtm_laz if transform_from == 'dtm' else join(make_dirs(in_dir), 'unfiltered.json')
+        transform = stages.run('align_transform', lambda: shared_transform(source, reference, asp_dir),
+                               inputs = [source, *pc_files(source), *reference], tools = tools)
+
+    # align the DTM and the DSM at the same time
+    with ThreadPoolExecutor(max_workers= 2) as executor:
+        dtm_future = executor.submit(in_run(stages.run), 'align_dtm', lambda: laz_align(dtm_laz, align_file = align_file, asp_dir= asp_dir, reference = reference, transform = transform),
+                                     inputs = [dtm_laz, align_file, *reference, transform], params = dict(asp_dir = asp_dir), tools = tools)
+        dsm_future = executor.submit(in_run(stages.run), 'align_dsm', lambda: laz_align(dsm_laz, align_file = align_file, asp_dir= asp_dir, reference = reference, transform = transform),
+                                     inputs = [dsm_laz, align_file, *reference, transform], params = dict(asp_dir = asp_dir), tools = tools)
+        dtm_align_tif = dtm_future.result()
+        dsm_align_tif = dsm_future.result()
 
     return dtm_align_tif, dsm_align_tif
 
-def pc2snow(in_dir, align_file, asp_dir, user_dem = ''):
+@reported
+def pc2snow(in_dir, align_file, asp_dir, user_dem = '', resume = True, transform_from = 'each'):
     """Converts laz files to snow depth and canopy height.
 
     Args:
         in_dir (str): Path to the directory containing the point cloud files.
         align_shp (str): Path to the shapefile to align the point cloud to.
         user_dem (str, optional): Path to the DEM file. Defaults to ''.
+        resume (bool, optional): Skip the stages whose inputs, parameters and tools are unchanged since the last run, e.g. after a
+            failure in the last stage only the last stage is run again. Defaults to True.
+        transform_from (str, optional): 'each', 'dtm' or 'unfiltered', see pc2correctedDEM(). Defaults to 'each'.
 
     Returns:
     outtif (str): filepath to output DTM tiff
     outlas (str): filepath to output DTM laz file
     """
-
     # create corrected DEM
-    dtm_align_tif, dsm_align_tif = pc2correctedDEM(in_dir, align_file, asp_dir, user_dem = user_dem)
+    dtm_align_tif, dsm_align_tif = pc2correctedDEM(in_dir, align_file, asp_dir, user_dem = user_dem, resume = resume, transform_from = transform_from)
     
     #set dem_fp
-    in_dir = os.path.dirname(dtm_align_tif)
-    ref_dem_path = join(in_dir, 'dem.tif')
-
-    #create snow depth
-    snow_depth_path = join(in_dir, f'{basename(in_dir)}-snowdepth.tif')
-    snowoff = rio.open_rasterio(ref_dem_path, masked=True)
-    snowon = rio.open_rasterio(dtm_align_tif, masked=True) 
-    snowon_matched = snowon.rio.reproject_match(snowoff)
-    snowdepth = snowon_matched - snowoff
-    snowdepth.rio.to_raster(snow_depth_path)
-
-    #create canopy height
-    canopy_height_path = join(in_dir, f'{basename(in_dir)}-canopyheight.tif')
-    canopy_height = rio.open_rasterio(dsm_align_tif, masked=True) - snowoff
-    canopy_height.rio.to_raster(canopy_height_path)
+    out_dir = os.path.dirname(dtm_align_tif)
+    ref_dem_path = join(out_dir, 'dem.tif')
+
+    #create snow depth and canopy height
+    snow_depth_path = join(out_dir, f'{basename(out_dir)}-snowdepth.tif')
+    canopy_height_path = join(out_dir, f'{basename(out_dir)}-canopyheight.tif')
+    stages = StageCache(make_dirs(in_dir), resume = resume)
+    return stages.run('difference', lambda: difference_dems(dtm_align_tif, dsm_align_tif, ref_dem_path, snow_depth_path, canopy_height_path),
+                      inputs = [dtm_align_tif, dsm_align_tif, ref_dem_path], tools = ['rasterio'])
+
+@instrumented
+def difference_dems(dtm_align_tif, dsm_align_tif, ref_dem_path, snow_depth_path, canopy_height_path, block_size = 1024):
+    """Difference the aligned DTM and DSM with the snow off reference DEM.
+
+    Both are resampled to the grid of the reference DEM and differenced block by block. Rasters on the same
+    grid share one resampling plan, so the reprojection is set up once per site, and the plans are closed afterwards.
+
+    Args:
+        dtm_align_tif (str): Filepath to the aligned DTM.
+        dsm_align_tif (str): Filepath to the aligned DSM.
+        ref_dem_path (str): Filepath to the snow off reference DEM.
+        snow_depth_path (str): Filepath to save the snow depth.
+        canopy_height_path (str): Filepath to save the canopy height.
+        block_size (int, optional): Size of the blocks in pixels. Defaults to 1024.
+
+    Returns:
+        tuple: Filepaths to the snow depth and the canopy height.
+    """
+    import rasterio
+
+    with rasterio.open(ref_dem_path) as ref, rasterio.open(dtm_align_tif) as dtm, rasterio.open(dsm_align_tif) as dsm:
+        dtm_plan = ResamplingPlan.from_rasters(dtm, ref)
+        dsm_plan = ResamplingPlan.from_rasters(dsm, ref)
+    if dsm_plan.key() == dtm_plan.key():
+        dsm_plan = dtm_plan
+    with dtm_plan, dsm_plan:
+        #create snow depth
+        difference_rasters(dtm_align_tif, ref_dem_path, snow_depth_path, block_size = block_size, plan = dtm_plan)
+
+        #create canopy height
+        difference_rasters(dsm_align_tif, ref_dem_path, canopy_height_path, block_size = block_size, plan = dsm_plan)
 
     return snow_depth_path, canopy_height_path
 
+def asp_tools(asp_dir):
+    """Filepaths of the ASP tools used for the alignment.
+
+    Args:
+        asp_dir (str): Path to the ASP install or its bin directory.
+
+    Returns:
+        list: Filepaths to pc_align and point2dem.
+    """
+    if basename(asp_dir) != 'bin':
+        asp_dir = join(asp_dir, 'bin')
+    return [join(asp_dir, 'pc_align'), join(asp_dir, 'point2dem')]
+
 
 # class Map(ipyleaflet.Map):
 #     """Custom map class that inherits from ipyleaflet.Map.
@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import subprocess
+from functools import lru_cache
+from snow_pc.report import active_report
+
+# files up to this size are fingerprinted by their content, larger files by their size and mtime
+HASH_BYTES = 1024**2
+
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize= None)
+def tool_version(tool):
+    """Version of a python package or of a command line tool.
+
+    Args:
+        tool (str): Name of an installed python package, or name or filepath of an executable that takes --version.
+
+    Returns:
+        str: The version, or 'unavailable' if the tool is not found.
+    """
+    from importlib import metadata
+
+    try:
+        return metadata.version(tool)
+    except metadata.PackageNotFoundError:
+        pass
+    try:
+        result = subprocess.run([tool, '--version'], capture_output= True, text= True, timeout= 60)
+    except (OSError, subprocess.TimeoutExpired):
+        return 'unavailable'
+    lines = (result.stdout or result.stderr).strip().splitlines()
+    return lines[0] if len(lines) > 0 else 'unavailable'
+
+def file_fingerprint(fp, hash_files = False):
+    """Fingerprint of a file.
+
+    Args:
+        fp (str): Filepath.
+        hash_files (bool, optional): Hash the content of large files too. Defaults to False.
+
+    Returns:
+        _type_: sha256 of the content for small files, [size, mtime] for large files, None if the file does not exist.
+    """
+    if not os.path.isfile(fp):
+        return None
+    stat = os.stat(fp)
+    if stat.st_size > HASH_BYTES and not hash_files:
+        return [stat.st_size, stat.st_mtime_ns]
+    digest = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """Record of the stages of a run so a rerun skips the stages whose inputs did not change.
+
+    Each stage is stored in stages.json in the results directory with the fingerprint of its input files,
+    parameters and tool versions, and with what it returned. A stage is skipped when its fingerprint is
+    unchanged and the files it returned still exist. The outputs of a stage are the inputs of the next ones,
+    so rerunning a stage reruns the stages downstream of it.
+    """
+
+    def __init__(self, results_dir, resume = True, hash_files = False):
+        """Open the record of a results directory.
+
+        Args:
+            results_dir (str): The results directory of the run.
+            resume (bool, optional): Skip the unchanged stages. False reruns every stage. Defaults to True.
+            hash_files (bool, optional): Fingerprint large input files by their content instead of their size and mtime. Defaults to False.
+        """
+        self.manifest_fp = os.path.join(results_dir, 'stages.json')
+        self.resume = resume
+        self.hash_files = hash_files
+
+    def load(self):
+        """Read the recorded stages.
+
+        Returns:
+            dict: The record of each stage by name.
+        """
+        if not os.path.exists(self.manifest_fp):
+            return {}
+        with open(self.manifest_fp) as f:
+            return json.load(f)
+
+    def fingerprint(self, inputs = (), params = None, tools = ()):
+        """Fingerprint of a stage.
+
+        Args:
+            inputs (list, optional): Filepaths of the input files. Empty strings are ignored. Defaults to ().
+            params (dict, optional): Parameters of the stage. Defaults to None.
+            tools (list, optional): Python packages and executables the stage runs. Defaults to ().
+
+        Returns:
+            str: The fingerprint.
+        """
+        from snow_pc import __version__
+
+        parts = {
+            'inputs': {os.path.abspath(fp): file_fingerprint(fp, self.hash_files) for fp in inputs if fp},
+            'params': params or {},
+            'tools': {'snow_pc': __version__, **{tool: tool_version(tool) for tool in tools}},
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys= True, default= str).encode()).hexdigest()
+
+    def run(self, name, func, inputs = (), params = None, tools = ()):
+        """Run a stage unless it is unchanged since the last run.
+
+        Args:
+            name (str): Name of the stage.
+            func (function): Runs the stage without arguments. Its return value must be json serializable.
+            inputs (list, optional): Filepaths of the input files. Defaults to ().
+            params (dict, optional): Parameters of the stage. Defaults to None.
+            tools (list, optional): Python packages and executables the stage runs. Defaults to ().
+
+        Returns:
+            _type_: What func returned, from this run or the recorded one.
+        """
+        fingerprint = self.fingerprint(inputs, params, tools)
+        if self.resume:
+            record = self.load().get(name)
+            if record is not None and record['fingerprint'] == fingerprint and all(os.path.exists(fp) for fp in record['outputs']):
+                print(f'Skipping {name}: inputs unchanged')
+                if active_report() is not None:
+                    active_report().skipped(name)
+                return _from_json(record['result'])
+
+        result = func()
+        outputs = [fp for fp in _strings(result) if os.path.isfile(fp)]
+        with _lock:
+            stages = self.load()
+            stages[name] = {'fingerprint': fingerprint, 'result': result, 'outputs': outputs}
+            # write to a temporary file first so an interrupted run never leaves a partial record
+            os.makedirs(os.path.dirname(os.path.abspath(self.manifest_fp)), exist_ok= True)
+            fd, tmp = tempfile.mkstemp(dir= os.path.dirname(os.path.abspath(self.manifest_fp)), suffix= '.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(stages, f, indent= 2)
+            os.replace(tmp, self.manifest_fp)
+        return result
+
+
+def _strings(value):
+    """Strings in a nested return value."""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [s for v in value for s in _strings(v)]
+    return []
+
+def _from_json(value):
+    """Turn the lists of a recorded return value back into tuples."""
+    if isinstance(value, list):
+        return tuple(_from_json(v) for v in value)
+    return value
@@ -0,0 +1,369 @@
+import os
+from os.path import join, basename, dirname
+import math
+import shutil
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import laspy
+from snow_pc.common import iter_chunks, copy_header, rescale_points
+from snow_pc.pipeline import run_pipeline, PipelineError
+
+# filters that take statistics over the whole point cloud and run once over it instead of per tile
+NOISE_STAGES = ('filters.elm', 'filters.outlier')
+
+
+def make_tiles(bounds, tile_size = 500, buffer = 30, resolution = 1.0):
+    """Split the bounds of a point cloud into square tiles with an overlap buffer.
+
+    The tile size is rounded to a multiple of the resolution so the tile grids line up with the grid of the
+    whole point cloud.
+
+    Args:
+        bounds (tuple): (minx, miny, maxx, maxy) of the point cloud.
+        tile_size (int, optional): Width of the tiles in map units. Defaults to 500.
+        buffer (int, optional): Overlap added around each tile. Defaults to 30.
+        resolution (float, optional): Resolution of the output rasters. Defaults to 1.0.
+
+    Returns:
+        list: One dict per tile with the tile name, column, row, core bounds and buffered bounds.
+    """
+    minx, miny, maxx, maxy = bounds
+    tile_size = max(1, round(tile_size / resolution)) * resolution
+    assert buffer < tile_size, f'The buffer ({buffer}) must be smaller than the tile size ({tile_size})'
+
+    ncols = max(1, math.ceil((maxx - minx) / tile_size))
+    nrows = max(1, math.ceil((maxy - miny) / tile_size))
+    # the last tile includes the maximum coordinates
+    if minx + ncols * tile_size <= maxx:
+        ncols += 1
+    if miny + nrows * tile_size <= maxy:
+        nrows += 1
+
+    tiles = []
+    for row in range(nrows):
+        for col in range(ncols):
+            core = (minx + col * tile_size, miny + row * tile_size, minx + (col + 1) * tile_size, miny + (row + 1) * tile_size)
+            buffered = (core[0] - buffer, core[1] - buffer, core[2] + buffer, core[3] + buffer)
+            tiles.append({'name': f'tile_{col}_{row}', 'col': col, 'row': row, 'core': core, 'buffered': buffered})
+    return tiles
+
+def split_tiles(laz_fp, tiles, out_dir, chunk_size = 1_000_000):
+    """Split point clouds into buffered tile files in one streaming pass.
+
+    Args:
+        laz_fp (str or list): Filepath to the point cloud file, or a list of point cloud files that share a point format.
+        tiles (list): Tiles from make_tiles().
+        out_dir (str): Directory to save the tile files.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        dict: Tile name to the filepath of the tile point cloud. Tiles without points are left out.
+    """
+    os.makedirs(out_dir, exist_ok= True)
+    by_index = {(t['col'], t['row']): t for t in tiles}
+    minx, miny = tiles[0]['core'][0], tiles[0]['core'][1]
+    tile_size = tiles[0]['core'][2] - tiles[0]['core'][0]
+    buffer = tiles[0]['core'][0] - tiles[0]['buffered'][0]
+
+    if isinstance(laz_fp, str):
+        laz_fp = [laz_fp]
+
+    tile_fps = {}
+    with ExitStack() as stack:
+        writers = {}
+        for points, header in iter_chunks(laz_fp, chunk_size):
+            x = np.asarray(points.x)
+            y = np.asarray(points.y)
+            # a point falls in at most two buffered tiles along each axis
+            col_lo = np.floor((x - buffer - minx) / tile_size).astype(np.int64)
+            col_hi = np.floor((x + buffer - minx) / tile_size).astype(np.int64)
+            row_lo = np.floor((y - buffer - miny) / tile_size).astype(np.int64)
+            row_hi = np.floor((y + buffer - miny) / tile_size).astype(np.int64)
+            for cols in (col_lo, col_hi):
+                for rows in (row_lo, row_hi):
+                    # skip the duplicate combinations when lo == hi
+                    keep = np.ones(len(x), dtype= bool)
+                    if cols is col_hi:
+                        keep &= col_hi != col_lo
+                    if rows is row_hi:
+                        keep &= row_hi != row_lo
+                    for col, row in set(zip(cols[keep].tolist(), rows[keep].tolist())):
+                        tile = by_index.get((col, row))
+                        if tile is None:
+                            continue
+                        mask = keep & (cols == col) & (rows == row)
+                        if tile['name'] not in writers:
+                            tile_fps[tile['name']] = join(out_dir, f"{tile['name']}.laz")
+                            writers[tile['name']] = stack.enter_context(laspy.open(tile_fps[tile['name']], mode= 'w', header= copy_header(header)))
+                        writers[tile['name']].write_points(rescale_points(points[mask], writers[tile['name']].header))
+    return tile_fps
+
+def tile_pipeline(json_pipeline, tile, tile_laz, tile_dir, grid):
+    """Rewrite a whole-cloud pipeline so it runs on one tile.
+
+    The readers are replaced by one reader of the tile point cloud, the writers save to the tile directory, and every
+    writers.gdal stage is pinned to the core of the tile on the grid of the whole point cloud.
+
+    Args:
+        json_pipeline (dict): The json pipeline for the whole point cloud.
+        tile (dict): Tile from make_tiles().
+        tile_laz (str): Filepath to the tile point cloud.
+        tile_dir (str): Directory to save the tile outputs.
+        grid (dict): Origin and resolution of the whole point cloud grid.
+
+    Returns:
+        dict: The json pipeline for the tile.
+    """
+    stages = []
+    previous = None
+    for stage in json_pipeline['pipeline']:
+        stage = dict(stage) if isinstance(stage, dict) else {"type": "readers.las", "filename": stage}
+        # the tile point cloud already holds the points of every reader
+        if previous == 'readers.las' and (stage['type'] == 'readers.las' or (stage['type'] == 'filters.merge' and 'inputs' not in stage)):
+            continue
+        previous = stage['type']
+        if stage['type'] == 'readers.las':
+            stage['filename'] = tile_laz
+        elif stage['type'].startswith('writers'):
+            stage['filename'] = join(tile_dir, basename(stage['filename']))
+        if stage['type'] == 'writers.gdal':
+            resolution = float(stage.get('resolution', grid['resolution']))
+            size = int(round((tile['core'][2] - tile['core'][0]) / resolution))
+            stage['origin_x'] = tile['core'][0]
+            stage['origin_y'] = tile['core'][1]
+            stage['width'] = size
+            stage['height'] = size
+        stages.append(stage)
+    return {"pipeline": stages}
+
+def _run_tile_pipeline(json_pipeline, json_fp):
+    """Run the pipeline of one tile in its own pdal process. This runs in a worker thread that waits on it."""
+    try:
+        # always a pdal process, the python bindings would run every tile inside this interpreter
+        run_pipeline(json_pipeline, json_fp = json_fp, backend = 'subprocess')
+    except PipelineError as e:
+        return json_fp, str(e)
+    return json_fp, ''
+
+def mosaic_laz(tile_fps, tiles, out_fp, chunk_size = 1_000_000):
+    """Crop the buffers off the tile point clouds and mosaic them into one file.
+
+    Args:
+        tile_fps (dict): Tile name to the filepath of the tile point cloud.
+        tiles (list): Tiles from make_tiles().
+        out_fp (str): Filepath to save the mosaic.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Returns:
+        str: Filepath to the mosaic.
+    """
+    tile_fps = {name: fp for name, fp in tile_fps.items() if os.path.exists(fp)}
+    if len(tile_fps) == 0:
+        raise Exception(f'No tile point clouds to mosaic into {out_fp}')
+    by_name = {t['name']: t for t in tiles}
+
+    with laspy.open(next(iter(tile_fps.values()))) as first:
+        header = copy_header(first.header)
+
+    with laspy.open(out_fp, mode= 'w', header= header) as writer:
+        for name, fp in tile_fps.items():
+            minx, miny, maxx, maxy = by_name[name]['core']
+            with laspy.open(fp) as reader:
+                for points in reader.chunk_iterator(chunk_size):
+                    x = np.asarray(points.x)
+                    y = np.asarray(points.y)
+                    # half open so points on a shared edge are kept once
+                    keep = (x >= minx) & (x < maxx) & (y >= miny) & (y < maxy)
+                    if not keep.any():
+                        continue
+                    writer.write_points(rescale_points(points[keep], writer.header))
+    return out_fp
+
+def mosaic_tif(tile_fps, tiles, out_fp, grid):
+    """Write the tile rasters into their windows of the whole point cloud grid.
+
+    Args:
+        tile_fps (dict): Tile name to the filepath of the tile raster.
+        tiles (list): Tiles from make_tiles().
+        out_fp (str): Filepath to save the mosaic.
+        grid (dict): Origin, resolution, width and height of the whole point cloud grid.
+
+    Returns:
+        str: Filepath to the mosaic.
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    tile_fps = {name: fp for name, fp in tile_fps.items() if os.path.exists(fp)}
+    if len(tile_fps) == 0:
+        raise Exception(f'No tile rasters to mosaic into {out_fp}')
+    by_name = {t['name']: t for t in tiles}
+    res = grid['resolution']
+    top = grid['origin_y'] + grid['height'] * res
+    full = Window(0, 0, grid['width'], grid['height'])
+
+    with rasterio.open(next(iter(tile_fps.values()))) as first:
+        profile = first.profile
+    profile.update(width= grid['width'], height= grid['height'], transform= from_origin(grid['origin_x'], top, res, res),
+                   tiled= True, blockxsize= 256, blockysize= 256, compress= 'deflate')
+    nodata = profile.get('nodata')
+    if nodata is None:
+        nodata = -9999
+        profile['nodata'] = nodata
+
+    with rasterio.open(out_fp, 'w', **profile) as dst:
+        for name, fp in tile_fps.items():
+            tile = by_name[name]
+            with rasterio.open(fp) as src:
+                col_off = int(round((tile['core'][0] - grid['origin_x']) / res))
+                row_off = int(round((top - tile['core'][3]) / res))
+                window = Window(col_off, row_off, src.width, src.height)
+                # clip the window of the outer tiles to the whole grid
+                clipped = window.intersection(full)
+                data = src.read(window= Window(clipped.col_off - col_off, clipped.row_off - row_off, clipped.width, clipped.height))
+                dst.write(data, window= clipped)
+    return out_fp
+
+def classify_noise(laz_fp, stages, out_fp, n_workers = None, chunk_size = 1_000_000):
+    """Run filters.elm and filters.outlier stages over the whole point cloud without PDAL.
+
+    Both filters take statistics over the whole cloud, the cells of filters.elm from its corner and the
+    threshold of filters.outlier from the mean and standard deviation of every neighbor distance, so they
+    cannot run per tile. The native engines of the noise module give the labels of PDAL in one streaming pass.
+
+    Args:
+        laz_fp (_type_): Filepath to the point cloud file or to a manifest of point cloud files.
+        stages (list): The filters.elm and filters.outlier stages of the pipeline, in their order.
+        out_fp (str): Filepath to save the classified point cloud.
+        n_workers (int, optional): Number of threads of the outlier KD-trees. Defaults to None which uses all cores.
+        chunk_size (int, optional): Number of points read at a time. Defaults to 1_000_000.
+
+    Raises:
+        ValueError: If a stage uses options the native engines do not have.
+
+    Returns:
+        str: Filepath to the classified point cloud.
+    """
+    from snow_pc.noise import elm_filter_native, outlier_filter_native, NOISE
+
+    for i, stage in enumerate(stages):
+        if int(stage.get('class', NOISE)) != NOISE:
+            raise ValueError(f'{stage["type"]} can only be run tiled with the noise class {NOISE}')
+        step_fp = out_fp if i == len(stages) - 1 else f'{os.path.splitext(out_fp)[0]}_{i}.laz'
+        if stage['type'] == 'filters.elm':
+            elm_filter_native(laz_fp, step_fp, cell= float(stage.get('cell', 10.0)), threshold= float(stage.get('threshold', 1.0)),
+                              chunk_size= chunk_size)
+        elif stage['type'] == 'filters.outlier' and stage.get('method', 'statistical') == 'statistical':
+            # the defaults of filters.outlier
+            outlier_filter_native(laz_fp, step_fp, mean_k= int(stage.get('mean_k', 8)), multiplier= float(stage.get('multiplier', 2.0)),
+                                  n_workers= n_workers, chunk_size= chunk_size)
+        else:
+            raise ValueError(f'{stage["type"]} with {stage} cannot be run tiled')
+        # the intermediate steps are removed, never the input
+        if i > 0:
+            os.remove(laz_fp)
+        laz_fp = step_fp
+    return out_fp
+
+def run_tiled(json_pipeline, tile_size = 500, buffer = 30, n_workers = None, work_dir = '', keep_tiles = False, chunk_size = 1_000_000):
+    """Run a whole-cloud pipeline tile by tile in parallel pdal processes and mosaic the outputs.
+
+    The input is split into tiles with an overlap buffer so filters.smrf has the neighbors it needs at the
+    tile edges. The buffers are cropped off before the laz outputs are mosaicked and the raster outputs are
+    written on the grid of the whole point cloud. Each tile runs in its own pdal process, so the pool only
+    needs threads to wait on them.
+
+    filters.elm and filters.outlier take their cells and threshold from the whole cloud, so they run once
+    over it with classify_noise() and the output matches a single pass. The stages before them are run tiled
+    and mosaicked first; they must work point by point, like filters.dem, filters.mongo and filters.range.
+
+    Args:
+        json_pipeline (dict): The json pipeline for the whole point cloud.
+        tile_size (int, optional): Width of the tiles in map units. Defaults to 500.
+        buffer (int, optional): Overlap added around each tile. Defaults to 30.
+        n_workers (int, optional): Number of tiles run at the same time. Defaults to None which uses all cores.
+        work_dir (str, optional): Directory for the tile files. Defaults to '' which uses a tiles directory next to the input.
+        keep_tiles (bool, optional): Keep the tile files after the mosaic. Defaults to False.
+        chunk_size (int, optional): Number of points read at a time when splitting and mosaicking. Defaults to 1_000_000.
+
+    Raises:
+        ValueError: If no tile holds points.
+
+    Returns:
+        list: Filepaths to the mosaicked outputs.
+    """
+    stages = json_pipeline['pipeline']
+    laz_fps = [s if isinstance(s, str) else s['filename'] for s in stages if isinstance(s, str) or s['type'] == 'readers.las']
+    assert len(laz_fps) > 0, 'Tiled pipelines need a readers.las stage'
+    writers = [s for s in stages if isinstance(s, dict) and s['type'].startswith('writers')]
+
+    if work_dir == '':
+        work_dir = join(dirname(laz_fps[0]), 'tiles')
+    os.makedirs(work_dir, exist_ok= True)
+
+    noise = [i for i, s in enumerate(stages) if isinstance(s, dict) and s['type'] in NOISE_STAGES]
+    if len(noise) > 0:
+        first, last = noise[0], noise[-1]
+        src_fp = laz_fps[0]
+        before = [s for s in stages[:first] if isinstance(s, dict) and s['type'] not in ('readers.las', 'filters.merge')]
+        if len(before) > 0 or len(laz_fps) > 1:
+            src_fp = join(work_dir, 'before_noise.laz')
+            run_tiled({"pipeline": stages[:first] + [{"type": "writers.las", "filename": src_fp, "forward": "all"}]}, tile_size, buffer,
+                      n_workers, join(work_dir, 'before_noise'), keep_tiles, chunk_size)
+        noise_fp = classify_noise(src_fp, stages[first:last + 1], join(work_dir, 'noise.laz'), n_workers, chunk_size)
+        outputs = run_tiled({"pipeline": [noise_fp] + stages[last + 1:]}, tile_size, buffer, n_workers, join(work_dir, 'after_noise'),
+                            keep_tiles, chunk_size)
+        if not keep_tiles:
+            shutil.rmtree(work_dir)
+        return outputs
+
+    # the grid of the whole point cloud, as writers.gdal would lay it out in a single pass
+    resolution = float(next((s.get('resolution', 1.0) for s in writers if s['type'] == 'writers.gdal'), 1.0))
+    minx, miny, maxx, maxy = np.inf, np.inf, -np.inf, -np.inf
+    for fp in laz_fps:
+        with laspy.open(fp) as las:
+            minx, miny = min(minx, las.header.mins[0]), min(miny, las.header.mins[1])
+            maxx, maxy = max(maxx, las.header.maxs[0]), max(maxy, las.header.maxs[1])
+    grid = {'origin_x': minx, 'origin_y': miny, 'resolution': resolution,
+            'width': int((maxx - minx) / resolution) + 1, 'height': int((maxy - miny) / resolution) + 1}
+
+    tiles = make_tiles((minx, miny, maxx, maxy), tile_size= tile_size, buffer= buffer, resolution= resolution)
+    print(f'Splitting {len(laz_fps)} point cloud files into {len(tiles)} tiles...')
+    tile_lazs = split_tiles(laz_fps, tiles, join(work_dir, 'input'), chunk_size= chunk_size)
+
+    # run the tile pipelines
+    jobs = []
+    for tile in tiles:
+        if tile['name'] not in tile_lazs:
+            continue
+        tile_dir = join(work_dir, tile['name'])
+        os.makedirs(tile_dir, exist_ok= True)
+        jobs.append((tile_pipeline(json_pipeline, tile, tile_lazs[tile['name']], tile_dir, grid), join(tile_dir, 'pipeline.json')))
+    if len(jobs) == 0:
+        if not keep_tiles:
+            shutil.rmtree(work_dir)
+        raise ValueError(f'No tile holds points of {", ".join(laz_fps)}')
+    failed = []
+    with ThreadPoolExecutor(max_workers= n_workers or os.cpu_count()) as pool:
+        for json_fp, error in pool.map(lambda job: _run_tile_pipeline(*job), jobs):
+            if error != '':
+                failed.append(json_fp)
+                print(f'Tile pipeline {json_fp} failed: {error}')
+    if len(failed) > 0:
+        raise Exception(f'{len(failed)} of {len(jobs)} tile pipelines failed')
+
+    # crop the buffers and mosaic the outputs
+    outputs = []
+    for writer in writers:
+        tile_fps = {t['name']: join(work_dir, t['name'], basename(writer['filename'])) for t in tiles if t['name'] in tile_lazs}
+        if writer['type'] == 'writers.gdal':
+            mosaic_tif(tile_fps, tiles, writer['filename'], grid)
+        else:
+            mosaic_laz(tile_fps, tiles, writer['filename'], chunk_size= chunk_size)
+        outputs.append(writer['filename'])
+
+    if not keep_tiles:
+        shutil.rmtree(work_dir)
+    return outputs
@@ -0,0 +1,311 @@
+import math
+import numpy as np
+from snow_pc.differencing import block_windows, read_masked
+
+
+def raster_grid(src, crs):
+    """Grid of a raster in a crs, the same grid a full reprojection of the raster would use.
+
+    Args:
+        src (_type_): The open raster.
+        crs (_type_): The target crs.
+
+    Returns:
+        tuple: The transform, width and height of the grid.
+    """
+    from rasterio.crs import CRS
+    from rasterio.warp import calculate_default_transform
+
+    crs = CRS.from_user_input(crs)
+    if crs == src.crs:
+        return src.transform, src.width, src.height
+    return calculate_default_transform(src.crs, crs, src.width, src.height, *src.bounds)
+
+def read_grid_window(src, crs, transform, window):
+    """Read a window of the grid of a raster in a crs, reprojecting only that window.
+
+    Args:
+        src (_type_): The open raster.
+        crs (_type_): The crs of the grid.
+        transform (affine.Affine): The transform of the grid from raster_grid().
+        window (rasterio.windows.Window): The window of the grid.
+
+    Returns:
+        np.ndarray: The values with nodata as NaN.
+    """
+    import rasterio
+    from rasterio.crs import CRS
+    from rasterio.enums import Resampling
+    from rasterio.warp import reproject
+    from rasterio.windows import transform as window_transform
+
+    crs = CRS.from_user_input(crs)
+    if crs == src.crs:
+        return read_masked(src, window)
+    data = np.full((int(window.height), int(window.width)), np.nan)
+    # nearest like rioxarray's reproject, GDAL only reads the part of the source the window covers
+    reproject(rasterio.band(src, 1), data, src_transform= src.transform, src_crs= src.crs, src_nodata= src.nodata,
+              dst_transform= window_transform(window, transform), dst_crs= crs, dst_nodata= np.nan, resampling= Resampling.nearest)
+    return data
+
+def sample_points(raster_fp, x, y, crs, buffer = 0, block_size = 512, interpolate = 'bilinear'):
+    """Sample a raster at points, or average it within a distance of the points.
+
+    The points are converted to pixel indices in one operation and grouped by block, and only the blocks
+    that hold points are read, reprojected to the crs of the points if the raster is in another crs.
+
+    Args:
+        raster_fp (str): Filepath to the raster.
+        x (np.ndarray): X coordinates of the points.
+        y (np.ndarray): Y coordinates of the points.
+        crs (_type_): Crs of the points, which the raster is sampled in.
+        buffer (float, optional): Average the pixels whose centers are within buffer of the point, like zonal_stats of the buffered
+            points. Defaults to 0 which interpolates the raster at the point.
+        block_size (int, optional): Size of the blocks in pixels. Defaults to 512.
+        interpolate (str, optional): Without a buffer, 'bilinear' between the 2x2 pixel centers around the point like
+            rasterstats.point_query, falling back to the nearest of them next to nodata, or 'nearest' for the pixel the point
+            falls in. Defaults to 'bilinear'.
+
+    Returns:
+        np.ndarray: The values with NaN off the raster and where there is no data.
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    if interpolate not in ('bilinear', 'nearest'):
+        raise ValueError(f'Unknown interpolation: {interpolate}')
+    bilinear = buffer == 0 and interpolate == 'bilinear'
+    x = np.asarray(x, dtype= np.float64)
+    y = np.asarray(y, dtype= np.float64)
+    values = np.full(len(x), np.nan)
+    with rasterio.open(raster_fp) as src:
+        transform, width, height = raster_grid(src, crs)
+        fcol, frow = ~transform * (x, y)
+        if bilinear:
+            # the upper left of the 2x2 pixels whose centers surround the point
+            col = np.round(fcol).astype(np.int64) - 1
+            row = np.round(frow).astype(np.int64) - 1
+            pad = 1
+            offsets = [(0, 0), (0, 1), (1, 0), (1, 1)]
+        else:
+            col = np.floor(fcol).astype(np.int64)
+            row = np.floor(frow).astype(np.int64)
+            # pixels that can be within buffer of a point
+            pad = int(math.ceil(buffer / abs(transform.a))) if buffer > 0 else 0
+            offsets = [(dr, dc) for dr in range(-pad, pad + 1) for dc in range(-pad, pad + 1)]
+
+        near = (col >= -pad) & (col < width + pad) & (row >= -pad) & (row < height + pad)
+        block = np.clip(row, 0, height - 1) // block_size * (width // block_size + 1) + np.clip(col, 0, width - 1) // block_size
+        for b in np.unique(block[near]):
+            idx = np.flatnonzero(near & (block == b))
+            br, bc = divmod(int(b), width // block_size + 1)
+            r0, c0 = max(br * block_size - pad, 0), max(bc * block_size - pad, 0)
+            r1, c1 = min((br + 1) * block_size + pad, height), min((bc + 1) * block_size + pad, width)
+            data = read_grid_window(src, crs, transform, Window(c0, r0, c1 - c0, r1 - r0))
+
+            samples = []
+            for dr, dc in offsets:
+                r = row[idx] + dr
+                c = col[idx] + dc
+                inside = (r >= r0) & (r < r1) & (c >= c0) & (c < c1)
+                if buffer > 0:
+                    cx, cy = transform * (c + 0.5, r + 0.5)
+                    inside &= np.hypot(cx - x[idx], cy - y[idx]) <= buffer
+                v = np.full(len(idx), np.nan)
+                v[inside] = data[r[inside] - r0, c[inside] - c0]
+                samples.append(v)
+            samples = np.stack(samples, axis= 1)
+            if bilinear:
+                values[idx] = _bilinear(samples, fcol[idx] - col[idx] - 0.5, row[idx] + 1.5 - frow[idx])
+            else:
+                count = (~np.isnan(samples)).sum(axis= 1)
+                with np.errstate(invalid= 'ignore'):
+                    values[idx] = np.where(count > 0, np.nansum(samples, axis= 1) / count, np.nan)
+    return values
+
+def _bilinear(corners, ux, uy):
+    """Bilinear interpolation on the unit square of 2x2 pixel centers, the nearest center where one has no data.
+
+    Args:
+        corners (np.ndarray): (n, 4) values of the upper left, upper right, lower left and lower right centers.
+        ux (np.ndarray): Position of the points from the left centers to the right ones, 0 to 1.
+        uy (np.ndarray): Position of the points from the lower centers to the upper ones, 0 to 1.
+
+    Returns:
+        np.ndarray: The values.
+    """
+    ul, ur, ll, lr = corners.T
+    out = ll * (1 - ux) * (1 - uy) + lr * ux * (1 - uy) + ul * (1 - ux) * uy + ur * ux * uy
+    missing = np.isnan(corners).any(axis= 1)
+    nearest = (np.round(1 - uy) * 2 + np.round(ux)).astype(np.int64)
+    out[missing] = corners[missing, nearest[missing]]
+    return out
+
+def sample_polygons(raster_fp, geometries, crs, block_size = 1024):
+    """Values of the pixels whose centers are inside polygons, read block by block.
+
+    Args:
+        raster_fp (str): Filepath to the raster.
+        geometries (list): Shapely polygons in crs.
+        crs (_type_): Crs of the polygons, which the raster is sampled in.
+        block_size (int, optional): Size of the blocks in pixels. Defaults to 1024.
+
+    Returns:
+        np.ndarray: The values of the pixels with data.
+    """
+    import rasterio
+    from rasterio.features import geometry_mask
+    from rasterio.windows import from_bounds, transform as window_transform
+    from shapely.ops import unary_union
+
+    shape = unary_union(list(geometries))
+    values = []
+    with rasterio.open(raster_fp) as src:
+        transform, width, height = raster_grid(src, crs)
+        # only the blocks of the grid that the polygons overlap are read
+        window = from_bounds(*shape.bounds, transform= transform).round_offsets().round_lengths()
+        window = window.intersection(rasterio.windows.Window(0, 0, width, height))
+        for block in block_windows(int(window.width), int(window.height), block_size):
+            block = rasterio.windows.Window(block.col_off + window.col_off, block.row_off + window.row_off, block.width, block.height)
+            inside = ~geometry_mask([shape], out_shape= (int(block.height), int(block.width)), transform= window_transform(block, transform))
+            if not inside.any():
+                continue
+            data = read_grid_window(src, crs, transform, block)[inside]
+            values.append(data[~np.isnan(data)])
+    return np.concatenate(values) if len(values) > 0 else np.array([])
+
+def sample_probes(lid_path, csv_path, snowdepth_col, lat_col, lon_col, road_shp = '', csv_EPSG=4326, zone_utmcrs=32611, lid_unit="m", probe_unit="cm", use_buffer = 'no'):
+    """Sample the lidar snow depth at the probes and on the roads.
+
+    Args:
+        lid_path (str): Filepath to the lidar snow depth raster.
+        csv_path (str): Filepath to the csv of the probes.
+        snowdepth_col (str): Column of the probed snow depth.
+        lat_col (str): Column of the latitude or y coordinate of the probes.
+        lon_col (str): Column of the longitude or x coordinate of the probes.
+        road_shp (str, optional): Filepath to the road shapefile, whose 2 m buffer is snow free stable terrain. Defaults to '' for no roads.
+        csv_EPSG (int, optional): EPSG code of the probe coordinates. Defaults to 4326.
+        zone_utmcrs (int, optional): EPSG code of the UTM zone the raster is sampled in. Defaults to 32611.
+        lid_unit (str, optional): Unit of the raster, "m" or "cm". Defaults to "m".
+        probe_unit (str, optional): Unit of the probes, "m" or "cm". Defaults to "cm".
+        use_buffer (str, optional): 'no' to interpolate the raster bilinearly at each probe, else the mean within 2 m of it. Defaults to 'no'.
+
+    Returns:
+        tuple: The probes with a lidar value as a GeoDataFrame with 'Probed Snow Depth (m)', 'LiDAR Snow Depth (m)' and 'error (cm)',
+            and the lidar snow depth of the road pixels in m.
+    """
+    import pandas as pd
+    import geopandas as gpd
+
+    zone_crs = "EPSG:" + str(zone_utmcrs)
+    # read the csv
+    df = pd.read_csv(csv_path, usecols=[snowdepth_col, lat_col, lon_col])
+    # convert to geodataframe in the crs of the zone
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[lon_col], df[lat_col]), crs="EPSG:" + str(csv_EPSG))
+    gdf_utm = gdf.to_crs(zone_crs)
+
+    #Extract the LiDAR pixels at pixel or buffered region, only the blocks of the raster with probes are read and reprojected to the zone
+    buffer = 0 if use_buffer == "no" else 2
+    gdf_utm['lidar'] = sample_points(lid_path, gdf_utm.geometry.x.values, gdf_utm.geometry.y.values, zone_crs, buffer= buffer)
+
+    #convert the unit to m
+    lid_scale = 0.01 if lid_unit == "cm" else 1
+    if probe_unit == "cm":
+        gdf_utm[snowdepth_col] = gdf_utm[snowdepth_col] / 100
+    gdf_utm["lidar"] = gdf_utm["lidar"] * lid_scale
+    gdf_utm.rename(columns={snowdepth_col: 'Probed Snow Depth (m)', 'lidar': 'LiDAR Snow Depth (m)'}, inplace=True)
+    gdf_utm['error (cm)'] = (gdf_utm['Probed Snow Depth (m)'] - gdf_utm['LiDAR Snow Depth (m)']) * 100
+    gdf_utm = gdf_utm.dropna(subset=['Probed Snow Depth (m)', 'LiDAR Snow Depth (m)'])
+
+    lidar_road = np.array([])
+    if road_shp != '':
+        #sample lidar values within 2 m of the roads
+        road = gpd.read_file(road_shp).to_crs(zone_crs)
+        lidar_road = sample_polygons(lid_path, road.buffer(2).geometry, zone_crs) * lid_scale
+    return gdf_utm, lidar_road
+
+def probe_metrics(probed, lidar):
+    """Agreement of the lidar snow depth with the probes.
+
+    Args:
+        probed (np.ndarray): Probed snow depth.
+        lidar (np.ndarray): Lidar snow depth at the probes.
+
+    Returns:
+        dict: Number of probes 'n', correlation 'r' (None if undefined), 'rmse', mean bias 'mbe' (probed - lidar), 'mae' and 'nmad' (1.4826 * median absolute error).
+    """
+    probed = np.asarray(probed, dtype= np.float64)
+    lidar = np.asarray(lidar, dtype= np.float64)
+    diff = probed - lidar
+    if len(diff) == 0:
+        return {'n': 0, 'r': None, 'rmse': None, 'mbe': None, 'mae': None, 'nmad': None}
+    # the correlation is undefined for fewer than two probes or a constant series
+    r = float(np.corrcoef(probed, lidar)[0, 1]) if len(diff) > 1 and np.std(probed) > 0 and np.std(lidar) > 0 else None
+    return {'n': int(len(diff)), 'r': r, 'rmse': float(np.sqrt(np.mean(diff**2))), 'mbe': float(np.mean(diff)),
+            'mae': float(np.mean(np.abs(diff))), 'nmad': float(1.4826 * np.median(np.abs(diff)))}
+
+def road_metrics(lidar_road):
+    """Residuals of the lidar snow depth on snow free roads, which should be zero.
+
+    Args:
+        lidar_road (np.ndarray): Lidar snow depth of the road pixels.
+
+    Returns:
+        dict: Number of pixels 'n', 'mean', 'median', 'std', 'rmse' and 'nmad' (1.4826 * median absolute deviation from the median).
+    """
+    res = np.asarray(lidar_road, dtype= np.float64)
+    if len(res) == 0:
+        return {'n': 0, 'mean': None, 'median': None, 'std': None, 'rmse': None, 'nmad': None}
+    median = float(np.median(res))
+    return {'n': int(len(res)), 'mean': float(np.mean(res)), 'median': median, 'std': float(np.std(res)),
+            'rmse': float(np.sqrt(np.mean(res**2))), 'nmad': float(1.4826 * np.median(np.abs(res - median)))}
+
+def snowdepth_metrics(lid_path, csv_path, snowdepth_col, lat_col, lon_col, road_shp = '', csv_EPSG=4326, zone_utmcrs=32611, lid_unit="m", probe_unit="cm", use_buffer = 'no'):
+    """Validate a lidar snow depth raster against probes without plotting.
+
+    Takes the same arguments as sample_probes(). Nothing is drawn and no plotting library is imported, so this is the
+    one to use for sweeps over many rasters; snowdepth_val() adds the figure.
+
+    Returns:
+        dict: The probe_metrics() of the probes, with the road_metrics() of the roads as 'road' (None without road_shp).
+    """
+    gdf_utm, lidar_road = sample_probes(lid_path, csv_path, snowdepth_col, lat_col, lon_col, road_shp, csv_EPSG, zone_utmcrs,
+                                        lid_unit, probe_unit, use_buffer)
+    metrics = probe_metrics(gdf_utm['Probed Snow Depth (m)'], gdf_utm['LiDAR Snow Depth (m)'])
+    metrics['road'] = road_metrics(lidar_road) if road_shp != '' else None
+    return metrics
+
+def plot_validation(gdf_utm, metrics = None):
+    """Scatter plot of the probed and lidar snow depth with the metrics, and histogram of the errors.
+
+    Args:
+        gdf_utm (_type_): The probes from sample_probes().
+        metrics (dict, optional): The probe_metrics() to print on the plot. Defaults to None which computes them.
+
+    Returns:
+        _type_: The figure.
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    if metrics is None:
+        metrics = probe_metrics(gdf_utm['Probed Snow Depth (m)'], gdf_utm['LiDAR Snow Depth (m)'])
+    fig, axs = plt.subplots(nrows=1, ncols=2, figsize=(10, 6))
+
+    # Scatter plot of probed depth vs lidar depth
+    sns.regplot(x='Probed Snow Depth (m)', y='LiDAR Snow Depth (m)', data=gdf_utm, ax=axs[0], fit_reg=False)
+    min_val = min(gdf_utm['Probed Snow Depth (m)'].min(), gdf_utm['LiDAR Snow Depth (m)'].min())
+    max_val = max(gdf_utm['Probed Snow Depth (m)'].max(), gdf_utm['LiDAR Snow Depth (m)'].max())
+    axs[0].plot([min_val, max_val], [min_val, max_val], linestyle='--', color='black')
+
+    # Add the metrics as text to the upper left corner
+    combined_text = '\n'.join(f'{label}: {metrics[key]:.2f}' for key, label in
+                              [('r', 'r'), ('rmse', 'RMSE'), ('mbe', 'MBE'), ('mae', 'MAE'), ('nmad', 'NMAD')] if metrics[key] is not None)
+    axs[0].text(0.02, 0.98, combined_text, transform=axs[0].transAxes, color='black', bbox=dict(facecolor='white', alpha=0.8), ha='left', va='top')
+
+    # Distribution plot of error
+    sns.histplot(gdf_utm['error (cm)'], kde=True, ax=axs[1])
+    axs[1].set_xlabel('Error (cm)')
+    axs[1].set_ylabel('Frequency')
+    plt.tight_layout()
+    return fig
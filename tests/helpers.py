@@ -0,0 +1,68 @@
+"""Synthetic point clouds, rasters and DEM providers shared by the tests."""
+
+
+import laspy
+import numpy as np
+import pyproj
+
+
+def write_cloud(fp, n = 5000, size = 100.0, seed = 0):
+    """Write a random point cloud to fp."""
+    rng = np.random.default_rng(seed)
+    header = laspy.LasHeader(point_format= 1, version= '1.2')
+    header.scales = [0.01, 0.01, 0.01]
+    header.offsets = [500000, 4800000, 0]
+    las = laspy.LasData(header)
+    las.x = 500000 + rng.uniform(0, size, n)
+    las.y = 4800000 + rng.uniform(0, size, n)
+    las.z = 1500 + rng.uniform(0, 5, n)
+    las.return_number = np.ones(n, dtype= np.uint8)
+    las.number_of_returns = np.ones(n, dtype= np.uint8)
+    las.write(fp)
+    return fp
+
+
+def write_utm_cloud(fp, x0 = 500000, y0 = 4800000, size = 200.0, n = 1000, seed = 0, crs = 'EPSG:32611'):
+    """Write a random point cloud in UTM zone 11N, or another crs, to fp."""
+    rng = np.random.default_rng(seed)
+    header = laspy.LasHeader(point_format= 1, version= '1.4')
+    header.scales = [0.01, 0.01, 0.01]
+    header.offsets = [x0, y0, 0]
+    header.add_crs(pyproj.CRS(crs))
+    las = laspy.LasData(header)
+    las.x = x0 + rng.uniform(0, size, n)
+    las.y = y0 + rng.uniform(0, size, n)
+    las.z = 1500 + rng.uniform(0, 5, n)
+    las.write(fp)
+    return fp
+
+
+def write_raster(fp, data, x0 = 500000.0, y0 = 4800100.0, res = 1.0, nodata = -9999, crs = 'EPSG:32611'):
+    """Write a single band raster with its upper left corner at x0, y0."""
+    import rasterio
+    from rasterio.transform import from_origin
+
+    with rasterio.open(fp, 'w', driver= 'GTiff', width= data.shape[1], height= data.shape[0], count= 1, dtype= 'float64',
+                       nodata= nodata, crs= crs, transform= from_origin(x0, y0, res, res)) as dst:
+        dst.write(data, 1)
+    return fp
+
+
+class LocalProvider:
+    """Stand-in for py3dep that serves a planar DEM in WGS84 and counts the requests."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, wgs84_bounds, resolution):
+        import rioxarray  # noqa: F401
+        import xarray as xr
+
+        self.calls += 1
+        minx, miny, maxx, maxy = wgs84_bounds.bounds
+        step = 1e-5
+        x = np.arange(minx - 10 * step, maxx + 10 * step, step)
+        y = np.arange(maxy + 10 * step, miny - 10 * step, -step)
+        data = 1500 + 1000 * (x[None, :] - x[0]) + 1000 * (y[:, None] - y[-1])
+        dem = xr.DataArray(data, coords= {'y': y, 'x': x}, dims= ('y', 'x'))
+        return dem.rio.write_crs('EPSG:4326')
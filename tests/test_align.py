@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.align` module."""
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import laspy
+import numpy as np
+
+from snow_pc.align import align_models, transform_laz
+from tests.helpers import write_cloud, write_utm_cloud
+
+
+class TestAlignModels(unittest.TestCase):
+    """Tests for aligning the products of a point cloud together."""
+
+    def test_000_shared_reference_and_concurrent(self):
+        """The reference is prepared once and the products are aligned at the same time."""
+        references = []
+        def prepare(laz_fp, align_file, user_dem = ''):
+            references.append(laz_fp)
+            return '/site/dem.tif', '/site/buffered_area.shp'
+        # both alignments have to be running for either to pass the barrier
+        barrier = threading.Barrier(2, timeout= 10)
+        def clip(laz_fp, buff_shp, align_path, asp_dir, ref_dem = '', **kwargs):
+            self.assertEqual((buff_shp, ref_dem), ('/site/buffered_area.shp', '/site/dem.tif'))
+            barrier.wait()
+            return align_path + '-DEM.tif'
+        with mock.patch('snow_pc.align.prepare_reference', prepare), mock.patch('snow_pc.align.clip_align', clip):
+            tifs = align_models(['/site/dtm.laz', '/site/dsm.laz'], 'roads.shp', '/asp')
+        self.assertEqual(tifs, ['/site/dtm-align-DEM.tif', '/site/dsm-align-DEM.tif'])
+        self.assertEqual(references, ['/site/dtm.laz'])
+
+    def test_001_shared_transform(self):
+        """One transform is solved from the source cloud and applied to every product."""
+        solved = []
+        def prepare(laz_fp, align_file, user_dem = ''):
+            return '/site/dem.tif', '/site/buffered_area.shp'
+        def solve(laz_fp, buff_shp, align_path, asp_dir, ref_dem = ''):
+            solved.append((laz_fp, asp_dir))
+            return align_path + '-transform.txt'
+        def apply(laz_fp, transform_fp, align_path, asp_dir, ref_dem = '', **kwargs):
+            self.assertEqual(transform_fp, '/site/results/shared-align-transform.txt')
+            return align_path + '-DEM.tif'
+        with mock.patch('snow_pc.align.prepare_reference', prepare), mock.patch('snow_pc.align.solve_transform', solve), \
+             mock.patch('snow_pc.align.apply_transform', apply):
+            tifs = align_models(['/site/dtm.laz', '/site/dsm.laz'], 'roads.shp', '/asp', transform_from= '/site/results/unfiltered.json')
+        self.assertEqual(tifs, ['/site/dtm-align-DEM.tif', '/site/dsm-align-DEM.tif'])
+        self.assertEqual(solved, [('/site/results/unfiltered.json', '/asp/bin')])
+
+
+class TestTransformLaz(unittest.TestCase):
+    """Tests for applying pc_align transforms without ASP."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.transform_fp = os.path.join(self.tmp, 'run-transform.txt')
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def write_transform(self, translation):
+        """Write a pc_align transform file that translates the points."""
+        matrix = np.eye(4)
+        matrix[:3, 3] = translation
+        np.savetxt(self.transform_fp, matrix)
+
+    def test_000_without_crs(self):
+        """Points without a crs are transformed directly and keep the scales and offsets."""
+        laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'))
+        self.write_transform([1.0, -2.0, 0.25])
+        out_fp = transform_laz(laz_fp, self.transform_fp, os.path.join(self.tmp, 'out', 'out.laz'), chunk_size= 700)
+        src, out = laspy.read(laz_fp), laspy.read(out_fp)
+        np.testing.assert_array_equal(out.header.scales, src.header.scales)
+        np.testing.assert_array_equal(out.header.offsets, src.header.offsets)
+        np.testing.assert_array_equal(out.X, src.X + 100)
+        np.testing.assert_array_equal(out.Y, src.Y - 200)
+        np.testing.assert_array_equal(out.Z, src.Z + 25)
+
+    def test_001_ecef(self):
+        """Georeferenced points are transformed in ECEF, so a translation along the local vertical raises them."""
+        from pyproj import Transformer
+
+        laz_fp = write_utm_cloud(os.path.join(self.tmp, 'in.laz'))
+        to_ecef = Transformer.from_crs('EPSG:4979', 'EPSG:4978', always_xy= True)
+        lon, lat = Transformer.from_crs('EPSG:32611', 'EPSG:4326', always_xy= True).transform(500100, 4800100)
+        up = np.subtract(to_ecef.transform(lon, lat, 1), to_ecef.transform(lon, lat, 0))
+        self.write_transform(2 * up)
+        out = laspy.read(transform_laz(laz_fp, self.transform_fp, os.path.join(self.tmp, 'out.laz')))
+        src = laspy.read(laz_fp)
+        np.testing.assert_allclose(out.z - src.z, 2, atol= 0.02)
+        np.testing.assert_allclose(out.x, src.x, atol= 0.02)
+        np.testing.assert_allclose(out.y, src.y, atol= 0.02)
+        self.assertEqual(out.header.parse_crs().to_epsg(), 32611)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.batch` module."""
+
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from snow_pc.batch import read_sites, run_batch
+
+
+def write_result(in_dir, value = 1, fail = False):
+    """Stand-in for pc2snow that writes one file in the site directory."""
+    if fail:
+        raise RuntimeError(f'{in_dir} failed')
+    out_fp = os.path.join(in_dir, 'result.txt')
+    with open(out_fp, 'w') as f:
+        f.write(str(value))
+    return out_fp
+
+
+class TestBatch(unittest.TestCase):
+    """Tests for running many sites."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.sites = []
+        for name in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.tmp, name))
+            self.sites.append(os.path.join(self.tmp, name))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_read_sites(self):
+        """Sites are read from lists, json manifests and text files."""
+        txt = os.path.join(self.tmp, 'sites.txt')
+        with open(txt, 'w') as f:
+            f.write('# campaign\n' + '\n'.join(self.sites) + '\n\n')
+        self.assertEqual([s['in_dir'] for s in read_sites(txt)], self.sites)
+        manifest = os.path.join(self.tmp, 'sites.json')
+        with open(manifest, 'w') as f:
+            json.dump([self.sites[0], {'in_dir': self.sites[1], 'user_dem': 'dem.tif'}], f)
+        self.assertEqual(read_sites(manifest)[1], {'in_dir': self.sites[1], 'user_dem': 'dem.tif'})
+
+    def test_001_failures_do_not_stop_the_batch(self):
+        """Every site runs in its own directory and a failed site is reported."""
+        sites = [self.sites[0], {'in_dir': self.sites[1], 'fail': True}, {'in_dir': self.sites[2], 'value': 3}]
+        report_fp = os.path.join(self.tmp, 'report.json')
+        results = run_batch(sites, func= write_result, n_workers= 2, report_fp= report_fp, value= 2)
+        self.assertEqual([r['status'] for r in results], ['ok', 'failed', 'ok'])
+        self.assertIn('RuntimeError', results[1]['error'])
+        self.assertEqual(results[2]['outputs'], os.path.join(self.sites[2], 'result.txt'))
+        with open(results[0]['outputs']) as f:
+            self.assertEqual(f.read(), '2')
+        with open(results[2]['outputs']) as f:
+            self.assertEqual(f.read(), '3')
+        with open(report_fp) as f:
+            self.assertEqual(len(json.load(f)), 3)
+        self.assertTrue(all(r['seconds'] >= 0 for r in results))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.benchmark` module."""
+
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import laspy
+import numpy as np
+
+from snow_pc.benchmark import synthetic_site, run_benchmarks, compare_benchmarks, terrain, pdal_available
+
+
+class TestBenchmark(unittest.TestCase):
+    """Tests for the synthetic sites and the benchmark harness."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_synthetic_site(self):
+        """The site has snow over the terrain, a plowed road, canopy, outliers and a matching reference DEM."""
+        import rasterio
+
+        site = synthetic_site(os.path.join(self.tmp, 'site'), size= 60, density= 5, seed= 1)
+        for fp in site.values():
+            self.assertTrue(os.path.exists(fp))
+        las = laspy.read(site['laz'])
+        self.assertEqual(las.header.parse_crs().to_epsg(), 32611)
+        above = np.asarray(las.z) - terrain(np.asarray(las.x), np.asarray(las.y))
+        single = np.asarray(las.number_of_returns) == 1
+        self.assertAlmostEqual(np.median(above[single]), 1.0, delta= 0.1)
+        self.assertTrue((las.number_of_returns == 2).any())
+        self.assertTrue((above < -5).any() and (above > 60).any())
+        self.assertTrue((np.asarray(las.return_number) > np.asarray(las.number_of_returns)).any())
+        with rasterio.open(site['dem']) as src:
+            self.assertEqual(src.crs.to_epsg(), 32611)
+            self.assertTrue(src.bounds.left < las.header.mins[0] and src.bounds.top > las.header.maxs[1])
+
+        # the same seed writes the same site
+        again = synthetic_site(os.path.join(self.tmp, 'again'), size= 60, density= 5, seed= 1)
+        np.testing.assert_array_equal(laspy.read(again['laz']).z, las.z)
+
+    def test_run_and_compare(self):
+        """The harness times the stages, saves the results and finds the slower stages."""
+        results_fp = os.path.join(self.tmp, 'results.json')
+        cases = ['return_filtering', 'terrain_models', 'ground_segmentation', 'difference', 'validation']
+        benchmark = run_benchmarks(self.tmp, sizes= (40,), density= 4, repeats= 2, cases= cases, results_fp= results_fp)
+        with open(results_fp) as f:
+            self.assertEqual(json.load(f), benchmark)
+        results = {(r['case'], r['engine']): r for r in benchmark['results']}
+        self.assertEqual(len(results[('return_filtering', 'numpy')]['seconds']), 2)
+        self.assertEqual(results[('validation', 'numpy')]['status'], 'ok')
+        # the numpy stand-in of terrain_models runs offline, ground_segmentation has none
+        self.assertEqual(results[('terrain_models', 'numpy')]['status'], 'ok')
+        self.assertNotIn(('ground_segmentation', 'numpy'), results)
+        if not pdal_available():
+            self.assertEqual(results[('return_filtering', 'pdal')]['status'], 'skipped')
+            self.assertEqual(results[('ground_segmentation', 'pdal')]['status'], 'skipped')
+
+        # the difference case differences a DTM and a DSM, so the canopy height is not the snow depth
+        import rasterio
+        with rasterio.open(os.path.join(self.tmp, 'site_40', 'site-snowdepth.tif')) as depth, \
+             rasterio.open(os.path.join(self.tmp, 'site_40', 'site-canopyheight.tif')) as height:
+            self.assertGreater(height.read(1, masked= True).max(), depth.read(1, masked= True).max())
+
+        slower = json.loads(json.dumps(benchmark))
+        for result in slower['results']:
+            if result['case'] == 'difference':
+                result['median'] = result['median'] * 2 + 1
+        regressions = compare_benchmarks(results_fp, slower)
+        self.assertEqual([r['case'] for r in regressions], ['difference'])
+        self.assertEqual(compare_benchmarks(benchmark, benchmark), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.chunked` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import laspy
+import numpy as np
+
+from snow_pc.chunked import sample_raster, return_filter_chunked, dem_filter_chunked
+from tests.helpers import write_cloud
+
+
+def write_plane_dem(fp, z0 = 1500.0, res = 1.0):
+    """Write a 100 m DEM over the test cloud that rises 0.1 m per column."""
+    import rasterio
+    from rasterio.transform import from_origin
+
+    data = z0 + 0.1 * np.tile(np.arange(100, dtype= 'float64'), (100, 1))
+    data[:10, :10] = -9999
+    with rasterio.open(fp, 'w', driver= 'GTiff', width= 100, height= 100, count= 1, dtype= 'float64', nodata= -9999,
+                       transform= from_origin(500000, 4800100, res, res)) as dst:
+        dst.write(data[np.newaxis])
+    return fp
+
+
+class TestChunked(unittest.TestCase):
+    """Tests for the laspy and numpy filtering engine."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'))
+        las = laspy.read(self.laz_fp)
+        las.return_number[::7] = 0
+        las.z[::3] = las.z[::3] + 100
+        las.write(self.laz_fp)
+        self.dem_fp = write_plane_dem(os.path.join(self.tmp, 'dem.tif'))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_return_filter(self):
+        """Points with a zero return number are dropped whatever the chunk size."""
+        expected = np.count_nonzero(laspy.read(self.laz_fp).return_number > 0)
+        for chunk_size in (333, 1_000_000):
+            out_fp = return_filter_chunked(self.laz_fp, os.path.join(self.tmp, f'returns_{chunk_size}.laz'), chunk_size= chunk_size)
+            out = laspy.read(out_fp)
+            self.assertEqual(len(out.points), expected)
+            self.assertTrue((out.return_number > 0).all())
+
+    def test_001_sample_raster(self):
+        """Nearest takes the pixel value, bilinear interpolates between pixel centers."""
+        import rasterio
+
+        with rasterio.open(self.dem_fp) as src:
+            x = np.array([500050.2, 500050.5, 500050.75, 500005.0, 499999.0])
+            y = np.full(5, 4800050.0)
+            y[3] = 4800095.0
+            nearest = sample_raster(src, x, y)
+            bilinear = sample_raster(src, x, y, interpolation= 'bilinear')
+        np.testing.assert_allclose(nearest[:3], [1505.0, 1505.0, 1505.0])
+        np.testing.assert_allclose(bilinear[:3], [1504.97, 1505.0, 1505.025])
+        # nodata and points off the raster
+        self.assertTrue(np.isnan(nearest[3:]).all())
+        self.assertTrue(np.isnan(bilinear[3:]).all())
+
+    def test_002_dem_filter(self):
+        """Points are kept within the limits of the DEM they fall on."""
+        las = laspy.read(self.laz_fp)
+        dem = 1500.0 + 0.1 * np.floor(las.x - 500000)
+        on_dem = ~((las.x < 500010) & (las.y >= 4800090))
+        expected = np.count_nonzero(on_dem & (las.z >= dem - 1) & (las.z <= dem + 10))
+        out_fp = dem_filter_chunked(self.laz_fp, self.dem_fp, os.path.join(self.tmp, 'dem_filtered.laz'),
+                                    dem_low= 1, dem_high= 10, chunk_size= 500)
+        out = laspy.read(out_fp)
+        self.assertEqual(len(out.points), expected)
+        self.assertLess(out.z.max(), 1520)
+
+    @unittest.skipIf(shutil.which('pdal') is None, 'pdal is not installed')
+    def test_003_matches_pdal(self):
+        """The numpy engine keeps the same points as filters.mongo and filters.dem."""
+        from snow_pc.filtering import FilterChain
+
+        key = lambda las: np.sort(np.asarray(las.X, dtype= np.int64) * 10**9 + np.asarray(las.Y, dtype= np.int64))
+        pdal_fp = FilterChain(self.laz_fp).returns().dem(user_dem= self.dem_fp, dem_low= 1, dem_high= 10).write(
+            os.path.join(self.tmp, 'pdal.laz'))
+        returns_fp = return_filter_chunked(self.laz_fp, os.path.join(self.tmp, 'returns.laz'), chunk_size= 700)
+        numpy_fp = dem_filter_chunked(returns_fp, self.dem_fp, os.path.join(self.tmp, 'numpy.laz'), dem_low= 1, dem_high= 10)
+        np.testing.assert_array_equal(key(laspy.read(numpy_fp)), key(laspy.read(pdal_fp)))
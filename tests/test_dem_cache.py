@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.dem_cache` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyproj
+
+from snow_pc.common import download_dem
+from snow_pc.dem_cache import DEMCache, TiledDEMCache
+from tests.helpers import write_utm_cloud, LocalProvider
+
+
+class TestDEMCache(unittest.TestCase):
+    """Tests for the reference DEM cache."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.laz_fp = write_utm_cloud(os.path.join(self.tmp, 'in.laz'))
+        self.cache = DEMCache(os.path.join(self.tmp, 'dem_cache'))
+        self.provider = LocalProvider()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_000_hit_skips_fetch(self):
+        """A second request for the same bounds is served from the cache."""
+        first = os.path.join(self.tmp, 'first.tif')
+        second = os.path.join(self.tmp, 'second.tif')
+        download_dem(self.laz_fp, first, dem_cache= self.cache, provider= self.provider)
+        download_dem(self.laz_fp, second, dem_cache= self.cache, provider= self.provider)
+        self.assertEqual(self.provider.calls, 1)
+        with open(first, 'rb') as a, open(second, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_001_key_depends_on_resolution_and_crs(self):
+        """Different resolutions and crs do not share entries."""
+        bounds = (0, 0, 10, 10)
+        utm = pyproj.CRS('EPSG:32611')
+        self.assertEqual(self.cache.key(bounds, utm, 1), self.cache.key((0.001, 0, 10, 10), utm, 1))
+        self.assertNotEqual(self.cache.key(bounds, utm, 1), self.cache.key(bounds, utm, 3))
+        self.assertNotEqual(self.cache.key(bounds, utm, 1), self.cache.key(bounds, pyproj.CRS('EPSG:32612'), 1))
+
+    def test_002_lru_eviction(self):
+        """The least recently used entries are removed when the cache is full."""
+        cache = DEMCache(os.path.join(self.tmp, 'small_cache'), max_bytes= 250)
+        src = os.path.join(self.tmp, 'entry.bin')
+        with open(src, 'wb') as f:
+            f.write(b'0' * 100)
+        cache.put('a', src)
+        cache.put('b', src)
+        os.utime(cache.path('a'), (1, 1))
+        os.utime(cache.path('b'), (2, 2))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', src)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_003_tiles_reused_across_flights(self):
+        """Overlapping flights with different bounds only fetch the tiles that are missing."""
+        import rasterio
+
+        cache = TiledDEMCache(os.path.join(self.tmp, 'tile_cache'), tile_size= 500)
+        flights = [write_utm_cloud(os.path.join(self.tmp, f'flight{i}.laz'), x0= x0, seed= i) for i, x0 in enumerate([500010, 500110, 500390])]
+        dems = []
+        for i, flight in enumerate(flights):
+            dems.append(download_dem(flight, os.path.join(self.tmp, f'dem{i}.tif'), dem_cache= cache, provider= self.provider)[0])
+        # the second flight lies in the cached tile, the third one needs the next tile
+        self.assertEqual(self.provider.calls, 2)
+
+        with rasterio.open(dems[0]) as a, rasterio.open(dems[1]) as b:
+            self.assertEqual(a.res, (1.0, 1.0))
+            # both windows sit on the same pixel grid and agree where they overlap
+            window = a.window(500150, 4800050, 500200, 4800150)
+            other = b.window(500150, 4800050, 500200, 4800150)
+            np.testing.assert_array_equal(a.read(1, window= window), b.read(1, window= other))
+            self.assertLessEqual(a.bounds.left, 500010)
+            self.assertGreaterEqual(a.bounds.top, 4800200 - 1)
+
+    def test_004_resolution_in_meters(self):
+        """The resolution in meters is converted to the units of the las crs, and geographic crs are rejected."""
+        import rasterio
+
+        cache = TiledDEMCache(os.path.join(self.tmp, 'tile_cache'), tile_size= 2000)
+        # the same area in the US survey feet of Idaho West
+        feet_fp = write_utm_cloud(os.path.join(self.tmp, 'feet.laz'), x0= 2292204, y0= 616972, size= 600.0, crs= 'EPSG:2243')
+        dem_fp = download_dem(feet_fp, os.path.join(self.tmp, 'feet.tif'), dem_cache= cache, provider= self.provider, resolution= 1)[0]
+        with rasterio.open(dem_fp) as src:
+            np.testing.assert_allclose(src.res, (1 / 0.3048006096, 1 / 0.3048006096))
+            self.assertLessEqual(src.bounds.left, 2292204)
+            self.assertGreaterEqual(src.bounds.right, 2292204 + 600 - 4)
+        with self.assertRaises(ValueError):
+            cache.get_dem((-117, 43, -116.99, 43.01), pyproj.CRS('EPSG:4326'), 1, os.path.join(self.tmp, 'wgs.tif'), self.provider)
+
+    def test_005_environment_untouched(self):
+        """Downloads do not change the process environment, which threads of other sites share."""
+        before = dict(os.environ)
+        download_dem(self.laz_fp, os.path.join(self.tmp, 'dem.tif'), dem_cache= self.cache, provider= self.provider)
+        self.assertEqual(dict(os.environ), before)
+        self.assertIn('HYRIVER_CACHE_NAME', os.environ)
+
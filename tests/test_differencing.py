@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.differencing` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from snow_pc.differencing import difference_rasters
+from tests.helpers import write_raster
+
+
+class TestDifferencing(unittest.TestCase):
+    """Tests for the block by block differencing."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        rows, cols = np.mgrid[0:100, 0:100]
+        self.ref_fp = write_raster(os.path.join(self.tmp, 'ref.tif'), 1500.0 + 0.1 * cols)
+        # the snow on raster has half the resolution, a nodata hole and is shifted by 20 m
+        snowon = 1502.0 + 0.1 * np.floor(np.arange(0, 60, 0.5))[np.newaxis, :].repeat(120, axis= 0) + 0.1 * 20
+        snowon[:10, :10] = -9999
+        self.src_fp = write_raster(os.path.join(self.tmp, 'snowon.tif'), snowon, x0= 500020.0, res= 0.5)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_difference_on_reference_grid(self):
+        """The difference is on the reference grid, with NaN where either raster has no data."""
+        import rasterio
+
+        out_fp = difference_rasters(self.src_fp, self.ref_fp, os.path.join(self.tmp, 'depth.tif'), block_size= 32)
+        with rasterio.open(out_fp) as out, rasterio.open(self.ref_fp) as ref:
+            self.assertEqual((out.transform, out.width, out.height), (ref.transform, ref.width, ref.height))
+            self.assertEqual(out.profile['compress'], 'deflate')
+            self.assertTrue(out.profile['tiled'])
+            data = out.read(1)
+        # outside the snow on raster and in its hole
+        self.assertTrue(np.isnan(data[:, :20]).all())
+        self.assertTrue(np.isnan(data[:5, 20:25]).all())
+        np.testing.assert_allclose(data[10:60, 25:80], 2.0, atol= 1e-4)
+        self.assertTrue(np.isnan(data[60:]).all())
+
+    def test_001_block_size_does_not_change_the_result(self):
+        """Blocks that do not divide the raster give the same result."""
+        import rasterio
+
+        a = difference_rasters(self.src_fp, self.ref_fp, os.path.join(self.tmp, 'a.tif'), block_size= 37)
+        b = difference_rasters(self.src_fp, self.ref_fp, os.path.join(self.tmp, 'b.tif'), block_size= 4096)
+        with rasterio.open(a) as a, rasterio.open(b) as b:
+            np.testing.assert_array_equal(a.read(1), b.read(1))
+
+    def test_002_plan_matches_warp(self):
+        """The plan gives the same values as a GDAL warp, in the same crs and across crs."""
+        import rasterio
+        from rasterio.enums import Resampling
+        from rasterio.vrt import WarpedVRT
+        from rasterio.windows import Window
+        from snow_pc.differencing import ResamplingPlan, read_masked
+
+        rows, cols = np.mgrid[0:80, 0:80]
+        wgs_fp = write_raster(os.path.join(self.tmp, 'wgs.tif'), 1500.0 + rows + 0.5 * cols, x0= -117.0, y0= 43.3539,
+                              res= 1.5e-5, crs= 'EPSG:4326')
+        for src_fp in (self.src_fp, wgs_fp):
+            with rasterio.open(src_fp) as src, rasterio.open(self.ref_fp) as ref:
+                plan = ResamplingPlan.from_rasters(src, ref, cache_dir= os.path.join(self.tmp, 'plan'))
+                vrt = WarpedVRT(src, crs= ref.crs, transform= ref.transform, width= ref.width, height= ref.height,
+                                resampling= Resampling.nearest, src_nodata= src.nodata, nodata= np.nan, dtype= 'float64')
+                window = Window(0, 0, ref.width, ref.height)
+                expected = read_masked(vrt, window)
+                values = plan.apply(src, window)
+                vrt.close()
+            # GDAL may round a few pixel centers on the cell edges the other way
+            both = ~np.isnan(expected) & ~np.isnan(values)
+            self.assertGreater(np.mean(values[both] == expected[both]), 0.99)
+            self.assertGreater(both.sum(), 0.9 * (~np.isnan(expected)).sum())
+
+    def test_003_plan_is_shared(self):
+        """Rasters on the same grid share one plan."""
+        import rasterio
+        from snow_pc.differencing import resampling_plan
+
+        dsm_fp = os.path.join(self.tmp, 'dsm.tif')
+        shutil.copy(self.src_fp, dsm_fp)
+        with rasterio.open(self.src_fp) as dtm, rasterio.open(dsm_fp) as dsm, rasterio.open(self.ref_fp) as ref:
+            self.assertIs(resampling_plan(dtm, ref), resampling_plan(dsm, ref))
+            self.assertIsNot(resampling_plan(dtm, ref), resampling_plan(dtm, ref, resampling= 'bilinear'))
+
+    def test_004_bilinear(self):
+        """Bilinear interpolates between the pixel centers of the source."""
+        import rasterio
+        from rasterio.windows import Window
+        from snow_pc.differencing import ResamplingPlan
+
+        with rasterio.open(self.ref_fp) as src, rasterio.open(self.src_fp) as dst:
+            # the 0.5 m grid samples the 1 m reference a quarter pixel either side of its centers
+            values = ResamplingPlan.from_rasters(src, dst, resampling= 'bilinear').apply(src, Window(0, 0, 4, 1))
+        np.testing.assert_allclose(values[0], 1500.0 + 0.1 * np.array([19.75, 20.25, 20.75, 21.25]))
+
+    def test_005_plan_cache_is_removed(self):
+        """The temporary block indices are removed with the plan and the shared plans are bounded."""
+        import rasterio
+        from rasterio.windows import Window
+        from snow_pc import differencing
+        from snow_pc.differencing import ResamplingPlan, resampling_plan
+
+        rows, cols = np.mgrid[0:80, 0:80]
+        wgs_fp = write_raster(os.path.join(self.tmp, 'wgs.tif'), 1500.0 + rows + 0.5 * cols, x0= -117.0, y0= 43.3539,
+                              res= 1.5e-5, crs= 'EPSG:4326')
+        with rasterio.open(wgs_fp) as src, rasterio.open(self.ref_fp) as ref:
+            with ResamplingPlan.from_rasters(src, ref) as plan:
+                plan.apply(src, Window(0, 0, 10, 10))
+                cache_dir = plan._tmp_dir.name
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertFalse(os.path.exists(cache_dir))
+
+            shared = resampling_plan(src, ref)
+            shared.apply(src, Window(0, 0, 10, 10))
+            cache_dir = shared._tmp_dir.name
+        # plans to other grids push the first one out
+        for i in range(differencing.MAX_PLANS):
+            other_fp = write_raster(os.path.join(self.tmp, f'ref{i}.tif'), np.zeros((10, 10)), x0= 500000.0 + i)
+            with rasterio.open(wgs_fp) as src, rasterio.open(other_fp) as ref:
+                resampling_plan(src, ref)
+        self.assertLessEqual(len(differencing._plans), differencing.MAX_PLANS)
+        self.assertFalse(os.path.exists(cache_dir))
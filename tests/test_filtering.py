@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.filtering` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import laspy
+
+from snow_pc.filtering import FilterChain
+
+
+class TestFilterChain(unittest.TestCase):
+    """Tests for chaining the filters into one pipeline."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.laz_fp = os.path.join(self.tmp, 'in.laz')
+        self.dem_fp = os.path.join(self.tmp, 'user_dem.tif')
+        open(self.dem_fp, 'w').close()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_chain_reads_and_writes_once(self):
+        """Chained stages share one reader and only the end of the chain is written."""
+        chain = FilterChain(self.laz_fp).returns().dem(user_dem= self.dem_fp, dem_low= 10, dem_high= 30).elm().outlier(mean_k= 8)
+        stages = chain.pipeline('out.laz')['pipeline']
+        self.assertEqual([s['type'] for s in stages],
+                         ['readers.las', 'filters.mongo', 'filters.dem', 'filters.elm', 'filters.outlier', 'writers.las'])
+        self.assertEqual(stages[2]['limits'], 'Z[10:30]')
+        self.assertEqual(stages[2]['raster'], os.path.join(self.tmp, 'dem.tif'))
+        self.assertEqual(stages[4]['mean_k'], 8)
+
+    def test_001_segmentation_outputs(self):
+        """Segmentation stages match the lidar and SfM variants and can add a raster."""
+        lidar = FilterChain(self.laz_fp).ground().pipeline('g.laz', out_tif= 'g.tif')['pipeline']
+        self.assertEqual([s['type'] for s in lidar], ['readers.las', 'filters.smrf', 'filters.range', 'writers.las', 'writers.gdal'])
+        sfm = FilterChain(self.laz_fp).surface(lidar_pc= 'no').pipeline('s.laz', las_options= {"minor_version": 4})['pipeline']
+        self.assertEqual(sfm[1]['limits'], 'Classification[2:6]')
+        self.assertEqual(sfm[-1]['minor_version'], 4)
+
+
+class TestThreadSafety(unittest.TestCase):
+    """Tests for running stages of several directories from threads."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        from tests.helpers import write_utm_cloud
+
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.sites = []
+        for i in range(4):
+            site = os.path.join(self.tmp, f'site_{i}')
+            os.makedirs(site)
+            las = laspy.read(write_utm_cloud(os.path.join(site, 'in.laz'), n= 500 * (i + 1), seed= i))
+            las.return_number[:] = 1
+            las.number_of_returns[:] = 1
+            las.write(os.path.join(site, 'in.laz'))
+            self.sites.append(site)
+        # work from an unrelated directory so relative paths would land in the wrong place
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def run_site(self, site):
+        """Download a DEM and run the return and DEM filters of one site with the default outputs."""
+        from snow_pc.common import download_dem
+        from snow_pc.filtering import return_filtering, dem_filtering
+        from tests.helpers import LocalProvider
+
+        laz_fp = os.path.join(site, 'in.laz')
+        dem_fp, _, _ = download_dem(laz_fp, 'reference.tif', dem_cache= False, provider= LocalProvider())
+        returns_fp = return_filtering(laz_fp, engine= 'numpy')
+        dem_filtered_fp = dem_filtering(returns_fp, user_dem= dem_fp, dem_low= 1000, dem_high= 1000, engine= 'numpy')
+        return dem_fp, returns_fp, dem_filtered_fp
+
+    def test_000_threads_write_to_their_own_directory(self):
+        """Every output of every site lands in the directory of that site."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers= 4) as executor:
+            outputs = list(executor.map(self.run_site, self.sites))
+        for i, (site, fps) in enumerate(zip(self.sites, outputs)):
+            for fp in fps:
+                self.assertEqual(os.path.dirname(fp), site)
+                self.assertTrue(os.path.exists(fp))
+            self.assertEqual(laspy.read(fps[1]).header.point_count, 500 * (i + 1))
+            self.assertTrue(os.path.exists(os.path.join(site, 'dem.tif')))
+        self.assertEqual(os.getcwd(), self.tmp)
+        self.assertFalse(any(name.endswith(('.laz', '.tif')) for name in os.listdir(self.tmp)))
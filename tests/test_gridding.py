@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.gridding` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import laspy
+import numpy as np
+
+from snow_pc.common import iter_chunks
+from snow_pc.gridding import GridAccumulator, bin_strips, grid_laz, make_grid, raster_grid, strip_rows, NODATA
+from tests.helpers import write_cloud
+
+
+class TestGridding(unittest.TestCase):
+    """Tests for the streaming rasterizer."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.grid = {'origin_x': 0.0, 'origin_y': 0.0, 'resolution': 1.0, 'width': 3, 'height': 2}
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_cell_statistics(self):
+        """Points count for the cells whose center is within radius."""
+        stats = GridAccumulator(self.grid, radius= 0.5)
+        # two points in the lower left cell, one on the center of the upper right cell
+        stats.add(np.array([0.25, 0.5, 2.5]), np.array([0.5, 0.5, 1.5]), np.array([1.0, 3.0, 7.0]))
+        np.testing.assert_array_equal(stats.result('count'), [[0, 0, 1], [2, 0, 0]])
+        np.testing.assert_array_equal(stats.result('min'), [[NODATA, NODATA, 7], [1, NODATA, NODATA]])
+        np.testing.assert_array_equal(stats.result('max')[1, 0], 3)
+        np.testing.assert_array_equal(stats.result('mean')[1, 0], 2)
+        # the point on the cell center takes the idw value
+        self.assertEqual(stats.result('idw')[1, 0], 3)
+        self.assertEqual(stats.result('idw')[0, 2], 7)
+
+    def test_001_idw_weights(self):
+        """idw weights the points by the inverse squared distance to the cell center."""
+        stats = GridAccumulator(self.grid)
+        stats.add(np.array([0.75, 0.0]), np.array([0.5, 0.5]), np.array([10.0, 20.0]))
+        # distances 0.25 and 0.5 give weights 16 and 4
+        self.assertAlmostEqual(stats.result('idw')[1, 0], (16 * 10 + 4 * 20) / 20)
+
+    def test_002_chunks_do_not_change_the_raster(self):
+        """The raster is the same whatever the chunk size and is written tiled and compressed."""
+        import rasterio
+
+        laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'), n= 3000, size= 40.0)
+        small = grid_laz(laz_fp, os.path.join(self.tmp, 'small.tif'), output_type= 'all', chunk_size= 250)
+        large = grid_laz(laz_fp, os.path.join(self.tmp, 'large.tif'), output_type= 'all')
+        with rasterio.open(small) as a, rasterio.open(large) as b:
+            np.testing.assert_allclose(a.read(), b.read())
+            self.assertEqual(a.descriptions, ('min', 'max', 'mean', 'idw', 'count'))
+            self.assertEqual(a.profile['compress'], 'deflate')
+            self.assertEqual(a.count, 5)
+            grid = make_grid(laz_fp)
+            self.assertEqual((a.width, a.height), (grid['width'], grid['height']))
+            self.assertEqual(a.read(5).sum() > 3000, True)
+
+    @unittest.skipIf(shutil.which('pdal') is None, 'pdal is not installed')
+    def test_003_matches_writers_gdal(self):
+        """The idw raster matches writers.gdal."""
+        import rasterio
+        from snow_pc.pipeline import run_pipeline
+
+        laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'), n= 3000, size= 40.0)
+        pdal_fp = os.path.join(self.tmp, 'pdal.tif')
+        run_pipeline({"pipeline": [laz_fp, {"type": "writers.gdal", "filename": pdal_fp, "resolution": 1.0, "output_type": "idw"}]})
+        native_fp = grid_laz(laz_fp, os.path.join(self.tmp, 'native.tif'))
+        with rasterio.open(pdal_fp) as a, rasterio.open(native_fp) as b:
+            self.assertEqual(a.transform, b.transform)
+            np.testing.assert_allclose(a.read(1), b.read(1), rtol= 1e-6)
+
+    def test_004_only_requested_accumulators(self):
+        """Only the accumulators of the requested outputs are allocated, in 32 bits."""
+        stats = GridAccumulator(self.grid, output_types= ['min'])
+        self.assertFalse(hasattr(stats, 'max') or hasattr(stats, 'sum') or hasattr(stats, 'weights'))
+        self.assertEqual((stats.count.dtype, stats.min.dtype), (np.int32, np.float32))
+        stats.add(np.array([0.5]), np.array([0.5]), np.array([2.0]))
+        self.assertEqual(stats.result('min').dtype, np.float32)
+        with self.assertRaises(ValueError):
+            stats.result('idw')
+        with self.assertRaises(ValueError):
+            GridAccumulator(self.grid, output_types= ['median'])
+
+    def test_005_strips_do_not_change_the_raster(self):
+        """Accumulating in strips of rows gives the raster of a single pass."""
+        import rasterio
+
+        laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'), n= 3000, size= 40.0)
+        grid = make_grid(laz_fp)
+        # a budget of a few rows of accumulators
+        max_memory = 3 * grid['width'] * 60
+        self.assertEqual(strip_rows(grid, ['min', 'max', 'mean', 'idw', 'count'], max_memory), 3)
+        # the point cloud is read once, not once per strip
+        with mock.patch('snow_pc.gridding.iter_chunks', side_effect= iter_chunks) as read:
+            strips = grid_laz(laz_fp, os.path.join(self.tmp, 'strips.tif'), output_type= 'all', max_memory= max_memory, chunk_size= 700)
+        self.assertEqual(read.call_count, 1)
+        whole = grid_laz(laz_fp, os.path.join(self.tmp, 'whole.tif'), output_type= 'all')
+        with rasterio.open(strips) as a, rasterio.open(whole) as b:
+            self.assertEqual(a.dtypes[0], 'float32')
+            np.testing.assert_array_equal(a.read(), b.read())
+
+    def test_006_raster_grid(self):
+        """The grid of a raster keeps its upper left corner and covers it at another resolution."""
+        from tests.helpers import write_raster
+
+        raster_fp = write_raster(os.path.join(self.tmp, 'dem.tif'), np.zeros((20, 30)), x0= 10.5, y0= 120.0)
+        self.assertEqual(raster_grid(raster_fp), {'origin_x': 10.5, 'origin_y': 100.0, 'resolution': 1.0, 'width': 30, 'height': 20})
+        self.assertEqual(raster_grid(raster_fp, 0.5), {'origin_x': 10.5, 'origin_y': 100.0, 'resolution': 0.5, 'width': 60, 'height': 40})
+        grid = raster_grid(raster_fp, 3.0)
+        self.assertEqual((grid['width'], grid['height'], grid['origin_y']), (10, 7, 99.0))
+
+    def test_007_bin_strips(self):
+        """Every point within radius of the cell centers of a strip is binned into it, in order."""
+        y = np.random.default_rng(0).uniform(-5, 105, 2000)
+        top, res, rows, radius = 100.0, 1.0, 7, 1.5
+        binned = dict(bin_strips(y, top, res, rows, radius, 15))
+        for i in range(15):
+            first, last = i * rows, min((i + 1) * rows, 100)
+            near = np.flatnonzero((y <= top - (first + 0.5) * res + radius) & (y >= top - (last - 0.5) * res - radius))
+            self.assertTrue(np.isin(near, binned.get(i, [])).all())
+            self.assertTrue((np.diff(binned.get(i, [])) > 0).all())
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+"""Tests for the import time of `snow_pc` package."""
+
+
+import subprocess
+import sys
+import unittest
+
+# heavy plotting, validation and download libraries that must load only when used
+LAZY_MODULES = ['matplotlib', 'seaborn', 'sklearn', 'py3dep', 'rasterstats', 'geopandas', 'rioxarray', 'xarray', 'pandas']
+
+# cumulative import time of snow_pc in microseconds. Loading every dependency took about 2.5 s
+IMPORT_BUDGET_US = 1_000_000
+
+
+class TestImport(unittest.TestCase):
+    """Tests that `import snow_pc` stays fast."""
+
+    def test_000_heavy_modules_are_lazy(self):
+        """Importing snow_pc does not import the heavy libraries."""
+        code = 'import sys, snow_pc; print(" ".join(sorted(m for m in sys.modules if "." not in m)))'
+        loaded = subprocess.run([sys.executable, '-c', code], capture_output= True, text= True, check= True).stdout.split()
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, loaded)
+
+    def test_001_import_time_budget(self):
+        """The cumulative import time of snow_pc reported by -X importtime is within the budget."""
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import snow_pc'], capture_output= True, text= True, check= True)
+        line = [line for line in result.stderr.splitlines() if line.rstrip().endswith('| snow_pc')][-1]
+        cumulative = int(line.split('|')[1])
+        self.assertLess(cumulative, IMPORT_BUDGET_US)
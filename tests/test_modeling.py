@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.modeling` module."""
+
+
+import unittest
+
+from snow_pc.modeling import elevation_pipeline
+
+
+class TestElevationPipeline(unittest.TestCase):
+    """Tests for the single pass terrain and surface pipeline."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.pipeline = elevation_pipeline('in.laz', 'dem.tif', 'dtm.laz', 'dtm.tif', 'dsm.laz', 'dsm.tif')['pipeline']
+
+    def test_000_shared_prefix_runs_once(self):
+        """The reader and the expensive filters appear only once."""
+        types = [stage['type'] for stage in self.pipeline]
+        for stage_type in ['readers.las', 'filters.dem', 'filters.mongo', 'filters.elm', 'filters.outlier']:
+            self.assertEqual(types.count(stage_type), 1)
+
+    def test_001_branches_write_both_models(self):
+        """Both branches start from the filtered points and write their own outputs."""
+        branches = [stage for stage in self.pipeline if stage.get('inputs') == ['filtered']]
+        self.assertEqual(len(branches), 2)
+        outputs = [stage['filename'] for stage in self.pipeline if stage['type'].startswith('writers')]
+        self.assertEqual(sorted(outputs), ['dsm.laz', 'dsm.tif', 'dtm.laz', 'dtm.tif'])
+
+    def test_002_sfm_skips_return_filter(self):
+        """SfM point clouds do not use the return filter or filters.smrf."""
+        pipeline = elevation_pipeline('in.laz', 'dem.tif', 'dtm.laz', 'dtm.tif', 'dsm.laz', 'dsm.tif', lidar_pc = 'no')['pipeline']
+        types = [stage['type'] for stage in pipeline]
+        self.assertNotIn('filters.mongo', types)
+        self.assertNotIn('filters.smrf', types)
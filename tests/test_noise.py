@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.noise` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import laspy
+import numpy as np
+from scipy.spatial import cKDTree
+
+from snow_pc.noise import mean_knn_distances, statistical_outliers, read_xyz, elm_grid, elm_cells, elm_cutoffs
+from snow_pc.filtering import outlier_filtering, elm_filtering
+from snow_pc.benchmark import synthetic_site
+from snow_pc.pipeline import has_python_pdal
+from tests.helpers import write_cloud
+
+
+def brute_force_outliers(xyz, mean_k = 20, multiplier = 3):
+    """filters.outlier with one KD-tree over the whole cloud."""
+    d, _ = cKDTree(xyz).query(xyz, k= mean_k + 1)
+    mean = d[:, 1:].mean(axis= 1)
+    return mean, mean >= mean.mean() + multiplier * mean.std(ddof= 1)
+
+def brute_force_elm(xyz, grid, threshold = 1.0):
+    """filters.elm with every point of each cell sorted in memory."""
+    noise = np.zeros(len(xyz), dtype= bool)
+    cells = elm_cells(grid, xyz[:, 0], xyz[:, 1])
+    for cell in np.unique(cells):
+        ids = np.flatnonzero(cells == cell)
+        ids = ids[np.argsort(xyz[ids, 2], kind= 'stable')]
+        for i in range(len(ids) - 1):
+            if xyz[ids[i + 1], 2] - xyz[ids[i], 2] > threshold:
+                noise[ids[:i + 1]] = True
+            else:
+                break
+    return noise
+
+
+class TestStatisticalOutliers(unittest.TestCase):
+    """Tests for the native statistical outlier filter."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'), n= 4000)
+        # a few points far above and below the surface
+        las = laspy.read(self.laz_fp)
+        z = np.asarray(las.z).copy()
+        z[:10] += 80
+        z[10:20] -= 40
+        las.z = z
+        las.write(self.laz_fp)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_tiles_match_one_tree(self):
+        """Small tiles with a narrow buffer give the distances of one tree over the whole cloud."""
+        xyz = read_xyz(self.laz_fp)
+        expected, _ = brute_force_outliers(xyz)
+        for tile_size, buffer in [(500.0, 30.0), (10.0, 1.0), (7.0, 0.0)]:
+            np.testing.assert_allclose(mean_knn_distances(xyz, tile_size= tile_size, buffer= buffer, n_workers= 4), expected)
+
+    def test_outliers(self):
+        """The outliers are the points above the global threshold and include the displaced points."""
+        xyz = read_xyz(self.laz_fp)
+        _, expected = brute_force_outliers(xyz, mean_k= 8, multiplier= 2)
+        outliers = statistical_outliers(xyz, mean_k= 8, multiplier= 2, tile_size= 25.0, buffer= 5.0)
+        np.testing.assert_array_equal(outliers, expected)
+        self.assertTrue(outliers[:20].all())
+        self.assertFalse(statistical_outliers(xyz[:1]).any())
+
+    def test_outlier_filtering_engine(self):
+        """The numpy engine keeps every point and sets the outliers to class 7."""
+        out_fp = outlier_filtering(self.laz_fp, engine= 'numpy', chunk_size= 1000)
+        las = laspy.read(out_fp)
+        _, expected = brute_force_outliers(read_xyz(self.laz_fp))
+        self.assertEqual(len(las.points), 4000)
+        np.testing.assert_array_equal(np.asarray(las.classification) == 7, expected)
+
+    @unittest.skipUnless(has_python_pdal(), 'python-pdal is not installed')
+    def test_matches_pdal(self):
+        """The numpy engine marks the same points as filters.outlier."""
+        pdal_fp = outlier_filtering(self.laz_fp, out_fp= 'pdal.laz')
+        numpy_fp = outlier_filtering(self.laz_fp, out_fp= 'numpy.laz', engine= 'numpy')
+        np.testing.assert_array_equal(np.asarray(laspy.read(pdal_fp).classification) == 7,
+                                      np.asarray(laspy.read(numpy_fp).classification) == 7)
+
+
+class TestELM(unittest.TestCase):
+    """Tests for the streaming ELM filter."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.site = synthetic_site(self.tmp, size= 60, density= 5, noise_fraction= 0.01)
+        self.xyz = read_xyz(self.site['laz'])
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_cutoffs_match_sorting(self):
+        """The cutoffs from the lowest points of each cell classify the same noise as sorting every cell."""
+        grid = elm_grid(self.site['laz'])
+        expected = brute_force_elm(self.xyz, grid)
+        self.assertTrue(expected.any())
+        # a depth of one forces the passes with a larger depth
+        for depth in (16, 1):
+            grid, cutoffs = elm_cutoffs(self.site['laz'], depth= depth, chunk_size= 3000)
+            noise = self.xyz[:, 2] < cutoffs[elm_cells(grid, self.xyz[:, 0], self.xyz[:, 1])]
+            np.testing.assert_array_equal(noise, expected)
+
+    def test_stacked_noise(self):
+        """Noise points stacked below each other with large gaps are all noise, the highest point of a cell never is."""
+        fp = os.path.join(self.tmp, 'stack.laz')
+        las = laspy.read(self.site['laz'])
+        las.points = las.points[:3]
+        las.x = [500001.0, 500001.0, 500001.0]
+        las.y = [4800001.0, 4800001.0, 4800001.0]
+        las.z = [1480.0, 1490.0, 1500.0]
+        las.write(fp)
+        grid, cutoffs = elm_cutoffs(fp, depth= 1)
+        self.assertEqual(cutoffs.max(), 1500.0)
+
+    def test_elm_filtering_engine(self):
+        """The numpy engine keeps every point and sets the low noise to class 7."""
+        out_fp = elm_filtering(self.site['laz'], engine= 'numpy', chunk_size= 5000)
+        las = laspy.read(out_fp)
+        self.assertEqual(len(las.points), len(self.xyz))
+        np.testing.assert_array_equal(np.asarray(las.classification) == 7, brute_force_elm(self.xyz, elm_grid(self.site['laz'])))
+
+    @unittest.skipUnless(has_python_pdal(), 'python-pdal is not installed')
+    def test_matches_pdal(self):
+        """The numpy engine marks the same points as filters.elm on the benchmark cloud."""
+        pdal_fp = elm_filtering(self.site['laz'], out_fp= 'pdal.laz')
+        numpy_fp = elm_filtering(self.site['laz'], out_fp= 'numpy.laz', engine= 'numpy')
+        np.testing.assert_array_equal(np.asarray(laspy.read(pdal_fp).classification) == 7,
+                                      np.asarray(laspy.read(numpy_fp).classification) == 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
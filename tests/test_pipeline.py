@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.pipeline` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from snow_pc.pipeline import run_pipeline, run_command, has_python_pdal, PipelineError
+
+
+class TestPipeline(unittest.TestCase):
+    """Tests for the PDAL pipeline runner."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.pipeline = {"pipeline": [os.path.join(self.tmp, 'missing.laz'), os.path.join(self.tmp, 'out.laz')]}
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_unknown_backend(self):
+        """An unknown backend is rejected."""
+        with self.assertRaises(ValueError):
+            run_pipeline(self.pipeline, backend= 'gdal')
+
+    def test_001_subprocess_failure_raises(self):
+        """A failing pipeline raises instead of being ignored, and the json is saved where asked."""
+        json_fp = os.path.join(self.tmp, 'jsons', 'test.json')
+        with self.assertRaises(PipelineError):
+            run_pipeline(self.pipeline, json_fp= json_fp, backend= 'subprocess')
+        self.assertTrue(os.path.exists(json_fp))
+
+    def test_002_arrays_need_python_backend(self):
+        """Input arrays cannot be passed to the subprocess backend."""
+        with self.assertRaises(PipelineError):
+            run_pipeline(self.pipeline, backend= 'subprocess', arrays= [])
+
+    @unittest.skipUnless(has_python_pdal(), 'python-pdal is not installed')
+    def test_003_python_failure_raises(self):
+        """A failing in-process pipeline raises PipelineError."""
+        with self.assertRaises(PipelineError):
+            run_pipeline(self.pipeline, backend= 'python')
+
+    def test_004_command_exit_code(self):
+        """External tools that exit with an error or are missing raise PipelineError."""
+        import sys
+
+        self.assertEqual(run_command([sys.executable, '-c', 'print("ok")']).strip(), 'ok')
+        with self.assertRaises(PipelineError):
+            run_command([sys.executable, '-c', 'import sys; sys.exit(3)'])
+        with self.assertRaises(PipelineError):
+            run_command([os.path.join(self.tmp, 'pc_align')])
+
+    def test_005_temporary_json_removed(self):
+        """The temporary pipeline json and its metadata are removed after a run."""
+        before = set(os.listdir(tempfile.gettempdir()))
+        with self.assertRaises(PipelineError):
+            run_pipeline(self.pipeline, backend= 'subprocess')
+        after = set(os.listdir(tempfile.gettempdir()))
+        self.assertEqual([fp for fp in after - before if fp.endswith('.json')], [])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.prepare` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from snow_pc.common import read_manifest, reader_stages
+from snow_pc.prepare import prepare_pc, las2laz
+from tests.helpers import write_cloud
+
+
+class TestPrepare(unittest.TestCase):
+    """Tests for preparing the point cloud files."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        write_cloud(os.path.join(self.tmp, 'a.laz'), n= 100, seed= 0)
+        write_cloud(os.path.join(self.tmp, 'b.laz'), n= 200, seed= 1)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_000_manifest_lists_inputs(self):
+        """prepare_pc writes a manifest of the inputs instead of a merged copy."""
+        manifest_fp = prepare_pc(self.tmp)
+        self.assertTrue(manifest_fp.endswith('unfiltered.json'))
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(manifest_fp), 'unfiltered_merge.laz')))
+        manifest = read_manifest(manifest_fp)
+        self.assertEqual(len(manifest['files']), 2)
+        self.assertEqual(manifest['point_count'], 300)
+        self.assertLessEqual(manifest['bounds'][0], min(f['bounds'][0] for f in manifest['files']))
+
+    def test_001_reader_stages(self):
+        """A manifest is read as one reader per file followed by a merge."""
+        stages = reader_stages(prepare_pc(self.tmp))
+        self.assertEqual([s['type'] for s in stages], ['readers.las', 'readers.las', 'filters.merge'])
+        self.assertEqual(reader_stages('in.laz'), [{"type": "readers.las", "filename": 'in.laz'}])
+
+    def test_002_las2laz_skips_current_files(self):
+        """LAS files with an up to date LAZ file are not converted again."""
+        las_dir = os.path.join(self.tmp, 'las')
+        os.makedirs(las_dir)
+        write_cloud(os.path.join(las_dir, 'current.las'), n= 100)
+        write_cloud(os.path.join(las_dir, 'current.laz'), n= 100)
+        write_cloud(os.path.join(las_dir, 'stale.las'), n= 100)
+        write_cloud(os.path.join(las_dir, 'stale.laz'), n= 50)
+        summary = las2laz(las_dir, n_workers= 2)
+        self.assertEqual(summary['skipped'], [os.path.join(las_dir, 'current.las')])
+        # the stale file is converted, and reported as failed if pdal is not installed
+        converted = summary['converted'] + [failed[0] for failed in summary['failed']]
+        self.assertEqual(converted, [os.path.join(las_dir, 'stale.las')])
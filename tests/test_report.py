@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.report` module."""
+
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from snow_pc.report import run_report, instrumented, point_count, active_report, in_run
+from snow_pc.stages import StageCache
+from snow_pc.filtering import return_filtering
+from tests.helpers import write_cloud
+
+
+@instrumented
+def empty_stage(laz_fp):
+    """A stage that writes a point cloud without points."""
+    import laspy
+
+    out_fp = laz_fp.replace('.laz', '-empty.laz')
+    with laspy.open(laz_fp) as reader:
+        header = reader.header
+    with laspy.open(out_fp, mode= 'w', header= header) as writer:
+        pass
+    return out_fp
+
+@instrumented
+def child_stage(megabytes):
+    """A stage whose child process holds memory for a moment."""
+    import sys
+    import subprocess
+
+    subprocess.run([sys.executable, '-c', f'import time; b = bytearray({megabytes} * 2**20); time.sleep(0.5)'], check= True)
+
+@instrumented
+def failing_stage(laz_fp):
+    """A stage that fails."""
+    raise RuntimeError('no ground points')
+
+
+class TestReport(unittest.TestCase):
+    """Tests for the stage instrumentation."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'), n= 1000)
+        self.report_fp = os.path.join(self.tmp, 'results', 'run_report.json')
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def read_report(self):
+        with open(self.report_fp) as f:
+            return json.load(f)
+
+    def test_point_count(self):
+        """Point counts come from the headers of files and directories."""
+        self.assertEqual(point_count(self.laz_fp), 1000)
+        self.assertEqual(point_count(self.tmp), 1000)
+        self.assertIsNone(point_count(os.path.join(self.tmp, 'missing.laz')))
+
+    def test_stages_are_recorded(self):
+        """An instrumented stage records its time, memory, I/O and point counts in the saved report."""
+        with run_report(os.path.join(self.tmp, 'results')):
+            out_fp = return_filtering(self.laz_fp, engine= 'numpy')
+            # a nested run records into the outer report
+            with run_report(os.path.join(self.tmp, 'other')) as report:
+                self.assertIs(report, active_report())
+                empty_stage(self.laz_fp)
+        self.assertIsNone(active_report())
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'other', 'run_report.json')))
+
+        stages = self.read_report()['stages']
+        self.assertEqual([stage['name'] for stage in stages], ['return_filtering', 'empty_stage'])
+        stage = stages[0]
+        self.assertEqual(stage['status'], 'ok')
+        self.assertEqual(stage['input_points'], {self.laz_fp: 1000})
+        self.assertEqual(stage['output_points'], {out_fp: 1000})
+        self.assertGreaterEqual(stage['seconds'], 0)
+        if stage['peak_rss'] is not None:
+            self.assertGreater(stage['peak_rss'], 0)
+        if stage['bytes_read'] is not None:
+            self.assertGreater(stage['bytes_read'], 0)
+            self.assertGreater(stage['bytes_written'], 0)
+        # a stage that silently produced no points is flagged
+        self.assertEqual(stages[1]['status'], 'empty')
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), 'needs /proc')
+    def test_children_memory(self):
+        """The memory of the child processes of each stage is sampled, also below the peak of earlier children."""
+        with run_report(os.path.join(self.tmp, 'results')):
+            child_stage(120)
+            child_stage(40)
+        large, small = self.read_report()['stages']
+        self.assertGreater(large['peak_rss_children'], 120 * 2**20)
+        self.assertGreater(small['peak_rss_children'], 40 * 2**20)
+        self.assertLess(small['peak_rss_children'], 120 * 2**20)
+        self.assertIn('children_bytes_read', small)
+
+    def test_failed_and_skipped_stages(self):
+        """A failed stage is recorded and raised, and a stage skipped by the stage cache is recorded as skipped."""
+        stages = StageCache(os.path.join(self.tmp, 'results'))
+        stages.run('copy', lambda: shutil.copy(self.laz_fp, os.path.join(self.tmp, 'copy.laz')), inputs= [self.laz_fp])
+        with self.assertRaises(RuntimeError):
+            with run_report(os.path.join(self.tmp, 'results')):
+                stages.run('copy', lambda: shutil.copy(self.laz_fp, os.path.join(self.tmp, 'copy.laz')), inputs= [self.laz_fp])
+                failing_stage(self.laz_fp)
+
+        recorded = self.read_report()['stages']
+        self.assertEqual(recorded[0], {'name': 'copy', 'status': 'skipped'})
+        self.assertEqual(recorded[1]['status'], 'failed')
+        self.assertIn('no ground points', recorded[1]['error'])
+
+    def test_runs_in_threads(self):
+        """Runs in threads keep their own reports, and in_run() records a worker thread into the run of its caller."""
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        both_started = threading.Barrier(2)
+        def run(name):
+            with run_report(os.path.join(self.tmp, name)):
+                both_started.wait()
+                with ThreadPoolExecutor(max_workers= 1) as executor:
+                    executor.submit(in_run(empty_stage), self.laz_fp).result()
+                    # without in_run the worker is outside of the run
+                    executor.submit(empty_stage, self.laz_fp).result()
+
+        threads = [threading.Thread(target= run, args= (name,)) for name in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name in ('a', 'b'):
+            with open(os.path.join(self.tmp, name, 'run_report.json')) as f:
+                self.assertEqual([stage['name'] for stage in json.load(f)['stages']], ['empty_stage'])
+        self.assertIsNone(active_report())
+
+    def test_no_report(self):
+        """Outside of a run the stages run unchanged."""
+        self.assertTrue(os.path.exists(return_filtering(self.laz_fp, engine= 'numpy')))
+        self.assertFalse(os.path.exists(self.report_fp))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,16 @@
 """Tests for `snow_pc` package."""
 
 
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
+
+import numpy as np
 
 from snow_pc import snow_pc
+from tests.helpers import write_raster, write_utm_cloud
 
 
 class TestSnow_pc(unittest.TestCase):
@@ -19,3 +26,51 @@ class TestSnow_pc(unittest.TestCase):
 
     def test_000_something(self):
         """Test something."""
+
+
+class TestDifferenceDems(unittest.TestCase):
+    """Tests for differencing the aligned models of pc2snow."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_models_share_the_plan(self):
+        """The DTM and DSM of different extents are gridded on the reference DEM and difference with one plan."""
+        import rasterio
+        from snow_pc.align import apply_transform
+        from snow_pc.differencing import difference_rasters
+        from snow_pc.gridding import raster_grid
+
+        # a 1 m reference DEM whose corner is off the cloud bounds, the aligned rasters are 0.5 m
+        ref_fp = write_raster(os.path.join(self.tmp, 'dem.tif'), np.full((220, 230), 1500.0), x0= 499990.3, y0= 4800210.7)
+        dtm_laz = write_utm_cloud(os.path.join(self.tmp, 'dtm.laz'), n= 4000)
+        dsm_laz = write_utm_cloud(os.path.join(self.tmp, 'dsm.laz'), x0= 500013, y0= 4800021, size= 150.0, n= 3000, seed= 1)
+        transform_fp = os.path.join(self.tmp, 'identity-transform.txt')
+        np.savetxt(transform_fp, np.eye(4))
+        tifs = [apply_transform(laz_fp, transform_fp, os.path.join(self.tmp, name + '-align'), '/asp', ref_dem= ref_fp)
+                for laz_fp, name in [(dtm_laz, 'dtm'), (dsm_laz, 'dsm')]]
+
+        grid = raster_grid(ref_fp, 0.5)
+        for tif in tifs:
+            with rasterio.open(tif) as src:
+                self.assertEqual((src.width, src.height), (grid['width'], grid['height']))
+                self.assertEqual((src.transform.c, src.transform.f), (499990.3, 4800210.7))
+
+        plans = []
+        def record(src_fp, ref_fp, out_fp, plan = None, **kwargs):
+            plans.append(plan)
+            return difference_rasters(src_fp, ref_fp, out_fp, plan= plan, **kwargs)
+        with mock.patch('snow_pc.snow_pc.difference_rasters', record):
+            depth_fp, height_fp = snow_pc.difference_dems(*tifs, ref_fp, os.path.join(self.tmp, 'depth.tif'), os.path.join(self.tmp, 'height.tif'))
+        self.assertIs(plans[0], plans[1])
+        with rasterio.open(depth_fp) as depth, rasterio.open(height_fp) as height:
+            self.assertEqual(depth.shape, (220, 230))
+            d, h = depth.read(1, masked= True), height.read(1, masked= True)
+        # the clouds are 0 to 5 m above the reference and the DSM covers less of it
+        self.assertTrue(0 <= d.min() and d.max() <= 5 and 0 <= h.min() and h.max() <= 5)
+        self.assertLess(h.count(), d.count())
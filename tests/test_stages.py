@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.stages` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from snow_pc.stages import StageCache
+from snow_pc.snow_pc import pc2uncorrectedDEM
+
+
+class TestStageCache(unittest.TestCase):
+    """Tests for skipping the unchanged stages of a run."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.in_fp = os.path.join(self.tmp, 'in.txt')
+        with open(self.in_fp, 'w') as f:
+            f.write('a')
+        self.calls = []
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def stage(self, name, in_fp):
+        """A stage that copies its input and records that it ran."""
+        def func():
+            self.calls.append(name)
+            out_fp = os.path.join(self.tmp, f'{name}.txt')
+            shutil.copy(in_fp, out_fp)
+            return out_fp, 1
+        return func
+
+    def run_chain(self, k = 1, resume = True):
+        """Run two chained stages."""
+        stages = StageCache(self.tmp, resume = resume)
+        first, _ = stages.run('first', self.stage('first', self.in_fp), inputs = [self.in_fp])
+        return stages.run('second', self.stage('second', first), inputs = [first], params = {'k': k})
+
+    def test_000_rerun_skips(self):
+        """An unchanged rerun returns the recorded result without running the stages."""
+        result = self.run_chain()
+        self.assertEqual(self.run_chain(), result)
+        self.assertEqual(self.calls, ['first', 'second'])
+        self.run_chain(resume = False)
+        self.assertEqual(self.calls, ['first', 'second', 'first', 'second'])
+
+    def test_001_param_change_runs_downstream_only(self):
+        """Changing a parameter reruns its stage and not the stages before it."""
+        self.run_chain()
+        self.run_chain(k = 2)
+        self.assertEqual(self.calls, ['first', 'second', 'second'])
+
+    def test_002_input_change_runs_downstream(self):
+        """Changing an input reruns its stage and the stages after it."""
+        self.run_chain()
+        with open(self.in_fp, 'w') as f:
+            f.write('b')
+        self.run_chain()
+        self.assertEqual(self.calls, ['first', 'second', 'first', 'second'])
+
+    def test_003_missing_output_reruns(self):
+        """A stage whose output was removed runs again."""
+        self.run_chain()
+        os.remove(os.path.join(self.tmp, 'second.txt'))
+        self.run_chain()
+        self.assertEqual(self.calls, ['first', 'second', 'second'])
+
+    def test_004_pc2uncorrectedDEM_resumes(self):
+        """Changing mean_k reruns the models and not the preparation."""
+        cwd = os.getcwd()
+        in_dir = os.path.join(self.tmp, 'site')
+        os.makedirs(in_dir)
+        open(os.path.join(in_dir, 'a.laz'), 'w').close()
+        manifest = os.path.join(in_dir, 'snow-pc', 'results', 'unfiltered.json')
+        def prepare(in_dir):
+            self.calls.append('prepare')
+            with open(manifest, 'w') as f:
+                f.write('{"files": []}')
+            return manifest
+        def models(laz_fp, **kwargs):
+            self.calls.append('models')
+            return laz_fp, '', '', ''
+        try:
+            with mock.patch('snow_pc.snow_pc.prepare_pc', prepare), mock.patch('snow_pc.snow_pc.elevation_models', models), \
+                 mock.patch('snow_pc.snow_pc.pc_files', lambda fp: []):
+                pc2uncorrectedDEM(in_dir)
+                pc2uncorrectedDEM(in_dir)
+                pc2uncorrectedDEM(in_dir, mean_k = 10)
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(self.calls, ['prepare', 'models', 'models'])
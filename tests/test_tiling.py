@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.tiling` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import laspy
+import numpy as np
+
+from snow_pc.tiling import make_tiles, split_tiles, mosaic_laz, mosaic_tif, tile_pipeline, run_tiled
+from tests.helpers import write_cloud
+
+
+class TestTiling(unittest.TestCase):
+    """Tests for the tiled execution engine."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.laz_fp = write_cloud(os.path.join(self.tmp, 'in.laz'))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_000_tiles_cover_bounds(self):
+        """The tile cores cover the bounds without gaps and the buffers overlap."""
+        tiles = make_tiles((0, 0, 100, 100), tile_size= 40, buffer= 5)
+        self.assertEqual(len(tiles), 9)
+        self.assertEqual(tiles[0]['core'], (0, 0, 40, 40))
+        self.assertEqual(tiles[0]['buffered'], (-5, -5, 45, 45))
+        self.assertTrue(max(t['core'][2] for t in tiles) > 100)
+
+    def test_001_split_and_mosaic_round_trip(self):
+        """Cropping the buffers off the tiles gives back every point exactly once."""
+        with laspy.open(self.laz_fp) as las:
+            bounds = (las.header.mins[0], las.header.mins[1], las.header.maxs[0], las.header.maxs[1])
+        tiles = make_tiles(bounds, tile_size= 30, buffer= 5)
+        tile_fps = split_tiles(self.laz_fp, tiles, os.path.join(self.tmp, 'tiles'), chunk_size= 1000)
+        # the buffers duplicate the points near the tile edges
+        self.assertGreater(sum(laspy.read(fp).header.point_count for fp in tile_fps.values()), 5000)
+
+        out_fp = mosaic_laz(tile_fps, tiles, os.path.join(self.tmp, 'mosaic.laz'), chunk_size= 1000)
+        original = laspy.read(self.laz_fp)
+        mosaic = laspy.read(out_fp)
+        self.assertEqual(len(mosaic.points), len(original.points))
+        key = lambda las: np.sort(np.asarray(las.X, dtype= np.int64) * 10**9 + np.asarray(las.Y, dtype= np.int64))
+        np.testing.assert_array_equal(key(mosaic), key(original))
+
+    def test_002_tile_pipeline_pins_grid(self):
+        """The tile pipeline reads the tile and writes the rasters on the tile core."""
+        tiles = make_tiles((0, 0, 100, 100), tile_size= 40, buffer= 5)
+        pipeline = {"pipeline": [{"type": "readers.las", "filename": "in.laz"},
+                                 {"type": "writers.gdal", "filename": "/out/dtm.tif", "resolution": 1.0}]}
+        tiled = tile_pipeline(pipeline, tiles[4], 'tile.laz', '/work/tile', {'resolution': 1.0})['pipeline']
+        self.assertEqual(tiled[0]['filename'], 'tile.laz')
+        self.assertEqual(tiled[1]['filename'], os.path.join('/work/tile', 'dtm.tif'))
+        self.assertEqual((tiled[1]['origin_x'], tiled[1]['origin_y'], tiled[1]['width']), (40, 40, 40))
+        # the whole cloud pipeline is left untouched
+        self.assertEqual(pipeline['pipeline'][1]['filename'], '/out/dtm.tif')
+
+    def test_003_tile_pipeline_collapses_readers(self):
+        """The readers of a manifest are replaced by the single tile reader."""
+        tiles = make_tiles((0, 0, 100, 100), tile_size= 40, buffer= 5)
+        pipeline = {"pipeline": [{"type": "readers.las", "filename": "a.laz"}, {"type": "readers.las", "filename": "b.laz"},
+                                 {"type": "filters.merge"}, {"type": "filters.elm"}]}
+        tiled = tile_pipeline(pipeline, tiles[0], 'tile.laz', '/work/tile', {'resolution': 1.0})['pipeline']
+        self.assertEqual([s['type'] for s in tiled], ['readers.las', 'filters.elm'])
+
+    def test_004_mosaic_tif_places_tiles(self):
+        """Each tile raster lands in its window of the whole grid."""
+        import rasterio
+        from rasterio.transform import from_origin
+
+        tiles = make_tiles((0, 0, 19, 19), tile_size= 10, buffer= 2)
+        grid = {'origin_x': 0, 'origin_y': 0, 'resolution': 1.0, 'width': 20, 'height': 20}
+        tile_fps = {}
+        for i, tile in enumerate(tiles):
+            fp = os.path.join(self.tmp, f"{tile['name']}.tif")
+            with rasterio.open(fp, 'w', driver= 'GTiff', width= 10, height= 10, count= 1, dtype= 'float64', nodata= -9999,
+                               transform= from_origin(tile['core'][0], tile['core'][3], 1, 1)) as dst:
+                dst.write(np.full((1, 10, 10), i, dtype= 'float64'))
+            tile_fps[tile['name']] = fp
+        out_fp = mosaic_tif(tile_fps, tiles, os.path.join(self.tmp, 'mosaic.tif'), grid)
+        with rasterio.open(out_fp) as src:
+            data = src.read(1)
+            self.assertEqual(src.bounds, (0, 0, 20, 20))
+        self.assertEqual(data[19, 0], 0)
+        self.assertEqual(data[0, 19], 3)
+
+    @unittest.skipIf(shutil.which('pdal') is None, 'pdal is not installed')
+    def test_005_tiled_matches_single_pass(self):
+        """The tiled raster matches the single pass raster."""
+        import json
+        import subprocess
+        import rasterio
+
+        single = os.path.join(self.tmp, 'single.tif')
+        tiled = os.path.join(self.tmp, 'tiled.tif')
+        pipeline = lambda out: {"pipeline": [{"type": "readers.las", "filename": self.laz_fp},
+                                             {"type": "writers.gdal", "filename": out, "resolution": 1.0, "output_type": "idw"}]}
+        json_fp = os.path.join(self.tmp, 'single.json')
+        with open(json_fp, 'w') as f:
+            json.dump(pipeline(single), f)
+        subprocess.run(['pdal', 'pipeline', json_fp], check= True)
+        run_tiled(pipeline(tiled), tile_size= 30, buffer= 5, n_workers= 2)
+        with rasterio.open(single) as a, rasterio.open(tiled) as b:
+            self.assertEqual(a.transform, b.transform)
+            np.testing.assert_allclose(a.read(1), b.read(1))
+
+        # the noise filters label the same points tiled
+        noise = lambda out: {"pipeline": [self.laz_fp, {"type": "filters.elm"},
+                                          {"type": "filters.outlier", "method": "statistical", "mean_k": 8, "multiplier": 2},
+                                          {"type": "writers.las", "filename": out}]}
+        single = os.path.join(self.tmp, 'single.laz')
+        tiled = os.path.join(self.tmp, 'tiled.laz')
+        with open(json_fp, 'w') as f:
+            json.dump(noise(single), f)
+        subprocess.run(['pdal', 'pipeline', json_fp], check= True)
+        run_tiled(noise(tiled), tile_size= 30, buffer= 5, n_workers= 2)
+        a, b = laspy.read(single), laspy.read(tiled)
+        order = lambda las: np.lexsort((np.asarray(las.Z), np.asarray(las.Y), np.asarray(las.X)))
+        np.testing.assert_array_equal(np.asarray(a.classification)[order(a)], np.asarray(b.classification)[order(b)])
+
+    def test_006_no_points_raises(self):
+        """A point cloud without points has no tile to run."""
+        empty_fp = os.path.join(self.tmp, 'empty.laz')
+        with laspy.open(self.laz_fp) as reader:
+            header = reader.header
+        with laspy.open(empty_fp, mode= 'w', header= header):
+            pass
+        pipeline = {"pipeline": [empty_fp, {"type": "writers.las", "filename": os.path.join(self.tmp, 'out.laz')}]}
+        with self.assertRaises(ValueError):
+            run_tiled(pipeline, tile_size= 30, buffer= 5, work_dir= os.path.join(self.tmp, 'tiles'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'tiles')))
+
+    def test_007_noise_labels_match_single_pass(self):
+        """The elm and outlier labels of the tiles are the labels of a single pass over the whole cloud."""
+        from snow_pc.noise import read_xyz, statistical_outliers, elm_cutoffs, elm_cells, NOISE
+        from snow_pc.tiling import classify_noise
+
+        laz_fp = write_cloud(os.path.join(self.tmp, 'noisy.laz'), n= 20000)
+        las = laspy.read(laz_fp)
+        z = np.asarray(las.z).copy()
+        # points far above the surface and low noise below it
+        z[:20] += 80
+        z[20:60] -= 10
+        las.z = z
+        las.write(laz_fp)
+
+        # filters.elm then filters.outlier over the whole cloud with one KD-tree
+        xyz = read_xyz(laz_fp)
+        grid, cutoffs = elm_cutoffs(laz_fp)
+        noise = (xyz[:, 2] < cutoffs[elm_cells(grid, xyz[:, 0], xyz[:, 1])]) | statistical_outliers(xyz, 20, 3, tile_size= 1e6)
+        single = dict(zip(map(tuple, np.round(xyz * 100).astype(np.int64).tolist()), noise))
+
+        stages = [{"type": "filters.elm"}, {"type": "filters.outlier", "method": "statistical", "mean_k": 20, "multiplier": 3}]
+        noise_fp = classify_noise(laz_fp, stages, os.path.join(self.tmp, 'noise.laz'))
+        tiles = make_tiles((xyz[:, 0].min(), xyz[:, 1].min(), xyz[:, 0].max(), xyz[:, 1].max()), tile_size= 40, buffer= 10)
+        tile_fps = split_tiles(noise_fp, tiles, os.path.join(self.tmp, 'tiles'))
+        n, diff = 0, 0
+        for tile in tiles:
+            if tile['name'] not in tile_fps:
+                continue
+            points = laspy.read(tile_fps[tile['name']])
+            x, y = np.asarray(points.x), np.asarray(points.y)
+            minx, miny, maxx, maxy = tile['core']
+            core = (x >= minx) & (x < maxx) & (y >= miny) & (y < maxy)
+            txyz = np.column_stack([x, y, np.asarray(points.z)])[core]
+            labels = np.asarray(points.classification)[core] == NOISE
+            for p, label in zip(np.round(txyz * 100).astype(np.int64).tolist(), labels):
+                n += 1
+                diff += label != single[tuple(p)]
+        self.assertEqual(n, 20000)
+        self.assertTrue(noise[:20].all() and noise[20:60].any())
+        self.assertEqual(diff, 0)
+        with self.assertRaises(ValueError):
+            classify_noise(laz_fp, [{"type": "filters.outlier", "method": "radius"}], os.path.join(self.tmp, 'radius.laz'))
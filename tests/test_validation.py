@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Tests for `snow_pc.validation` module."""
+
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from snow_pc.validation import sample_points, sample_polygons, probe_metrics, road_metrics, snowdepth_metrics
+from tests.helpers import write_raster
+
+
+class TestSampling(unittest.TestCase):
+    """Tests for the vectorized raster sampling."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        rows, cols = np.mgrid[0:100, 0:100]
+        data = (rows * 100 + cols).astype(np.float64)
+        data[50, 50] = -9999
+        self.raster_fp = write_raster(os.path.join(self.tmp, 'depth.tif'), data)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_points(self):
+        """Points take the pixel they fall in with nearest, with NaN off the raster and on nodata."""
+        x = np.array([500000.5, 500010.2, 500050.5, 499990.0, 500099.9])
+        y = np.array([4800099.5, 4800079.9, 4800049.5, 4800050.0, 4800000.1])
+        values = sample_points(self.raster_fp, x, y, 'EPSG:32611', block_size= 16, interpolate= 'nearest')
+        np.testing.assert_array_equal(values[[0, 1, 4]], [0, 2010, 9999])
+        self.assertTrue(np.isnan(values[2]) and np.isnan(values[3]))
+
+    def test_buffer(self):
+        """Buffered points average the pixel centers within the buffer and skip nodata."""
+        values = sample_points(self.raster_fp, [500020.5, 500050.5], [4800079.5, 4800049.5], 'EPSG:32611', buffer= 1.0, block_size= 16)
+        # the center pixel and its four neighbours
+        self.assertAlmostEqual(values[0], 2020.0)
+        self.assertAlmostEqual(values[1], (4950 + 5049 + 5051 + 5150) / 4)
+
+    def test_reprojected(self):
+        """A raster in another crs is sampled like the reprojected raster."""
+        import rasterio
+        from rasterio.warp import reproject, calculate_default_transform, Resampling
+        from pyproj import Transformer
+
+        x, y = Transformer.from_crs('EPSG:32611', 'EPSG:32612', always_xy= True).transform(
+            np.array([500020.5, 500070.5]), np.array([4800079.5, 4800029.5]))
+        values = sample_points(self.raster_fp, x, y, 'EPSG:32612', block_size= 16, interpolate= 'nearest')
+
+        with rasterio.open(self.raster_fp) as src:
+            transform, width, height = calculate_default_transform(src.crs, 'EPSG:32612', src.width, src.height, *src.bounds)
+            full = np.full((height, width), np.nan)
+            reproject(src.read(1), full, src_transform= src.transform, src_crs= src.crs, src_nodata= src.nodata,
+                      dst_transform= transform, dst_crs= 'EPSG:32612', dst_nodata= np.nan, resampling= Resampling.nearest)
+        col, row = ~transform * (x, y)
+        np.testing.assert_array_equal(values, full[np.floor(row).astype(int), np.floor(col).astype(int)])
+
+    def test_bilinear_matches_point_query(self):
+        """Without a buffer the points are interpolated like rasterstats.point_query, also next to nodata and the edges."""
+        import rasterio
+        from rasterstats import point_query
+        from shapely.geometry import Point
+
+        rng = np.random.default_rng(0)
+        x = np.concatenate([500000 + rng.uniform(0, 100, 200), [500050.3, 500049.6, 500000.2, 500099.9]])
+        y = np.concatenate([4800000 + rng.uniform(0, 100, 200), [4800049.7, 4800050.4, 4800099.9, 4800000.2]])
+        values = sample_points(self.raster_fp, x, y, 'EPSG:32611', block_size= 16)
+        with rasterio.open(self.raster_fp) as src:
+            expected = point_query([Point(p) for p in zip(x, y)], src.read(1), affine= src.transform, nodata= -9999)
+        expected = np.array([np.nan if v is None else v for v in expected], dtype= np.float64)
+        np.testing.assert_allclose(values, expected, equal_nan= True)
+
+    def test_polygons(self):
+        """Polygons take the pixels whose centers are inside them."""
+        from shapely.geometry import box
+
+        values = sample_polygons(self.raster_fp, [box(500000, 4800096, 500002, 4800100), box(500048, 4800048, 500053, 4800051)],
+                                 'EPSG:32611', block_size= 16)
+        expected = [0, 1, 100, 101, 200, 201, 300, 301] + [r * 100 + c for r in (49, 50, 51) for c in range(48, 53) if (r, c) != (50, 50)]
+        np.testing.assert_array_equal(np.sort(values), np.sort(expected))
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the headless validation metrics."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        # 1 m of snow with a snow free road along the top rows
+        data = np.ones((100, 100))
+        data[:4] = 0.02
+        self.raster_fp = write_raster(os.path.join(self.tmp, 'depth.tif'), data)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_probe_metrics(self):
+        """The metrics of probed against lidar depths."""
+        metrics = probe_metrics([1.0, 2.0, 3.0, 4.0], [1.1, 1.9, 3.2, 4.0])
+        self.assertEqual(metrics['n'], 4)
+        self.assertAlmostEqual(metrics['mbe'], -0.05)
+        self.assertAlmostEqual(metrics['mae'], 0.1)
+        self.assertAlmostEqual(metrics['rmse'], np.sqrt(0.06 / 4))
+        self.assertAlmostEqual(metrics['nmad'], 1.4826 * 0.1)
+        self.assertIsNone(probe_metrics([], [])['r'])
+        self.assertIsNone(probe_metrics([1.0, 2.0], [1.5, 1.5])['r'])
+
+    def test_road_metrics(self):
+        """The road residuals are the lidar snow depth on the road."""
+        metrics = road_metrics([0.0, 0.1, -0.1, 0.2])
+        self.assertAlmostEqual(metrics['mean'], 0.05)
+        self.assertAlmostEqual(metrics['median'], 0.05)
+        self.assertAlmostEqual(metrics['nmad'], 1.4826 * 0.1)
+
+    def test_snowdepth_metrics(self):
+        """Probes in cm and a road shapefile give the metrics without a figure."""
+        import pandas as pd
+        import geopandas as gpd
+        from shapely.geometry import LineString
+
+        pd.DataFrame({'depth': [100, 110, 90, None], 'y': [4800050.5, 4800040.5, 4800030.5, 4800020.5],
+                      'x': [500050.5, 500040.5, 500030.5, 500020.5]}).to_csv(os.path.join(self.tmp, 'probes.csv'), index= False)
+        road_fp = os.path.join(self.tmp, 'road.shp')
+        gpd.GeoDataFrame(geometry= [LineString([(500000, 4800098), (500100, 4800098)])], crs= 'EPSG:32611').to_file(road_fp)
+
+        metrics = snowdepth_metrics(self.raster_fp, os.path.join(self.tmp, 'probes.csv'), 'depth', 'y', 'x', road_shp= road_fp, csv_EPSG= 32611)
+        self.assertEqual(metrics['n'], 3)
+        self.assertAlmostEqual(metrics['mbe'], 0.0)
+        self.assertAlmostEqual(metrics['mae'], 0.2 / 3)
+        # the lidar depth is constant, so there is no correlation and the metrics are valid json
+        self.assertIsNone(metrics['r'])
+        json.dumps(metrics, allow_nan= False)
+        self.assertEqual(metrics['road']['n'], 400)
+        self.assertAlmostEqual(metrics['road']['mean'], 0.02)
+        self.assertIsNone(snowdepth_metrics(self.raster_fp, os.path.join(self.tmp, 'probes.csv'), 'depth', 'y', 'x', csv_EPSG= 32611)['road'])
+
+
+if __name__ == '__main__':
+    unittest.main()